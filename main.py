@@ -1,5 +1,6 @@
 from fastapi import FastAPI, BackgroundTasks, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
@@ -7,6 +8,7 @@ from fastapi import Request
 import uvicorn
 import uuid
 import json
+import threading
 import time
 import os
 import sys
@@ -14,7 +16,11 @@ import sys
 sys.path.append(os.path.dirname(__file__))
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 from src.chat import process_message, sessions, update_user_agent, get_current_agent_config, clear_session, get_session_messages
-from utils import logger
+from src.agent import warm_up_agents
+from src.llm_client import warm_up_llm_clients
+from src.progress import ProgressChannel, progress_channel
+from src.value_index import start_value_index
+from utils import logger, metrics
 
 
 app = FastAPI(title="Swarm API", description="通过API与Swarm智能体交互的服务")
@@ -29,6 +35,22 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def warm_up():
+    """启动时预热LLM连接和智能体模板，避免第一个请求承担建连和构建开销"""
+    warm_up_agents()
+    warm_up_llm_clients()
+    # 分类字段取值索引在后台构建，不阻塞启动
+    start_value_index()
+
+
+@app.on_event("shutdown")
+def flush_memory():
+    """退出前把内存中尚未落盘的会话写入文件"""
+    from src.chat import memory_manager
+    memory_manager.close()
+
+
 # 请求和响应模型
 class MessageRequest(BaseModel):
     session_id: Optional[str] = None
@@ -82,6 +104,32 @@ def chat(request: ChatRequest, req: Request):
             user_id=user_id  # 传递用户标识
         )
 
+        # 当日token配额已用完
+        if response is not None and response.get("quota_exceeded"):
+            return {
+                "code": 429,
+                "data": {
+                    "error": response["error"],
+                    "message": "今日额度已用完，请明天再试",
+                    "session_id": session_id,
+                    "timestamp": current_timestamp,
+                    "user": user_id
+                }
+            }
+
+        # LLM服务熔断中，返回降级回复
+        if response is not None and response.get("degraded"):
+            return {
+                "code": 503,
+                "data": {
+                    "error": response["error"],
+                    "message": "抱歉，模型服务暂时不可用，请稍后再试...",
+                    "session_id": session_id,
+                    "timestamp": current_timestamp,
+                    "user": user_id
+                }
+            }
+
         # 检查是否有错误字段
         if response is not None and "error" in response:
             return {
@@ -144,6 +192,54 @@ def chat(request: ChatRequest, req: Request):
                 }
             }
 
+@app.post("/api/chat/stream")
+def chat_stream(request: ChatRequest, req: Request):
+    """处理聊天请求，以SSE推送分析过程中的进度事件，最后推送完整回复"""
+    user_id = req.headers.get("X-Forwarded-For", req.client.host)
+    session_id = request.session_id if request.session_id else "default"
+    channel = ProgressChannel()
+    result = {}
+
+    def run():
+        with progress_channel(channel):
+            try:
+                result["response"] = process_message(
+                    session_id=session_id,
+                    user_message=request.message,
+                    stream=request.stream if request.stream is not None else True,
+                    user_id=user_id
+                )
+            except Exception as e:
+                logger.info(f"处理流式聊天请求时出错: {str(e)}")
+                result["response"] = {"error": str(e)}
+            finally:
+                channel.close()
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def event_stream():
+        for event in channel.events(timeout=15):
+            if event is None:
+                # 心跳，防止代理在长时间无数据时断开连接
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: progress\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+
+        response = result.get("response") or {}
+        assistant_message = next(
+            (item['content'] for item in reversed(response.get('response', [])) if item.get('role') == 'assistant'),
+            ""
+        )
+        data = {"response": assistant_message, "session_id": session_id}
+        # 客户端据此区分配额用完、熔断降级和普通错误，并显示本会话的用量
+        for key in ("error", "quota_exceeded", "degraded", "usage"):
+            if key in response:
+                data[key] = response[key]
+        yield f"event: done\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 # 修改获取会话消息API端点
 @app.get("/api/sessions/{session_id}/messages")
 def api_get_session_messages(session_id: str, req: Request):
@@ -154,15 +250,17 @@ def api_get_session_messages(session_id: str, req: Request):
 class AgentConfigResponse(BaseModel):
     model_name: str
 @app.post("/api/init", response_model=AgentConfigResponse)
-async def initialize_agent(config: AgentConfigRequest):
+async def initialize_agent(config: AgentConfigRequest, req: Request):
     """初始化智能体配置"""
-    # 更新全局智能体
+    user_id = req.headers.get("X-Forwarded-For", req.client.host)
+    # 更新该用户使用的模型
     update_user_agent(
+        user_id=user_id,
         model_name=config.model_name,
     )
 
     # 返回当前配置
-    current_config = get_current_agent_config()
+    current_config = get_current_agent_config(user_id)
     return current_config
 
 
@@ -219,7 +317,8 @@ def api_delete_session(session_id: str, req: Request):
     """API端点：删除指定的会话及其文件"""
     current_timestamp = get_current_timestamp()
     user_id = req.headers.get("X-Forwarded-For", "BalteMayer")
-    combined_id = f"{user_id}_{session_id}"
+    # 和聊天接口相同的组合会话ID
+    combined_id = f"{user_id}:{session_id}"
 
     try:
         # 导入会话管理器
@@ -279,6 +378,15 @@ def health_check(req: Request):
     }
 
 
+@app.get("/api/metrics")
+def api_metrics():
+    """API端点：导出进程内统计指标"""
+    return {
+        "code": 200,
+        "data": metrics.snapshot()
+    }
+
+
 @app.get("/api/sessions")
 def list_sessions(req: Request):
     """获取指定会话的完整记忆"""
@@ -296,8 +404,8 @@ def list_sessions(req: Request):
             }
         }
 
-    # 构造完整的会话ID (user_id_session_id)
-    combined_id = f"{user_id}_{session_id}"
+    # 构造完整的会话ID (user_id:session_id)，和聊天接口相同
+    combined_id = f"{user_id}:{session_id}"
 
     # 导入会话管理器
     from src.chat import memory_manager
@@ -307,10 +415,6 @@ def list_sessions(req: Request):
         # 获取完整的会话消息
         session_data = memory_manager.get_messages(combined_id)
 
-        # 获取会话元数据
-        sessions_info = memory_manager.list_available_sessions()
-        session_info = next((s for s in sessions_info if s['session_id'] == combined_id), None)
-
         return {
             "code": 200,
             "data": {
@@ -330,7 +434,7 @@ def list_sessions(req: Request):
 
 @app.get("/api/sessions/list")
 def list_all_sessions(req: Request):
-    """API端点：获取所有会话列表，每个会话包含title和session_id"""
+    """API端点：获取当前用户的会话列表，每个会话包含title和session_id"""
     current_timestamp = get_current_timestamp()
     user_id = req.headers.get("X-Forwarded-For", req.client.host)
 
@@ -338,30 +442,15 @@ def list_all_sessions(req: Request):
         # 导入会话管理器
         from src.chat import memory_manager
 
-        # 获取会话文件列表
-        sessions_dir = memory_manager.sessions_dir
-        session_list = []
-
-        if os.path.exists(sessions_dir):
-            for file_name in os.listdir(sessions_dir):
-                if file_name.endswith('.json'):
-                    file_path = os.path.join(sessions_dir, file_name)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                            # 获取session_id，去掉文件扩展名
-                            session_id = file_name[:-5]
-
-                            # 从文件读取title，如果不存在则使用默认值
-                            title = data.get('title', '未命名会话')
-
-                            # 添加到会话列表
-                            session_list.append({
-                                'title': title,
-                                'session_id': session_id.replace("_", ":")
-                            })
-                    except Exception as e:
-                        print(f"读取会话文件失败 {file_path}: {str(e)}")
+        # 只读取当前用户的分片目录，JSONL格式下只读每个文件的第一行；session_id不含用户前缀
+        prefix = f"{user_id}:"
+        session_list = [
+            {
+                'title': info.get('title') or '未命名会话',
+                'session_id': info['session_id'][len(prefix):]
+            }
+            for info in memory_manager.list_user_sessions(user_id, limit=1000)
+        ]
 
         return {
             "code": 200,
@@ -381,5 +470,47 @@ def list_all_sessions(req: Request):
         }
 
 
+
+@app.get("/api/sessions/search")
+def search_sessions(req: Request, q: str = "", page: int = 1, page_size: int = 20):
+    """API端点：全文检索当前用户的会话消息，按相关度排序分页返回"""
+    current_timestamp = get_current_timestamp()
+    user_id = req.headers.get("X-Forwarded-For", req.client.host)
+
+    if not q.strip():
+        return {
+            "code": 400,
+            "data": {
+                "error": "查询参数 q 不能为空",
+                "timestamp": current_timestamp,
+                "user": user_id
+            }
+        }
+
+    try:
+        from src.chat import memory_manager
+
+        found = memory_manager.search_sessions(user_id, q, page=page, page_size=page_size)
+        return {
+            "code": 200,
+            "data": {
+                "total": found["total"],
+                "page": page,
+                "page_size": page_size,
+                "results": found["results"],
+            }
+        }
+    except Exception as e:
+        return {
+            "code": 500,
+            "data": {
+                "error": str(e),
+                "message": "检索会话失败",
+                "timestamp": current_timestamp,
+                "user": user_id
+            }
+        }
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001, reload=False)
\ No newline at end of file
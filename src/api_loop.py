@@ -1,5 +1,6 @@
 import json
 from swarm import Swarm
+from src.llm_client import get_swarm_client
 
 
 def run_api_loop(
@@ -12,7 +13,8 @@ def run_api_loop(
         debug=False):
 
 
-    client = Swarm(openai_client)
+    # 复用进程内共享的Swarm客户端，不再每个请求新建
+    client = openai_client if isinstance(openai_client, Swarm) else get_swarm_client(openai_client)
 
     if messages is None:
         messages = []
@@ -0,0 +1,333 @@
+"""
+工具参数的表结构校验与自动纠正
+
+在访问数据库之前，用 data/config.json 里的表结构检查模型传入的表名、字段名和过滤值:
+- 表名/字段名: 精确匹配 -> 忽略大小写 -> 别名(如 group->jlugroup, gender->sex) -> 相似度匹配
+- 字段不在指定的表里、但只在另一张表里存在时，纠正表名
+- 日期字段的过滤值用 utils.date_parser 解析("2025年4月"、"上个月"等)，按字段的存储类型格式化
+- 分类字段的过滤值交给注册的取值解析器纠正(见 register_value_resolver)
+能纠正的参数在本地直接修复，无法纠正时返回带候选项的错误信息，不再发起注定失败的查询。
+"""
+import difflib
+import os
+import re
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils import format_range, load_db_config, logger, metrics, parse_date_range
+
+
+def get_base_path():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+CONFIG_PATH = os.path.join(get_base_path(), 'data', 'config.json')
+
+# 模型常用的字段名 -> 库里实际的字段名
+FIELD_ALIASES = {
+    "group": "jlugroup",
+    "groups": "jlugroup",
+    "group_name": "jlugroup",
+    "组织": "jlugroup",
+    "组别": "jlugroup",
+    "分组": "jlugroup",
+    "gender": "sex",
+    "性别": "sex",
+    "name": "nickname",
+    "姓名": "nickname",
+    "学校": "school",
+    "校区": "school",
+    "身份": "identity",
+    "分类": "classification",
+}
+
+# 相似度匹配的阈值
+FUZZY_CUTOFF = float(os.environ.get('ARG_FUZZY_CUTOFF', '0.75'))
+
+# 参数名 -> 其值是哪张表的字段(参数名或固定表名)
+_FIELD_TABLE_ARGS = (
+    ("x_field", "x_table"),
+    ("x_index_field", "x_table"),
+    ("y_field", "y_table"),
+    ("y_index_field", "y_table"),
+    ("series_field", "y_table"),
+)
+
+# 类型不是日期时间、但按名字判断存的是日期的字段(如文本类型的 time 字段)；只用于文本类型的列
+_DATE_NAME_HINTS = ("date", "day", "created", "updated", "日期")
+# 名字里的time只在表示时刻时算日期(time、start_time、lasttime)，totaltime这类时长字段不算
+_TIME_NAME_PATTERN = re.compile(r'^((last|first|start|end|begin|create|update)_?)?time$|_time$|时间$', re.I)
+_DURATION_HINTS = ("total", "duration", "elapsed", "cost", "时长")
+_NUMERIC_TYPES = ("int", "decimal", "numeric", "float", "double", "real", "bit")
+
+_TIME_OF_DAY = re.compile(r'\d:\d{2}')
+
+_SQL_TABLE_PATTERN = re.compile(r'\b(FROM|JOIN)\s+(`?)([A-Za-z_][\w]*)\2', re.I)
+
+
+class SchemaCatalog:
+    """表结构目录，按配置文件的修改时间缓存"""
+
+    def __init__(self, config_path: str = CONFIG_PATH):
+        self._config_path = config_path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._tables: Dict[str, Dict[str, str]] = {}
+
+    @property
+    def tables(self) -> Dict[str, Dict[str, str]]:
+        try:
+            mtime = os.path.getmtime(self._config_path)
+        except OSError:
+            mtime = None
+        if mtime != self._mtime or not self._tables:
+            with self._lock:
+                if mtime != self._mtime or not self._tables:
+                    try:
+                        config = load_db_config()
+                        tables = config.get("mysql", config).get("tables", {})
+                        self._tables = {name: dict(table.get("fields", {})) for name, table in tables.items()}
+                        self._mtime = mtime
+                    except Exception as e:
+                        logger.warning(f"加载表结构目录失败: {e}")
+        return self._tables
+
+    def field_type(self, table: str, field: str) -> Optional[str]:
+        return self.tables.get(table, {}).get(field)
+
+    def resolve_table(self, name: str) -> Optional[str]:
+        """返回库里实际的表名，找不到时返回None"""
+        tables = self.tables
+        if name in tables:
+            return name
+        return _match(name, list(tables))
+
+    def resolve_field(self, table: str, name: str) -> Optional[str]:
+        """返回表里实际的字段名，找不到时返回None"""
+        fields = self.tables.get(table, {})
+        if name in fields:
+            return name
+        alias = FIELD_ALIASES.get(name) or FIELD_ALIASES.get(name.lower())
+        if alias in fields:
+            return alias
+        return _match(name, list(fields))
+
+    def tables_with_field(self, field: str) -> List[str]:
+        return [table for table, fields in self.tables.items() if field in fields]
+
+
+def _match(name: str, candidates: List[str]) -> Optional[str]:
+    lowered = {candidate.lower(): candidate for candidate in candidates}
+    if name.lower() in lowered:
+        return lowered[name.lower()]
+    close = difflib.get_close_matches(name.lower(), list(lowered), n=1, cutoff=FUZZY_CUTOFF)
+    return lowered[close[0]] if close else None
+
+
+schema_catalog = SchemaCatalog()
+
+# 分类字段取值解析器: (表, 字段, 值) -> 库里实际的值或None
+_value_resolvers: List[Callable[[str, str, str], Optional[str]]] = []
+
+
+def register_value_resolver(resolver: Callable[[str, str, str], Optional[str]]) -> None:
+    """注册分类字段取值的纠正函数"""
+    _value_resolvers.append(resolver)
+
+
+def is_date_field(field: str, column_type: Optional[str]) -> bool:
+    column_type = (column_type or "").lower()
+    if "date" in column_type or "time" in column_type:
+        return True
+    name = field.lower()
+    if any(numeric in column_type for numeric in _NUMERIC_TYPES) or any(hint in name for hint in _DURATION_HINTS):
+        return False
+    return bool(_TIME_NAME_PATTERN.search(name)) or any(hint in name for hint in _DATE_NAME_HINTS)
+
+
+def resolve_date_value(column_type: Optional[str], value: Any, bound: str) -> Any:
+    """把日期字段的过滤值解析成范围的一端(start取开始，end取结束)，无法解析时原样返回"""
+    if not isinstance(value, str) or not value or _TIME_OF_DAY.search(value):
+        # 已经精确到时刻的值保持不变
+        return value
+    date_range = parse_date_range(value)
+    if date_range is None:
+        return value
+    start, end = format_range(date_range, column_type)
+    return start if bound == "start" else end
+
+
+def resolve_value(table: str, field: str, value: Any) -> Any:
+    if not isinstance(value, str) or not value:
+        return value
+    for resolver in _value_resolvers:
+        try:
+            resolved = resolver(table, field, value)
+        except Exception as e:
+            logger.warning(f"取值解析失败 {table}.{field}={value}: {e}")
+            continue
+        if resolved is not None:
+            return resolved
+    return value
+
+
+class ArgumentError(Exception):
+    """无法纠正的工具参数"""
+
+
+def _each(value: Any) -> Tuple[List[Any], bool]:
+    if isinstance(value, list):
+        return list(value), True
+    return [value], False
+
+
+def _pick(values: List[Any], index: int) -> Any:
+    if not values:
+        return None
+    return values[index] if index < len(values) else values[-1]
+
+
+def _bound_field_args(args: Dict[str, Any], table_arg: str) -> List[str]:
+    """取值是table_arg所指表的字段的参数(y_table没有提供时y的字段也属于x_table)"""
+    tables = {table_arg}
+    if table_arg == "x_table" and not args.get("y_table"):
+        tables.add("y_table")
+    return [field_arg for field_arg, bound in _FIELD_TABLE_ARGS if bound in tables]
+
+
+def _rebind_fields(args: Dict[str, Any], table_arg: str, field_arg: str, table: str,
+                   fix: Callable[[str, Any, Any], None]) -> bool:
+    """
+    把表参数改成table之前，检查同一表参数下的其他字段在table里是否都存在；
+    都存在时按table纠正这些字段并返回True，否则不改动参数并返回False
+    """
+    resolved = {}
+    for other in _bound_field_args(args, table_arg):
+        if other == field_arg or not isinstance(args.get(other), str) or not args.get(other):
+            continue
+        field = schema_catalog.resolve_field(table, args[other])
+        if field is None:
+            return False
+        resolved[other] = field
+    for other, field in resolved.items():
+        fix(other, args[other], field)
+        args[other] = field
+    return True
+
+
+def correct_mysql_arguments(arguments: Dict[str, Any], record: bool = True) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    校验并纠正mysql_caculator的参数
+
+    返回 (纠正后的参数, 纠正记录)。无法纠正时抛出ArgumentError，错误信息里带可选的表名或字段名。
+    record为False时不记录日志和指标(用于投机查询预判)。
+    """
+    catalog = schema_catalog
+    if not catalog.tables:
+        # 没有表结构信息时不做校验
+        return arguments, []
+
+    args = dict(arguments)
+    corrections = []
+
+    def fix(kind: str, old: Any, new: Any) -> None:
+        if new != old:
+            corrections.append(f"{kind}: {old} -> {new}")
+
+    # 表名
+    for table_arg in ("x_table", "y_table"):
+        values, is_list = _each(args.get(table_arg))
+        fixed = []
+        for value in values:
+            if not isinstance(value, str) or not value:
+                fixed.append(value)
+                continue
+            table = catalog.resolve_table(value)
+            if table is None:
+                raise ArgumentError(f"表 {value} 不存在，可用的表: {', '.join(catalog.tables)}")
+            fix(table_arg, value, table)
+            fixed.append(table)
+        if args.get(table_arg) is not None:
+            args[table_arg] = fixed if is_list else fixed[0]
+
+    # 字段名
+    for field_arg, table_arg in _FIELD_TABLE_ARGS:
+        values, is_list = _each(args.get(field_arg))
+        tables, _ = _each(args.get(table_arg) or args.get("x_table"))
+        fixed = []
+        for i, value in enumerate(values):
+            table = _pick(tables, i)
+            if not isinstance(value, str) or not value or not isinstance(table, str):
+                fixed.append(value)
+                continue
+            field = catalog.resolve_field(table, value)
+            if field is None:
+                # 字段只存在于另一张表、且该表参数对应的其他字段在那张表里也都存在时，纠正单值的表名参数
+                owners = catalog.tables_with_field(value)
+                if (len(owners) == 1 and not isinstance(args.get(table_arg), list)
+                        and _rebind_fields(args, table_arg, field_arg, owners[0], fix)):
+                    fix(table_arg, args.get(table_arg), owners[0])
+                    args[table_arg] = owners[0]
+                    tables = [owners[0]]
+                    field = value
+                else:
+                    raise ArgumentError(
+                        f"表 {table} 中没有字段 {value}，可用的字段: {', '.join(catalog.tables.get(table, {}))}"
+                    )
+            fix(field_arg, value, field)
+            fixed.append(field)
+        if args.get(field_arg) is not None:
+            args[field_arg] = fixed if is_list else fixed[0]
+
+    # 日期字段和分类字段的过滤值
+    for prefix in ("x", "y"):
+        index_fields, _ = _each(args.get(f"{prefix}_index_field"))
+        tables, _ = _each(args.get(f"{prefix}_table"))
+        for bound in ("start", "end"):
+            value_arg = f"{prefix}_{bound}_index"
+            values, is_list = _each(args.get(value_arg))
+            if args.get(value_arg) is None:
+                continue
+            fixed = []
+            for i, value in enumerate(values):
+                table, field = _pick(tables, i), _pick(index_fields, i)
+                if not isinstance(table, str) or not isinstance(field, str):
+                    resolved = value
+                elif is_date_field(field, catalog.field_type(table, field)):
+                    resolved = resolve_date_value(catalog.field_type(table, field), value, bound)
+                else:
+                    resolved = resolve_value(table, field, value)
+                fix(value_arg, value, resolved)
+                fixed.append(resolved)
+            args[value_arg] = fixed if is_list else fixed[0]
+
+    if corrections and record:
+        metrics.inc("tool_argument_corrections_total", len(corrections), tool="mysql_caculator")
+        logger.info(f"已纠正mysql_caculator参数: {'; '.join(corrections)}")
+    return args, corrections
+
+
+def correct_sql(query: str) -> Tuple[str, List[str]]:
+    """纠正SQL中FROM/JOIN后的表名，其余部分不改动"""
+    catalog = schema_catalog
+    if not catalog.tables:
+        return query, []
+
+    corrections = []
+
+    def replace(match):
+        keyword, quote, name = match.groups()
+        table = catalog.resolve_table(name)
+        if table is None or table == name:
+            return match.group(0)
+        corrections.append(f"table: {name} -> {table}")
+        return f"{keyword} {quote}{table}{quote}"
+
+    corrected = _SQL_TABLE_PATTERN.sub(replace, query)
+    if corrections:
+        metrics.inc("tool_argument_corrections_total", len(corrections), tool="query_database")
+        logger.info(f"已纠正SQL表名: {'; '.join(corrections)}")
+    return corrected, corrections
@@ -0,0 +1,126 @@
+"""
+会话消息中大块图表/查询结果的内容寻址存储
+
+助手消息里的 $$$$图表数据$$$$ 和 &&&&查询结果&&&& 动辄几十KB，原样放在会话里会随每次落盘重写、
+占用会话缓存。超过阈值的结果按内容的sha256存成压缩文件 data/memory/blobs/ab/abcdef....z，
+消息里只保留引用 $$$$blob:<sha256>$$$$(分隔符不变，CHART_PAYLOAD_PATTERN仍能匹配)。
+相同的结果(不同会话里生成的同一张图)只存一份；文件一旦写入不再修改，先写临时文件再原子替换。
+
+引用在读取历史时才解析(ConversationMemory.get_messages)，解压后的内容缓存在LRU里。
+
+通过环境变量配置:
+- MEMORY_BLOB_ENABLED: 为0时不外置，消息原样保存，默认1(已外置的引用仍能解析)
+- MEMORY_BLOB_MIN_SIZE: 结果超过多少字节才外置，默认2048
+- MEMORY_BLOB_CACHE: 缓存的解压结果条数，默认256
+"""
+import hashlib
+import os
+import re
+import threading
+import zlib
+from typing import Optional
+
+from src.session_store import MEMORY_FSYNC, _fsync_dir, _fsync_path
+from utils import LRUCache, logger, metrics
+
+
+MEMORY_BLOB_ENABLED = os.environ.get('MEMORY_BLOB_ENABLED', '1') == '1'
+MEMORY_BLOB_MIN_SIZE = int(os.environ.get('MEMORY_BLOB_MIN_SIZE', '2048'))
+MEMORY_BLOB_CACHE = int(os.environ.get('MEMORY_BLOB_CACHE', '256'))
+
+# 助手消息里的图表结果($$$$...$$$$)和查询结果(&&&&...&&&&)
+CHART_PAYLOAD_PATTERN = re.compile(r'(\$\$\$\$|&&&&)(.*?)\1', re.S)
+
+BLOB_REF_PREFIX = "blob:"
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_blob_ref(payload: str) -> bool:
+    return payload.startswith(BLOB_REF_PREFIX) and bool(_DIGEST.match(payload[len(BLOB_REF_PREFIX):]))
+
+
+class BlobStore:
+    """按sha256去重的压缩文件存储"""
+
+    def __init__(self, blobs_dir: str):
+        self.blobs_dir = blobs_dir
+        os.makedirs(blobs_dir, exist_ok=True)
+        self._cache = LRUCache("memory_blobs", max_entries=MEMORY_BLOB_CACHE)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.blobs_dir, digest[:2], f"{digest}.z")
+
+    def put(self, payload: str) -> str:
+        """保存内容并返回sha256，已存在时不重复写入"""
+        data = payload.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            metrics.inc("memory_blob_dedup_total")
+        else:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # 临时文件名带进程和线程号，并发写入同一内容时互不影响，替换结果相同
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(data, 6))
+            # 引用它的会话落盘前结果必须已经持久化
+            if MEMORY_FSYNC:
+                _fsync_path(tmp_path)
+            os.replace(tmp_path, path)
+            if MEMORY_FSYNC:
+                _fsync_dir(directory)
+            metrics.inc("memory_blob_writes_total")
+            metrics.inc("memory_blob_bytes_total", len(data))
+        self._cache[digest] = payload
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """读取内容，文件不存在或损坏时返回None"""
+        payload = self._cache.get(digest)
+        if payload is not None:
+            return payload
+        try:
+            with open(self.path(digest), 'rb') as f:
+                payload = zlib.decompress(f.read()).decode('utf-8')
+        except (OSError, zlib.error, UnicodeDecodeError) as e:
+            logger.warning(f"读取图表结果失败 {digest}: {e}")
+            metrics.inc("memory_blob_missing_total")
+            return None
+        self._cache[digest] = payload
+        return payload
+
+    def externalize(self, content: str) -> str:
+        """把消息中超过阈值的图表/查询结果换成引用"""
+        if not MEMORY_BLOB_ENABLED or not content or len(content) < MEMORY_BLOB_MIN_SIZE:
+            return content
+
+        def _replace(match):
+            payload = match.group(2)
+            if is_blob_ref(payload) or len(payload.encode('utf-8')) < MEMORY_BLOB_MIN_SIZE:
+                return match.group(0)
+            try:
+                digest = self.put(payload)
+            except OSError as e:
+                # 写入失败时原样保存，不影响会话
+                logger.warning(f"保存图表结果失败: {e}")
+                return match.group(0)
+            return f"{match.group(1)}{BLOB_REF_PREFIX}{digest}{match.group(1)}"
+
+        return CHART_PAYLOAD_PATTERN.sub(_replace, content)
+
+    def resolve(self, content: str) -> str:
+        """把消息中的引用换回原始内容，找不到的结果换成说明文字"""
+        if not content or BLOB_REF_PREFIX not in content:
+            return content
+
+        def _replace(match):
+            payload = match.group(2)
+            if not is_blob_ref(payload):
+                return match.group(0)
+            resolved = self.get(payload[len(BLOB_REF_PREFIX):])
+            if resolved is None:
+                return "[图表结果已丢失]" if match.group(1) == '$$$$' else "[查询结果已丢失]"
+            return f"{match.group(1)}{resolved}{match.group(1)}"
+
+        return CHART_PAYLOAD_PATTERN.sub(_replace, content)
@@ -5,7 +5,8 @@ import pymongo
 import numpy as np
 from abc import ABC, abstractmethod
 from typing import Dict, List, Any, Union, Optional, Tuple
-from utils.data_helper import enrich_data_with_relations, group_and_aggregate, calculate_derived_metrics
+from src.progress import emit_progress
+from utils.data_helper import get_mongo_client, enrich_data_with_relations, group_and_aggregate, calculate_derived_metrics
 from utils.logger import logger
 
 
@@ -516,7 +517,7 @@ def connect_to_database(db_info: Dict[str, Any]) -> pymongo.MongoClient:
         connection_string += f"{username}:{password}@"
     connection_string += f"{host}:{port}/{database_name}"
 
-    client = pymongo.MongoClient(connection_string)
+    client = get_mongo_client(connection_string)
     return client[database_name]
 
 
@@ -761,6 +762,7 @@ def query_and_calculate(
 
         # 查询数据
         logger.info(f"查询集合 {x_table} 和 {y_table} 的数据...")
+        emit_progress("query_started", database="mongodb", tables=sorted({x_table, y_table}))
         data = query_data_from_collections(
             connection,
             x_table, y_table,
@@ -769,6 +771,7 @@ def query_and_calculate(
             y_index_field, y_start_index, y_end_index
         )
         logger.info(f"查询完成，获取到 {len(data)} 条记录")
+        emit_progress("rows_fetched", table=y_table, field=y_field, rows=len(data))
 
         # 根据图表类型执行计算
         logger.info(f"开始计算 {chart_type} 类型的图表数据...")
@@ -782,6 +785,7 @@ def query_and_calculate(
             )
         else:
             calculation_result = calculator.calculate(data, x_field, y_field, x_table, y_table)
+        emit_progress("calculation_done", chart_type=chart_type)
 
         # 构建结果
         result = {
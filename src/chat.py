@@ -3,22 +3,45 @@ import sys
 import os
 sys.path.append(os.path.dirname(__file__))
 
-from src.agent import init_agent, client
+from src.agent import get_agent, client, DEFAULT_MODEL
 from src.memory import ConversationMemory
-from utils import logger
+from src.summary_memory import SessionSummarizer, llm_summarize_fn
+from src.llm_stages import STAGES, get_stage_config
+from src.usage import QuotaExceededError, request_context, usage_tracker
+from src.circuit_breaker import CircuitOpenError
+from src.checkpoint import request_checkpoint
+from src.speculative_query import request_prefetches
+from src.llm_client import RETRYABLE_ERRORS
+from utils import LRUCache, logger
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import httpx
 import time
 import json
 
 # 创建全局会话记忆实例
-memory_manager = ConversationMemory(max_history=50)
+memory_manager = ConversationMemory(
+    max_history=50,
+    max_context_tokens=int(os.environ.get('MEMORY_CONTEXT_TOKENS', '6000')),
+)
+
+# 长会话的滚动摘要，在后台把较早的轮次折叠成摘要
+memory_manager.summarizer = SessionSummarizer(
+    memory_manager,
+    fold_threshold=int(os.environ.get('SUMMARY_FOLD_THRESHOLD', '20')),
+    keep_recent=int(os.environ.get('SUMMARY_KEEP_RECENT', '10')),
+    summarize_fn=llm_summarize_fn(client, os.environ.get('SUMMARY_MODEL', DEFAULT_MODEL)),
+)
+
+# 会话状态和用户模型配置的缓存上限和空闲淘汰时间(秒)，长期运行时内存不随访问过的会话数增长
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', '10000'))
+CHAT_CACHE_IDLE_TTL = float(os.environ.get('CHAT_CACHE_IDLE_TTL', '1800'))
 
-# 在全局变量部分
-user_agents = {}
+# 用户自定义的模型，只记录和默认模型不同的用户；agent本身从共享注册表获取
+# 空闲较久的用户会恢复为默认模型
+user_models = LRUCache("chat_user_models", max_entries=CHAT_CACHE_MAX_ENTRIES, ttl=CHAT_CACHE_IDLE_TTL * 48)
 
-# 创建一个字典用于存储会话状态
-sessions = {}
+# 会话状态，淘汰后下次请求重新创建(消息历史在memory_manager中，不受影响)
+sessions = LRUCache("chat_sessions", max_entries=CHAT_CACHE_MAX_ENTRIES, ttl=CHAT_CACHE_IDLE_TTL)
 
 
 def get_or_create_session(session_id, user_id):
@@ -26,28 +49,32 @@ def get_or_create_session(session_id, user_id):
     # 创建组合ID，确保不同用户的会话互不干扰
     combined_id = f"{user_id}:{session_id}"
 
-    # 为每个用户创建独立的agent实例
-    if user_id not in user_agents:
-        user_agents[user_id] = init_agent(model_name='deepseek-chat')
+    # 同一模型的用户共享同一个agent模板
+    agent = get_agent(user_models.get(user_id, DEFAULT_MODEL))
 
-    if combined_id not in sessions:
-        sessions[combined_id] = {
-            "agent": user_agents[user_id],  # 使用用户专属的agent
+    session = sessions.get(combined_id)
+    if session is None:
+        session = {
+            "agent": agent,
             "last_active": time.time(),
             "user_id": user_id
         }
+        sessions[combined_id] = session
 
-    return sessions[combined_id]
+    session["agent"] = agent
+    session["last_active"] = time.time()
+    return session
 
 
-# 添加重试装饰器，针对网络相关错误进行重试
+# 单次LLM请求的超时已经在 PooledSwarm 中按阶段重试，这里只兜底流式响应读到一半时的超时；
+# 重试时已完成的工具调用从请求检查点复用，不会重复执行内层智能体和数据库查询
 @retry(
-    stop=stop_after_attempt(3),  # 最多重试3次
+    stop=stop_after_attempt(2),
     wait=wait_exponential(multiplier=1, min=2, max=60),  # 指数退避重试等待
-    retry=retry_if_exception_type((httpx.TimeoutException, httpx.ConnectTimeout, httpx.ReadTimeout))  # 只对超时错误重试
+    retry=retry_if_exception_type(RETRYABLE_ERRORS)  # 只对超时、连接错误和5xx重试
 )
 def call_api_with_retry(client, agent, messages, stream):
-    """封装API调用的重试逻辑"""
+    """封装API调用的重试逻辑，需要在request_checkpoint()内调用"""
     return run_api_loop(
         openai_client=client,
         starting_agent=agent,
@@ -62,13 +89,25 @@ def process_message(session_id, user_message, stream=True, user_id="anonymous"):
     # 获取或创建会话，使用用户ID和会话ID组合
     combined_id = f"{user_id}:{session_id}"
 
+    # 当日用量超过配额时直接拒绝，不调用模型
+    try:
+        usage_tracker.check_quota(user_id)
+    except QuotaExceededError as e:
+        logger.warning(str(e))
+        return {
+            "response": memory_manager.get_messages(combined_id),
+            "session_id": session_id,
+            "error": str(e),
+            "quota_exceeded": True,
+        }
+
     session = get_or_create_session(session_id, user_id)
 
     # 添加用户消息到历史
     memory_manager.add_message(combined_id, "user", user_message)
 
-    # 获取当前会话的消息历史
-    messages = memory_manager.get_messages(combined_id)
+    # 获取当前会话的消息历史，按token预算截取，保证每次请求的提示长度有上限
+    messages = memory_manager.get_messages(combined_id, max_tokens=memory_manager.max_context_tokens)
 
     # # 打印会话历史长度用于调试
     # print(f"会话 {combined_id} 历史长度: {len(messages)}")
@@ -80,13 +119,14 @@ def process_message(session_id, user_message, stream=True, user_id="anonymous"):
 
 
     try:
-        # 使用重试机制调用API处理消息
-        response = call_api_with_retry(
-            client=client,
-            agent=session["agent"],
-            messages=messages,  # 使用完整历史
-            stream=stream,
-        )
+        # 使用重试机制调用API处理消息，本次请求内的所有LLM调用都记到该用户和会话名下
+        with request_context(user_id, session_id), request_checkpoint(), request_prefetches():
+            response = call_api_with_retry(
+                client=client,
+                agent=session["agent"],
+                messages=messages,
+                stream=stream,
+            )
 
         # 从响应中获取最新的助手消息
         if "messages" in response:
@@ -105,16 +145,24 @@ def process_message(session_id, user_message, stream=True, user_id="anonymous"):
 
         logger.info(f"{updated_messages}")
 
+        # 在后台刷新滚动摘要，不阻塞本次响应；生成摘要的用量记到该用户和会话名下
+        with request_context(user_id, session_id):
+            memory_manager.summarizer.schedule_refresh(combined_id, len(updated_messages))
+
         # 返回当前会话的完整消息历史
         return {
             "response": updated_messages,
             "session_id": session_id,
-            "stream_chunks": response.get("stream_chunks", []) if stream else []
+            "stream_chunks": response.get("stream_chunks", []) if stream else [],
+            "usage": usage_tracker.session_usage(user_id, session_id),
         }
     except Exception as e:
         # 捕获所有异常并返回友好错误消息
         print(f"API调用失败: {str(e)}")
         error_message = "抱歉，服务暂时响应超时，请稍后再试..."
+        if isinstance(e, CircuitOpenError):
+            # 熔断期间不等待超时，立即返回降级回复
+            error_message = "抱歉，模型服务暂时不可用，请稍后再试..."
 
         # 添加错误消息到会话历史
         memory_manager.add_message(combined_id, "assistant", error_message)
@@ -125,7 +173,8 @@ def process_message(session_id, user_message, stream=True, user_id="anonymous"):
         return {
             "response": updated_messages,
             "session_id": session_id,
-            "error": str(e)
+            "error": str(e),
+            "degraded": isinstance(e, CircuitOpenError),
         }
 
 
@@ -150,26 +199,22 @@ def get_session_messages(session_id, user_id="anonymous"):
     return memory_manager.get_messages(combined_id)
 
 
-# 修改为与默认agent一致
-current_agent_config = {
-    "model_name": "deepseek-chat",  # 与agent.py中的默认值保持一致
-}
-
-
-def get_current_agent_config():
+def get_current_agent_config(user_id=None):
     """获取当前智能体配置"""
-    # 确保配置反映实际的agent_main的模型
-    global current_agent_config, agent_main
-    current_agent_config["model_name"] = agent_main.model
-    return current_agent_config
+    return {
+        "model_name": user_models.get(user_id, DEFAULT_MODEL),
+        # 各阶段单独配置的模型/参数，未配置的阶段使用model_name
+        "stages": {stage: get_stage_config(stage) for stage in STAGES},
+    }
 
 
-def update_user_agent(user_id, model_name=None):
+def update_user_agent(user_id=None, model_name=None):
     """更新特定用户的智能体配置"""
-    global user_agents
-
     if model_name:
-        user_agents[user_id] = init_agent(model_name=model_name)
+        if model_name == DEFAULT_MODEL:
+            user_models.pop(user_id, None)
+        else:
+            user_models[user_id] = model_name
         print(f"用户 {user_id} 的智能体已更新: 模型={model_name}")
 
-    return user_agents[user_id]
\ No newline at end of file
+    return get_agent(user_models.get(user_id, DEFAULT_MODEL))
\ No newline at end of file
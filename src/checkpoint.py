@@ -0,0 +1,88 @@
+"""
+请求内的工具结果检查点
+
+一次请求里已经成功执行的工具调用结果按 (工具名, 规范化参数) 记录下来。
+请求因为超时等原因重试时，模型发出相同的工具调用会直接复用结果，
+不再重复执行内层智能体、数据库查询和计算。检查点只在单个请求内有效，请求结束即丢弃。
+"""
+import contextvars
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from utils import logger, metrics
+
+
+_current_checkpoint = contextvars.ContextVar("tool_checkpoint", default=None)
+
+# 以这些前缀开头的工具结果视为失败，不记录检查点
+_FAILED_PREFIXES = ('{"error"', "{'error'", "解析错误", "配置文件未找到", "Error:")
+
+
+def canonical_args(arguments: str) -> str:
+    """把工具参数JSON规范化(键排序)，参数相同但顺序不同的调用视为同一个调用"""
+    try:
+        return json.dumps(json.loads(arguments or "{}"), ensure_ascii=False, sort_keys=True)
+    except ValueError:
+        return arguments or ""
+
+
+def is_failed_result(content: Any) -> bool:
+    return not isinstance(content, str) or content.lstrip().startswith(_FAILED_PREFIXES)
+
+
+class ToolCheckpoint:
+    """单个请求内已完成的工具调用结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results: Dict[Tuple[str, str], str] = {}
+
+    def get(self, tool_name: str, arguments: str) -> Optional[str]:
+        with self._lock:
+            return self._results.get((tool_name, canonical_args(arguments)))
+
+    def put(self, tool_name: str, arguments: str, content: str) -> None:
+        if is_failed_result(content):
+            return
+        with self._lock:
+            self._results[(tool_name, canonical_args(arguments))] = content
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+
+@contextmanager
+def request_checkpoint():
+    """在with块内执行的工具调用共享同一个检查点，重试应放在with块之内"""
+    checkpoint = ToolCheckpoint()
+    token = _current_checkpoint.set(checkpoint)
+    try:
+        yield checkpoint
+    finally:
+        _current_checkpoint.reset(token)
+
+
+def current_checkpoint() -> Optional[ToolCheckpoint]:
+    return _current_checkpoint.get()
+
+
+def lookup(tool_name: str, arguments: str) -> Optional[str]:
+    """查找当前请求中相同工具调用的结果"""
+    checkpoint = _current_checkpoint.get()
+    if checkpoint is None:
+        return None
+    content = checkpoint.get(tool_name, arguments)
+    if content is not None:
+        metrics.inc("tool_checkpoint_hits_total", tool=tool_name)
+        logger.info(f"复用检查点中的工具结果: {tool_name}")
+    return content
+
+
+def record(tool_name: str, arguments: str, content: Any) -> None:
+    """记录成功的工具调用结果"""
+    checkpoint = _current_checkpoint.get()
+    if checkpoint is not None:
+        checkpoint.put(tool_name, arguments, content)
@@ -0,0 +1,182 @@
+"""
+LLM服务熔断器
+
+按端点统计最近一段时间内chat completion的失败率和慢调用率，超过阈值时熔断:
+只有超时、连接错误和5xx算作失败；4xx(参数错误、鉴权失败、限流等)说明服务本身正常，按成功记录。
+熔断期间的请求立即失败(CircuitOpenError)，由调用方返回降级回复，不再占用工作线程等待超时。
+熔断一段时间后进入半开状态，放行少量探测请求，探测成功则恢复，失败则继续熔断。
+
+通过环境变量配置:
+- LLM_BREAKER_ENABLED: 为0时关闭熔断，默认1
+- LLM_BREAKER_WINDOW: 统计窗口(秒)，默认60
+- LLM_BREAKER_MIN_CALLS: 窗口内至少多少次调用才判断是否熔断，默认10
+- LLM_BREAKER_ERROR_RATE: 失败率阈值，默认0.5
+- LLM_BREAKER_SLOW_CALL_SECONDS: 超过该耗时算慢调用，默认60
+- LLM_BREAKER_SLOW_RATE: 慢调用率阈值，默认0.8
+- LLM_BREAKER_OPEN_SECONDS: 熔断持续时间(秒)，默认30
+- LLM_BREAKER_HALF_OPEN_PROBES: 半开状态下放行的探测请求数，默认1
+"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict
+
+import httpx
+import openai
+
+from utils import logger, metrics
+
+
+BREAKER_ENABLED = os.environ.get('LLM_BREAKER_ENABLED', '1') == '1'
+BREAKER_WINDOW = float(os.environ.get('LLM_BREAKER_WINDOW', '60'))
+BREAKER_MIN_CALLS = int(os.environ.get('LLM_BREAKER_MIN_CALLS', '10'))
+BREAKER_ERROR_RATE = float(os.environ.get('LLM_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('LLM_BREAKER_SLOW_CALL_SECONDS', '60'))
+BREAKER_SLOW_RATE = float(os.environ.get('LLM_BREAKER_SLOW_RATE', '0.8'))
+BREAKER_OPEN_SECONDS = float(os.environ.get('LLM_BREAKER_OPEN_SECONDS', '30'))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('LLM_BREAKER_HALF_OPEN_PROBES', '1'))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """熔断期间拒绝的请求"""
+
+
+def is_service_failure(error: BaseException) -> bool:
+    """是否是服务不可用导致的失败(超时、连接错误、5xx)"""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """单个端点的熔断器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        # (结束时间, 是否失败, 是否慢调用)
+        self._calls = deque()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._update_state()
+            return self._state
+
+    def _update_state(self) -> None:
+        if self._state == OPEN and time.time() - self._opened_at >= BREAKER_OPEN_SECONDS:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            logger.info(f"LLM熔断器进入半开状态: {self.name}")
+
+    def _trim(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > BREAKER_WINDOW:
+            self._calls.popleft()
+
+    def _open(self, reason: str) -> None:
+        self._state = OPEN
+        self._opened_at = time.time()
+        self._calls.clear()
+        metrics.inc("llm_circuit_opened_total", endpoint=self.name)
+        logger.warning(f"LLM熔断器打开: {self.name}, 原因: {reason}, {BREAKER_OPEN_SECONDS:.0f}秒内的请求将直接降级")
+
+    def before_call(self) -> bool:
+        """请求前检查，熔断时抛出CircuitOpenError；返回本次请求是否为半开探测"""
+        with self._lock:
+            self._update_state()
+            if self._state == OPEN:
+                metrics.inc("llm_circuit_rejections_total", endpoint=self.name)
+                raise CircuitOpenError(f"LLM服务熔断中: {self.name}")
+            if self._state == HALF_OPEN:
+                if self._probes_in_flight >= BREAKER_HALF_OPEN_PROBES:
+                    metrics.inc("llm_circuit_rejections_total", endpoint=self.name)
+                    raise CircuitOpenError(f"LLM服务熔断探测中: {self.name}")
+                self._probes_in_flight += 1
+                return True
+            return False
+
+    def after_call(self, probe: bool, failed: bool, elapsed: float) -> None:
+        """请求结束后记录结果"""
+        slow = elapsed >= BREAKER_SLOW_CALL_SECONDS
+        with self._lock:
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self._state != HALF_OPEN:
+                    return
+                if failed or slow:
+                    self._open("半开探测失败" if failed else f"半开探测耗时 {elapsed:.1f}秒")
+                else:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    logger.info(f"LLM熔断器恢复: {self.name}")
+                return
+
+            now = time.time()
+            self._calls.append((now, failed, slow))
+            self._trim(now)
+            if self._state != CLOSED or len(self._calls) < BREAKER_MIN_CALLS:
+                return
+
+            total = len(self._calls)
+            error_rate = sum(1 for _, f, _ in self._calls if f) / total
+            slow_rate = sum(1 for _, _, s in self._calls if s) / total
+            if error_rate >= BREAKER_ERROR_RATE:
+                self._open(f"失败率 {error_rate:.0%}")
+            elif slow_rate >= BREAKER_SLOW_RATE:
+                self._open(f"慢调用率 {slow_rate:.0%}")
+
+    def call(self, func: Callable[[], Any]) -> Any:
+        """经过熔断器执行一次调用"""
+        if not BREAKER_ENABLED:
+            return func()
+
+        probe = self.before_call()
+        start_time = time.time()
+        try:
+            result = func()
+        except Exception as e:
+            self.after_call(probe, is_service_failure(e), time.time() - start_time)
+            raise
+        self.after_call(probe, False, time.time() - start_time)
+        return result
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """按端点获取共享熔断器"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name)
+                _breakers[name] = breaker
+    return breaker
+
+
+def breaker_snapshot() -> Dict[str, Any]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {
+        f'llm_circuit_state{{endpoint="{breaker.name}"}}': _STATE_VALUES[breaker.state]
+        for breaker in breakers
+    }
+
+
+metrics.register_collector(breaker_snapshot)
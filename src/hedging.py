@@ -0,0 +1,220 @@
+"""
+LLM请求对冲(hedged requests)
+
+主请求在延迟阈值内没有拿到首个token时，再发出一个备份请求(同一模型，或配置的备用模型/端点)，
+先返回首个token的一方胜出，另一方被取消。阈值取该模型最近首token延迟的p95。
+
+通过环境变量配置:
+- LLM_HEDGE_ENABLED: 为1时开启，默认关闭
+- LLM_HEDGE_PERCENTILE: 阈值取的分位数，默认95
+- LLM_HEDGE_WINDOW: 参与统计的最近样本数，默认200
+- LLM_HEDGE_MIN_SAMPLES: 样本数不足时使用默认阈值，默认20
+- LLM_HEDGE_DEFAULT_DELAY_MS / LLM_HEDGE_MIN_DELAY_MS / LLM_HEDGE_MAX_DELAY_MS: 默认阈值和阈值上下限
+- LLM_HEDGE_MODEL / LLM_HEDGE_BASE_URL / LLM_HEDGE_API_KEY: 备份请求使用的模型和端点，默认与主请求相同
+
+非流式请求在同步httpx上无法从其他线程中断，落败的一方会在后台完成后被丢弃，其用量仍按所用模型记入调用方的阶段，
+同时计入 llm_hedge_wasted_tokens_total；流式请求落败方的连接会立即关闭，拿不到用量，只计入 llm_hedge_wasted_requests_total。
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from utils import logger, metrics
+
+
+HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', '95'))
+HEDGE_WINDOW = int(os.environ.get('LLM_HEDGE_WINDOW', '200'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', '20'))
+HEDGE_DEFAULT_DELAY = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY_MS', '8000')) / 1000.0
+HEDGE_MIN_DELAY = float(os.environ.get('LLM_HEDGE_MIN_DELAY_MS', '500')) / 1000.0
+HEDGE_MAX_DELAY = float(os.environ.get('LLM_HEDGE_MAX_DELAY_MS', '30000')) / 1000.0
+HEDGE_MODEL = os.environ.get('LLM_HEDGE_MODEL') or None
+HEDGE_BASE_URL = os.environ.get('LLM_HEDGE_BASE_URL') or None
+HEDGE_API_KEY = os.environ.get('LLM_HEDGE_API_KEY') or None
+
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+class LatencyTracker:
+    """按模型记录最近的首token延迟，计算对冲阈值"""
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[model].append(seconds)
+
+    def percentile(self, model: str, percent: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(percent / 100.0 * len(samples))) - 1))
+        return samples[index]
+
+    def threshold(self, model: str) -> float:
+        """样本足够时取分位数，否则取默认阈值，结果限制在上下限之间"""
+        with self._lock:
+            count = len(self._samples.get(model, ()))
+        delay = self.percentile(model, HEDGE_PERCENTILE) if count >= HEDGE_MIN_SAMPLES else None
+        if delay is None:
+            delay = HEDGE_DEFAULT_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, delay))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            models = list(self._samples.keys())
+        result = {}
+        for model in models:
+            p95 = self.percentile(model, HEDGE_PERCENTILE)
+            if p95 is not None:
+                result[f'llm_first_token_p{int(HEDGE_PERCENTILE)}_seconds{{model="{model}"}}'] = round(p95, 3)
+                result[f'llm_hedge_threshold_seconds{{model="{model}"}}'] = round(self.threshold(model), 3)
+        return result
+
+
+latency_tracker = LatencyTracker()
+metrics.register_collector(latency_tracker.snapshot)
+
+# 每个模型的 [请求数, 对冲数]，用于导出对冲率
+_hedge_counts = defaultdict(lambda: [0, 0])
+_hedge_counts_lock = threading.Lock()
+
+
+def _count(model: str, fired: bool) -> None:
+    with _hedge_counts_lock:
+        counts = _hedge_counts[model]
+        counts[0] += 1
+        if fired:
+            counts[1] += 1
+
+
+def hedge_rate_snapshot() -> Dict[str, Any]:
+    with _hedge_counts_lock:
+        return {
+            f'llm_hedge_rate{{model="{model}"}}': round(fired / total, 4)
+            for model, (total, fired) in _hedge_counts.items() if total
+        }
+
+
+metrics.register_collector(hedge_rate_snapshot)
+
+
+def _first_chunk(stream) -> Tuple[Any, Any]:
+    """读取流式响应的首个chunk，流在首个chunk之前结束时返回None"""
+    iterator = iter(stream)
+    try:
+        return stream, next(iterator)
+    except StopIteration:
+        return stream, None
+
+
+def _close_stream(stream) -> None:
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def _chain(first, stream) -> Iterator[Any]:
+    if first is not None:
+        yield first
+    yield from stream
+
+
+def _discard_loser(future, stream: bool, model: str,
+                   record_usage: Optional[Callable[[str, Any], None]]) -> None:
+    """落败的请求完成后释放资源并记录其用量"""
+    # 回调在完成请求的工作线程中执行，需要在调用方的上下文中记录用量才能归属到对应用户
+    context = contextvars.copy_context()
+
+    def callback(done):
+        if done.cancelled() or done.exception() is not None:
+            return
+        metrics.inc("llm_hedge_wasted_requests_total", model=model)
+        if stream:
+            _close_stream(done.result()[0])
+            return
+        usage = getattr(done.result(), "usage", None)
+        if usage is None:
+            return
+        tokens = (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+        metrics.inc("llm_hedge_wasted_tokens_total", tokens, model=model)
+        if record_usage is not None:
+            try:
+                context.run(record_usage, model, usage)
+            except Exception as e:
+                logger.warning(f"记录对冲落败请求的用量失败: {e}")
+
+    future.add_done_callback(callback)
+
+
+def hedged_completion(
+        model: str,
+        stream: bool,
+        primary: Callable[[], Any],
+        backup: Callable[[], Any],
+        backup_model: Optional[str] = None,
+        record_usage: Optional[Callable[[str, Any], None]] = None,
+) -> Any:
+    """
+    执行带对冲的completion请求
+
+    primary/backup是发起请求的无参函数，返回completion(非流式)或Stream(流式)。
+    流式请求的胜负按首个chunk到达的时间判定，返回的迭代器会先产出该chunk。
+    record_usage(model, usage)用于记录落败一方的用量，胜出一方的用量由调用方自行记录。
+    """
+    def attempt(call, record_latency):
+        started = time.time()
+        result = call()
+        if stream:
+            result = _first_chunk(result)
+        if record_latency:
+            # 主请求落败时也记录其延迟，否则慢请求不会进入统计，阈值会偏低
+            latency_tracker.record(model, time.time() - started)
+        return result
+
+    metrics.inc("llm_hedge_requests_total", model=model)
+    delay = latency_tracker.threshold(model)
+
+    # 在工作线程中保留调用方的上下文变量
+    primary_future = _hedge_executor.submit(contextvars.copy_context().run, attempt, primary, True)
+    done, _ = wait([primary_future], timeout=delay)
+    _count(model, fired=not done)
+
+    if done:
+        winner, backup_future = primary_future, None
+    else:
+        metrics.inc("llm_hedge_fired_total", model=model)
+        logger.info(f"LLM请求超过对冲阈值 {delay:.2f}秒未返回首个token，发出备份请求: 模型={model}")
+        backup_future = _hedge_executor.submit(contextvars.copy_context().run, attempt, backup, False)
+        done, _ = wait([primary_future, backup_future], return_when=FIRST_COMPLETED)
+        # 一方失败时等待另一方
+        winner = next(iter(done))
+        if winner.exception() is not None:
+            other = backup_future if winner is primary_future else primary_future
+            if other.exception() is None:
+                winner = other
+
+    if backup_future is not None:
+        loser = backup_future if winner is primary_future else primary_future
+        loser_model = model if loser is primary_future else (backup_model or model)
+        _discard_loser(loser, stream, loser_model, record_usage)
+        won_by = "primary" if winner is primary_future else "backup"
+        metrics.inc("llm_hedge_wins_total", model=model, winner=won_by)
+        logger.info(f"LLM对冲请求完成: 模型={model}, 胜出={won_by}")
+
+    result = winner.result()
+    if stream:
+        stream_obj, first = result
+        return _chain(first, stream_obj)
+    return result
@@ -0,0 +1,324 @@
+"""
+LLM客户端池
+
+进程内共享的 httpx 连接池、OpenAI 客户端和 Swarm 客户端。
+所有请求复用同一批长连接(HTTP/2 keep-alive)，启动时预热，避免在请求路径上重复创建客户端和做TLS握手。
+"""
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import httpx
+import openai
+from dotenv import load_dotenv
+from openai import OpenAI
+from swarm import Swarm
+from swarm.types import Response
+from swarm.util import debug_print, function_to_json
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from src import checkpoint
+from src.circuit_breaker import get_breaker
+from src.progress import emit_progress
+from src.speculative_query import collect_stream, should_speculate
+from src.hedging import HEDGE_API_KEY, HEDGE_BASE_URL, HEDGE_ENABLED, HEDGE_MODEL, hedged_completion
+from src.llm_replay import replay_mode, wrap_transport
+from src.llm_stages import get_stage_config, resolve_stage
+from src.usage import STREAM_USAGE, track_stream, usage_tracker
+from src.prompt_compiler import report_prompt_cache
+from utils import logger, metrics
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+if getattr(sys, 'frozen', False):
+    base_dir = Path(sys.executable).parent
+else:
+    base_dir = Path(__file__).resolve().parent.parent
+
+env_path = base_dir / ".env"
+
+logger.info(f"加载环境变量文件: {env_path}")
+
+if env_path.exists():
+    load_dotenv(dotenv_path=env_path, override=True)
+
+# 检查加载结果
+api_key = os.environ.get('OPENAI_API_KEY')
+logger.info(f"加载后的API密钥: {api_key[:5]}..." if api_key and len(api_key) > 5 else "未找到API密钥")
+
+base_url = os.environ.get('OPENAI_BASE_URL')
+
+if not api_key and replay_mode() == "replay":
+    # 离线回放不需要真实密钥
+    api_key = "replay"
+
+if api_key:
+    os.environ['OPENAI_API'] = api_key
+if base_url:
+    os.environ['OPENAI_BASE_URL'] = base_url
+
+
+# 连接池配置
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', '50'))
+LLM_MAX_KEEPALIVE = int(os.environ.get('LLM_MAX_KEEPALIVE', '20'))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', '120'))
+LLM_WARMUP_TIMEOUT = float(os.environ.get('LLM_WARMUP_TIMEOUT', '10'))
+
+# 同一轮中多个工具调用的并发数
+TOOL_WORKERS = int(os.environ.get('TOOL_WORKERS', '8'))
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+# 标记当前线程是否是工具线程；工具内部再发起的对话(如transmit_refined_params_and_db_info)
+# 在本线程里顺序执行，不再向同一个线程池提交后阻塞等待，避免线程池被占满时互相等待
+_tool_thread = threading.local()
+
+# Swarm注入工具函数的上下文参数名
+CTX_VARS_NAME = "context_variables"
+
+# 单次completion请求的重试，只重试失败的这一步，不重跑整个对话循环；
+# 这是唯一的请求级重试(客户端的max_retries为0)，每次失败都经过熔断器计数。
+# 加上chat.call_api_with_retry的2次，一个阶段最多发出 2 * LLM_STAGE_RETRIES 次请求
+LLM_STAGE_RETRIES = int(os.environ.get('LLM_STAGE_RETRIES', '3'))
+# SDK的重试关闭后，5xx也在这里重试
+RETRYABLE_ERRORS = (httpx.TimeoutException, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def create_http_client() -> httpx.Client:
+    """创建带连接池和keep-alive的共享httpx客户端，开启录制/回放时包装传输层"""
+    transport = httpx.HTTPTransport(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return httpx.Client(
+        transport=wrap_transport(transport),
+        timeout=httpx.Timeout(connect=30.0, read=180.0, write=30.0, pool=30.0),
+    )
+
+
+http_client = create_http_client()
+
+
+def create_completion(openai_client: OpenAI, create_params: dict):
+    """经过端点熔断器发出chat completion请求，熔断时立即抛出CircuitOpenError"""
+    breaker = get_breaker(str(openai_client.base_url))
+    return breaker.call(lambda: openai_client.chat.completions.create(**create_params))
+
+
+class PooledSwarm(Swarm):
+    """共享客户端上的Swarm，所有chat completion调用都经过这里，统一做阶段路由、对冲和用量记录"""
+
+    def build_create_params(self, agent, history, context_variables, model, stream):
+        """和Swarm.get_chat_completion相同的请求参数，拆出来以便按阶段追加参数"""
+        context_variables = defaultdict(str, context_variables)
+        instructions = (
+            agent.instructions(context_variables)
+            if callable(agent.instructions)
+            else agent.instructions
+        )
+        messages = [{"role": "system", "content": instructions}] + history
+        tools = [function_to_json(f) for f in agent.functions]
+        # 不把context_variables暴露给模型
+        for tool in tools:
+            params = tool["function"]["parameters"]
+            params["properties"].pop(CTX_VARS_NAME, None)
+            if CTX_VARS_NAME in params["required"]:
+                params["required"].remove(CTX_VARS_NAME)
+
+        create_params = {
+            "model": model,
+            "messages": messages,
+            "tools": tools or None,
+            "tool_choice": agent.tool_choice,
+            "stream": stream,
+        }
+        if tools:
+            create_params["parallel_tool_calls"] = agent.parallel_tool_calls
+        return create_params
+
+    def get_chat_completion(self, agent, history, context_variables, model_override, stream, debug):
+        stage = resolve_stage(history)
+        stage_config = get_stage_config(stage)
+        model = stage_config.get("model") or model_override or agent.model
+
+        openai_client = self.client
+        if stage_config.get("base_url") or stage_config.get("api_key_env"):
+            endpoint_key = os.environ.get(stage_config["api_key_env"]) if stage_config.get("api_key_env") else None
+            openai_client = get_openai_client(stage_config.get("base_url"), endpoint_key)
+
+        # 内层智能体的参数解析和查询阶段在内部改用流式请求，边生成参数边开始数据库查询
+        speculate = not stream and stage in ("extract", "query") and should_speculate(agent)
+        request_stream = stream or speculate
+
+        create_params = self.build_create_params(agent, history, context_variables, model, request_stream)
+        if stage_config.get("max_tokens"):
+            create_params["max_tokens"] = stage_config["max_tokens"]
+        if stage_config.get("timeout"):
+            create_params["timeout"] = stage_config["timeout"]
+        if request_stream and STREAM_USAGE:
+            create_params["stream_options"] = {"include_usage": True}
+        debug_print(debug, f"Getting chat completion for stage {stage}, model {model}:", create_params["messages"])
+
+        def request():
+            if HEDGE_ENABLED:
+                backup_client = get_openai_client(HEDGE_BASE_URL, HEDGE_API_KEY)
+                backup_params = dict(create_params, model=HEDGE_MODEL or model)
+                return hedged_completion(
+                    model=model,
+                    stream=request_stream,
+                    primary=lambda: create_completion(openai_client, create_params),
+                    backup=lambda: create_completion(backup_client, backup_params),
+                    backup_model=backup_params["model"],
+                    record_usage=lambda used_model, usage: usage_tracker.record(used_model, stage, usage),
+                )
+            return create_completion(openai_client, create_params)
+
+        for attempt in Retrying(
+                stop=stop_after_attempt(LLM_STAGE_RETRIES),
+                wait=wait_exponential(multiplier=1, min=1, max=10),
+                retry=retry_if_exception_type(RETRYABLE_ERRORS),
+                reraise=True,
+        ):
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    metrics.inc("llm_stage_retries_total", stage=stage)
+                    logger.warning(f"LLM请求失败，重试阶段 {stage} 第 {attempt.retry_state.attempt_number} 次")
+                completion = request()
+
+        def report_usage(usage):
+            report_prompt_cache(model, usage)
+            usage_tracker.record(model, stage, usage)
+
+        if stream:
+            return track_stream(completion, report_usage)
+        if speculate:
+            return collect_stream(track_stream(completion, report_usage), model)
+        report_usage(getattr(completion, "usage", None))
+        return completion
+
+    def handle_tool_calls(self, tool_calls, functions, context_variables, debug):
+        """
+        同一轮返回的多个工具调用并发执行，结果按原调用顺序合并
+
+        本次请求中已经成功执行过的相同调用(工具名和参数相同)直接复用检查点中的结果。
+        """
+        if not tool_calls:
+            return super().handle_tool_calls(tool_calls, functions, context_variables, debug)
+
+        def run_one(tool_call):
+            name = tool_call.function.name
+            arguments = tool_call.function.arguments
+            cached = checkpoint.lookup(name, arguments)
+            if cached is not None:
+                emit_progress("tool_resumed", tool=name)
+                return Response(
+                    messages=[{"role": "tool", "tool_call_id": tool_call.id, "tool_name": name, "content": cached}],
+                    agent=None,
+                    context_variables={},
+                )
+
+            emit_progress("tool_started", tool=name, arguments=arguments)
+            partial = super(PooledSwarm, self).handle_tool_calls([tool_call], functions, context_variables, debug)
+            if partial.agent is None and partial.messages:
+                checkpoint.record(name, arguments, partial.messages[-1].get("content"))
+            return partial
+
+        def run_on_worker(tool_call):
+            _tool_thread.active = True
+            try:
+                return run_one(tool_call)
+            finally:
+                _tool_thread.active = False
+
+        if len(tool_calls) == 1:
+            return run_one(tool_calls[0])
+
+        start_time = time.time()
+        if getattr(_tool_thread, 'active', False):
+            # 嵌套的工具调用在当前工具线程里顺序执行
+            partials = [run_one(tool_call) for tool_call in tool_calls]
+        else:
+            futures = [
+                _tool_executor.submit(contextvars.copy_context().run, run_on_worker, tool_call)
+                for tool_call in tool_calls
+            ]
+            partials = [future.result() for future in futures]
+        logger.info(f"并发执行 {len(tool_calls)} 个工具调用，耗时 {time.time() - start_time:.2f}秒")
+
+        merged = Response(messages=[], agent=None, context_variables={})
+        for partial in partials:
+            merged.messages.extend(partial.messages)
+            merged.context_variables.update(partial.context_variables)
+            if partial.agent is not None:
+                merged.agent = partial.agent
+        return merged
+
+
+# 按 (base_url, api_key) 缓存的客户端，同一端点上的所有模型共用一个客户端
+_openai_clients: Dict[Tuple[Optional[str], Optional[str]], OpenAI] = {}
+_swarm_clients: Dict[int, Tuple[OpenAI, PooledSwarm]] = {}
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(endpoint_url: Optional[str] = None, endpoint_key: Optional[str] = None) -> OpenAI:
+    """获取指定端点的共享OpenAI客户端，默认使用.env里配置的端点"""
+    key = (endpoint_url or base_url, endpoint_key or api_key)
+    client = _openai_clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _openai_clients.get(key)
+            if client is None:
+                # 关闭SDK自带的重试(默认2次)，由阶段重试统一控制次数
+                client = OpenAI(api_key=key[1], base_url=key[0], http_client=http_client, max_retries=0)
+                _openai_clients[key] = client
+    return client
+
+
+def get_swarm_client(openai_client: Optional[OpenAI] = None) -> PooledSwarm:
+    """获取包装指定OpenAI客户端的共享Swarm实例"""
+    if openai_client is None:
+        openai_client = get_openai_client()
+    entry = _swarm_clients.get(id(openai_client))
+    if entry is None or entry[0] is not openai_client:
+        with _clients_lock:
+            entry = _swarm_clients.get(id(openai_client))
+            if entry is None or entry[0] is not openai_client:
+                entry = (openai_client, PooledSwarm(openai_client))
+                _swarm_clients[id(openai_client)] = entry
+    return entry[1]
+
+
+def warm_up_llm_clients() -> None:
+    """预热所有已创建的端点连接，让TLS握手和连接建立发生在启动阶段而不是第一个请求里"""
+    if replay_mode() == "replay":
+        return
+
+    if not _openai_clients:
+        get_openai_client()
+
+    for (endpoint_url, _), openai_client in list(_openai_clients.items()):
+        start_time = time.time()
+        try:
+            openai_client.with_options(timeout=LLM_WARMUP_TIMEOUT, max_retries=0).models.list()
+            logger.info(f"LLM连接预热完成: {endpoint_url} 耗时 {time.time() - start_time:.2f}秒")
+        except Exception as e:
+            # 预热失败不影响服务启动，第一个请求会重新建立连接
+            logger.warning(f"LLM连接预热失败 {endpoint_url}: {str(e)}")
+
+
+# 默认端点的客户端
+client = get_openai_client()
+swarm_client = get_swarm_client(client)
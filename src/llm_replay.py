@@ -0,0 +1,312 @@
+"""
+LLM请求录制/回放
+
+在httpx传输层录制chat completion的请求和响应(包括tool calls和流式SSE响应体)，
+之后可以在没有网络的环境中按录制内容回放，并注入可配置的延迟，用于确定性的端到端压测。
+
+通过环境变量启用(在导入 src.llm_client 之前设置):
+- LLM_REPLAY_MODE=record|replay
+- LLM_CASSETTE_PATH: 录制文件路径，默认 data/llm_cassette.jsonl
+- LLM_REPLAY_LATENCY: 回放延迟，"recorded"表示使用录制时的耗时，数字表示固定毫秒数，默认0
+- LLM_REPLAY_LATENCY_SCALE: 延迟缩放系数，默认1.0
+- LLM_REPLAY_STRICT: 为1(默认)时找不到匹配录制直接返回错误；为0时回放同一会话(第一条用户消息相同)
+  录制中的下一条，不同会话之间互不影响
+
+匹配键忽略按当天日期换算出的"时间范围"(见 utils.condense_msg)，录制不会因为日期变化而失效。
+
+压测: python -m src.llm_replay --cassette data/llm_cassette.jsonl --input questions.txt --concurrency 4
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils import logger
+
+
+def get_base_path():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+DEFAULT_CASSETTE_PATH = os.path.join(get_base_path(), 'data', 'llm_cassette.jsonl')
+
+# 录制时去掉的响应头，响应体保存的是解压后的内容
+_DROP_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+# condense_msg按date.today()换算的日期范围，由"索引信息"原文决定，不参与匹配
+_TIME_RANGE_PATTERN = re.compile(r"'时间范围': \{'开始': '[\d-]+', '结束': '[\d-]+'\}")
+
+
+def _request_body(content: bytes) -> Any:
+    try:
+        return json.loads(content or b'{}')
+    except ValueError:
+        return {"raw": content.decode('utf-8', errors='replace')}
+
+
+def conversation_key(body: Any) -> Optional[str]:
+    """请求所属会话的标识: 第一条用户消息的内容，非严格模式下按会话回放"""
+    if not isinstance(body, dict):
+        return None
+    for message in body.get("messages") or []:
+        if isinstance(message, dict) and message.get("role") == "user":
+            content = message.get("content")
+            return json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return None
+
+
+def request_key(request: httpx.Request) -> str:
+    """根据请求路径和请求体中影响结果的字段生成匹配键"""
+    return _key(request.method, request.url.path, request.content)
+
+
+def _key(method: str, path: str, content: bytes) -> str:
+    body = _request_body(content)
+    if isinstance(body, dict):
+        body = {k: body.get(k) for k in ("model", "messages", "tools", "tool_choice", "stream")}
+
+    canonical = json.dumps(
+        {"method": method, "path": path, "body": body},
+        ensure_ascii=False, sort_keys=True
+    )
+    canonical = _TIME_RANGE_PATTERN.sub("'时间范围': {}", canonical)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class RecordingTransport(httpx.BaseTransport):
+    """转发请求到真实传输层，并把请求和完整响应追加写入录制文件"""
+
+    def __init__(self, inner: httpx.BaseTransport, cassette_path: str = DEFAULT_CASSETTE_PATH):
+        self._inner = inner
+        self._cassette_path = cassette_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(cassette_path)), exist_ok=True)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        start_time = time.time()
+        response = self._inner.handle_request(request)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        latency = time.time() - start_time
+
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in _DROP_HEADERS}
+        record = {
+            "key": request_key(request),
+            "method": request.method,
+            "path": request.url.path,
+            "request": request.content.decode('utf-8', errors='replace'),
+            "status": response.status_code,
+            "headers": headers,
+            "body": body.decode('utf-8', errors='replace'),
+            "latency": latency,
+        }
+        with self._lock:
+            with open(self._cassette_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=headers,
+            content=body,
+            request=request,
+        )
+
+    def close(self) -> None:
+        self._inner.close()
+
+
+class ReplayTransport(httpx.BaseTransport):
+    """按录制文件回放响应，不访问网络"""
+
+    def __init__(self, cassette_path: str = DEFAULT_CASSETTE_PATH, latency: str = "0",
+                 latency_scale: float = 1.0, strict: bool = True):
+        self._lock = threading.Lock()
+        self._latency = latency
+        self._latency_scale = latency_scale
+        self._strict = strict
+        self._records: List[Dict[str, Any]] = []
+        self._by_key = defaultdict(list)
+        self._cursor_by_key = defaultdict(int)
+        # 会话 -> 该会话的录制，按录制顺序循环
+        self._by_conversation = defaultdict(deque)
+
+        with open(cassette_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                content = record.get("request", "").encode('utf-8')
+                if record.get("method") and record.get("path"):
+                    # 按当前的规则重新计算匹配键，旧录制(键里带有当天的时间范围)也能匹配
+                    record["key"] = _key(record["method"], record["path"], content)
+                self._records.append(record)
+                self._by_key[record["key"]].append(record)
+                conversation = conversation_key(_request_body(content))
+                if conversation is not None:
+                    self._by_conversation[conversation].append(record)
+        logger.info(f"已加载 {len(self._records)} 条LLM录制: {cassette_path}")
+
+    def _next_record(self, key: str, conversation: Optional[str]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            candidates = self._by_key.get(key)
+            if candidates:
+                # 相同请求多次出现时按录制顺序循环回放
+                index = self._cursor_by_key[key] % len(candidates)
+                self._cursor_by_key[key] += 1
+                return candidates[index]
+
+            sequence = self._by_conversation.get(conversation)
+            if self._strict or not sequence:
+                return None
+
+            # 非严格模式：请求内容有变化(如提示词调整)时按该会话的录制顺序回放，
+            # 并发的其他会话不会取走这个会话的响应
+            record = sequence.popleft()
+            sequence.append(record)
+            return record
+
+    def _delay(self, record: Dict[str, Any]) -> float:
+        if self._latency == "recorded":
+            delay = record.get("latency", 0.0)
+        else:
+            delay = float(self._latency or 0) / 1000.0
+        return max(0.0, delay * self._latency_scale)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = request_key(request)
+        record = self._next_record(key, None if self._strict else conversation_key(_request_body(request.content)))
+        if record is None:
+            logger.warning(f"LLM回放未找到匹配录制: {request.method} {request.url.path} key={key[:12]}")
+            return httpx.Response(
+                status_code=404,
+                json={"error": {"message": "no recorded response for this request", "type": "replay_miss"}},
+                request=request,
+            )
+
+        delay = self._delay(record)
+        if delay:
+            time.sleep(delay)
+
+        return httpx.Response(
+            status_code=record["status"],
+            headers=record.get("headers", {}),
+            content=record["body"].encode('utf-8'),
+            request=request,
+        )
+
+
+def replay_mode() -> str:
+    """当前的录制/回放模式: record、replay或空字符串"""
+    return os.environ.get('LLM_REPLAY_MODE', '').strip().lower()
+
+
+def wrap_transport(inner: httpx.BaseTransport) -> httpx.BaseTransport:
+    """根据环境变量为LLM客户端选择传输层"""
+    mode = replay_mode()
+    cassette_path = os.environ.get('LLM_CASSETTE_PATH', DEFAULT_CASSETTE_PATH)
+
+    if mode == "record":
+        logger.info(f"LLM请求录制已开启: {cassette_path}")
+        return RecordingTransport(inner, cassette_path)
+    if mode == "replay":
+        inner.close()
+        return ReplayTransport(
+            cassette_path,
+            latency=os.environ.get('LLM_REPLAY_LATENCY', '0'),
+            latency_scale=float(os.environ.get('LLM_REPLAY_LATENCY_SCALE', '1.0')),
+            strict=os.environ.get('LLM_REPLAY_STRICT', '1') == '1',
+        )
+    return inner
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(percent / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_benchmark(questions: List[str], concurrency: int = 1, iterations: int = 1) -> Dict[str, Any]:
+    """用process_message跑完整流水线，统计吞吐和延迟"""
+    from concurrent.futures import ThreadPoolExecutor
+    from src.chat import process_message
+
+    # 每次压测使用新会话，保证历史为空，请求内容和录制时一致
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    jobs = [(i, j, q) for i in range(iterations) for j, q in enumerate(questions)]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run_one(job):
+        nonlocal errors
+        iteration, index, question = job
+        start_time = time.time()
+        response = process_message(
+            session_id=f"bench-{run_id}-{iteration}-{index}",
+            user_message=question,
+            stream=False,
+            user_id="bench",
+        )
+        elapsed = time.time() - start_time
+        with lock:
+            latencies.append(elapsed)
+            if "error" in response:
+                errors += 1
+
+    bench_start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_one, jobs))
+    total_time = time.time() - bench_start
+
+    return {
+        "requests": len(jobs),
+        "errors": errors,
+        "concurrency": concurrency,
+        "total_seconds": round(total_time, 3),
+        "throughput_rps": round(len(jobs) / total_time, 3) if total_time else 0.0,
+        "p50_seconds": round(_percentile(latencies, 50), 3),
+        "p95_seconds": round(_percentile(latencies, 95), 3),
+        "max_seconds": round(max(latencies), 3) if latencies else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="基于LLM录制回放的端到端压测")
+    parser.add_argument("--cassette", default=DEFAULT_CASSETTE_PATH, help="录制文件路径")
+    parser.add_argument("--input", required=True, help="问题列表文件，每行一个问题")
+    parser.add_argument("--mode", default="replay", choices=["replay", "record"], help="replay离线压测，record在线录制")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--latency", default="0", help='"recorded"或固定毫秒数')
+    args = parser.parse_args()
+
+    # 必须在导入src.chat(进而导入src.llm_client)之前设置
+    os.environ['LLM_REPLAY_MODE'] = args.mode
+    os.environ['LLM_CASSETTE_PATH'] = args.cassette
+    os.environ['LLM_REPLAY_LATENCY'] = args.latency
+    if args.mode == "replay":
+        os.environ.setdefault('OPENAI_API_KEY', 'replay')
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    print(json.dumps(run_benchmark(questions, args.concurrency, args.iterations), ensure_ascii=False, indent=2))
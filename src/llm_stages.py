@@ -0,0 +1,91 @@
+"""
+按阶段选择模型
+
+一次对话会经过几个阶段，每个阶段可以在 data/llm_stages.json 中单独配置模型、端点、max_tokens和超时:
+- route: 主智能体判断意图并选择工具
+- extract: 内层智能体解析图表参数
+- query: 内层智能体编写SQL/MongoDB查询
+- commentary: 主智能体根据工具结果生成最终回复
+
+字段为null时使用默认值(用户选择的模型、.env里的端点)。api_key_env填环境变量名，密钥不写进配置文件。
+配置文件路径可通过 LLM_STAGES_PATH 覆盖。
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from utils import logger
+
+
+def get_base_path():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+STAGES = ("route", "extract", "query", "commentary")
+STAGES_PATH = os.environ.get('LLM_STAGES_PATH', os.path.join(get_base_path(), 'data', 'llm_stages.json'))
+
+_current_stage = contextvars.ContextVar("llm_stage", default=None)
+_stage_configs = None
+_stage_configs_lock = threading.Lock()
+
+
+def load_stage_configs() -> Dict[str, Dict[str, Any]]:
+    """读取阶段配置，文件不存在或格式错误时所有阶段使用默认值"""
+    global _stage_configs
+    if _stage_configs is not None:
+        return _stage_configs
+
+    with _stage_configs_lock:
+        if _stage_configs is None:
+            configs = {}
+            if os.path.exists(STAGES_PATH):
+                try:
+                    with open(STAGES_PATH, 'r', encoding='utf-8') as f:
+                        configs = json.load(f)
+                except Exception as e:
+                    logger.warning(f"读取阶段模型配置失败，使用默认配置: {str(e)}")
+            unknown = set(configs) - set(STAGES)
+            if unknown:
+                logger.warning(f"阶段模型配置中有未知阶段: {sorted(unknown)}")
+            _stage_configs = configs
+    return _stage_configs
+
+
+def get_stage_config(stage: Optional[str]) -> Dict[str, Any]:
+    """获取阶段配置，去掉值为null的字段"""
+    config = load_stage_configs().get(stage or "", {})
+    return {k: v for k, v in config.items() if v is not None and k != "description"}
+
+
+@contextmanager
+def llm_stage(stage: str):
+    """在with块内发出的LLM请求都归属指定阶段"""
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+def current_stage() -> Optional[str]:
+    return _current_stage.get()
+
+
+def resolve_stage(history: List[Dict[str, Any]]) -> str:
+    """
+    确定当前请求所属阶段
+
+    显式设置的阶段优先；否则是主智能体的请求，最后一条消息是工具结果时为commentary，其余为route。
+    """
+    stage = _current_stage.get()
+    if stage:
+        return stage
+    if history and history[-1].get("role") == "tool":
+        return "commentary"
+    return "route"
@@ -1,124 +1,400 @@
-from typing import List, Dict, Any, Optional
-import json
+from typing import List, Dict, Any, Optional, Tuple
+import hashlib
+import atexit
 import os
+import re
+import threading
 import time
 import sys
 
+from src.blob_store import CHART_PAYLOAD_PATTERN, BlobStore
+from src.session_archive import MEMORY_ARCHIVE_DAYS, MEMORY_ARCHIVE_INTERVAL, SessionArchive
+from src.session_search import (
+    MEMORY_SEARCH_ENABLED, SessionSearchIndex, backfill_search_index, search_index_path,
+)
+from src.session_store import JsonSessionStore, create_session_store, session_path
+from utils import LRUCache, count_tokens, logger, metrics
+
+
+# 脏会话的落盘间隔(秒)
+MEMORY_FLUSH_INTERVAL = float(os.environ.get('MEMORY_FLUSH_INTERVAL', '1.0'))
+
+# 为1时add_message等到本条消息所在的批次提交(fsync)后才返回；
+# 有写入在等待时落盘线程先等待MEMORY_GROUP_COMMIT_WINDOW秒，让并发请求的写入合并成一批
+MEMORY_SYNC_WRITES = os.environ.get('MEMORY_SYNC_WRITES', '0') == '1'
+MEMORY_GROUP_COMMIT_WINDOW = float(os.environ.get('MEMORY_GROUP_COMMIT_WINDOW', '0.005'))
+
+# 内存中最多缓存的会话数和空闲淘汰时间(秒)
+MEMORY_CACHE_MAX_SESSIONS = int(os.environ.get('MEMORY_CACHE_MAX_SESSIONS', '1000'))
+MEMORY_CACHE_IDLE_TTL = float(os.environ.get('MEMORY_CACHE_IDLE_TTL', '1800'))
+
+# 每条消息在请求中的固定开销(role、分隔符等)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def elide_chart_payload(content: str) -> str:
+    """把消息中的图表/查询结果替换成简短说明，只保留图表类型和标题"""
+
+    def _replace(match):
+        payload = match.group(2)
+        chart_type = re.search(r"['\"]chart_type['\"]\s*:\s*['\"]([^'\"]+)", payload)
+        title = re.search(r"['\"]title['\"]\s*:\s*['\"]([^'\"]+)", payload)
+        if match.group(1) == '&&&&':
+            return "[历史查询结果已省略]"
+        parts = [p.group(1) for p in (chart_type, title) if p]
+        return f"[历史图表结果已省略: {' '.join(parts)}]" if parts else "[历史图表结果已省略]"
+
+    return CHART_PAYLOAD_PATTERN.sub(_replace, content)
+
 
 class ConversationMemory:
-    def __init__(self, max_history=50):
-        # 会话消息记录 - 完整保存所有消息
-        self.sessions = {}
+    """
+    会话记忆
+
+    内存中的会话是权威数据，写入只标记为脏并由后台线程按 flush_interval 批量落盘，
+    同一会话在一个刷新周期内的多次写入只写一次文件；进程退出时(close/atexit)把剩余的脏会话写完。
+    每个批次由存储统一fsync后原子提交(组提交)，开启 MEMORY_SYNC_WRITES 时写入方等待所在批次提交。
+    文件只在会话第一次被访问时读取，因此同一份 data/memory 只能由一个进程写入。
+    文件格式由 src.session_store 决定，默认JSONL格式下新消息只追加到会话日志末尾。
+    助手消息里较大的图表/查询结果存到 src.blob_store，会话里只保留引用，get_messages 时再解析。
+    文件后端下闲置的会话由后台线程归档(src.session_archive)，访问时透明恢复。
+    新消息随落盘批量写入全文检索索引(src.session_search)，按max_history截断掉的消息随落盘从索引中删除。
+    """
+
+    def __init__(self, max_history=50, max_context_tokens=6000, keep_recent=4,
+                 flush_interval=None):
+        # 会话消息记录，只缓存最近活跃的会话；尚未落盘的会话不会被淘汰，淘汰的会话下次访问时从文件重新加载
+        self.sessions = LRUCache(
+            "memory_sessions",
+            max_entries=MEMORY_CACHE_MAX_SESSIONS,
+            ttl=MEMORY_CACHE_IDLE_TTL,
+            can_evict=lambda session_id, _: session_id not in self._dirty,
+            on_evict=lambda session_id, _: self._meta.pop(session_id, None),
+        )
         self.max_history = max_history
 
+        # 发送给模型的历史token预算，最近keep_recent条消息总是完整保留
+        self.max_context_tokens = max_context_tokens
+        self.keep_recent = keep_recent
+        self._token_cache = {}
+
+        # 可选的滚动摘要管理器(SessionSummarizer)，设置后按预算取历史时用摘要替换已折叠的旧消息
+        self.summarizer = None
+
         # 确保存储目录存在
         self.storage_dir = './data/memory'
         self.sessions_dir = os.path.join(self.storage_dir, 'sessions')
 
         os.makedirs(self.sessions_dir, exist_ok=True)
+        self.store = create_session_store(self.sessions_dir, max_history)
+        self.blobs = BlobStore(os.path.join(self.storage_dir, 'blobs'))
+        # 闲置会话的归档，只用于文件后端
+        self.archive = None
+        if isinstance(self.store, JsonSessionStore):
+            self.archive = SessionArchive(os.path.join(self.storage_dir, 'archive'))
+        # 全文检索索引，待索引的消息 (会话ID, 位置, role, 内容, 时间) 随落盘批量写入
+        self.search = None
+        self._search_pending = []
+        # 待从索引中删除的截断消息: 会话ID -> 截断后的message_offset
+        self._search_trims = {}
+        if MEMORY_SEARCH_ENABLED:
+            self.search = SessionSearchIndex(search_index_path(self.storage_dir))
+            if self.search.needs_rebuild:
+                # 第一次启用检索或索引格式升级时在后台为已有的会话建立索引
+                threading.Thread(target=backfill_search_index,
+                                 args=(self.search, self.store, self.archive, self.blobs, max_history),
+                                 name="memory-search-backfill", daemon=True).start()
+
+        # 会话元数据(title、last_updated)
+        self._meta = {}
+        # 待落盘的会话 -> 上次落盘后新增的消息，为None时需要整体重写(清空、设置title等)
+        self._dirty = {}
+        self._lock = threading.RLock()
+        # 落盘和删除文件互斥，避免刚删除的会话又被写回
+        self._flush_lock = threading.Lock()
+        # 组提交: 每次标记脏会话分配一个序号，批次提交后推进已提交序号并唤醒等待者
+        self._write_seq = 0
+        self._committed_seq = 0
+        self._committed = threading.Condition()
+        self.flush_interval = flush_interval if flush_interval is not None else MEMORY_FLUSH_INTERVAL
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="memory-flush", daemon=True)
+        self._flusher.start()
+        if self.archive is not None and MEMORY_ARCHIVE_DAYS > 0:
+            threading.Thread(target=self._archive_loop, name="memory-archive", daemon=True).start()
+        atexit.register(self.close)
 
 
     def _get_file_path(self, directory, session_id):
-        """获取文件路径，将会话ID转换为安全的文件名"""
-        safe_id = session_id.replace('/', '_').replace(':', '_')
-        return os.path.join(directory, f"{safe_id}.json")
+        """获取会话附属文件(如摘要)的路径，和会话文件一样按用户分片"""
+        return session_path(directory, session_id, ".json")
 
     def _load_session_data(self, session_id):
-        """从文件加载会话数据"""
-        # 加载会话消息
-        session_file = self._get_file_path(self.sessions_dir, session_id)
-        if os.path.exists(session_file):
+        """返回内存中的会话消息列表，不在内存中时从文件加载"""
+        with self._lock:
+            messages = self.sessions.get(session_id)
+            if messages is not None:
+                return messages
+
+        messages, meta = [], {}
+        restored = trimmed = False
+        try:
+            # 超出max_history的旧消息不会再用到，只读取最近的部分
+            loaded = self.store.load(session_id, limit=self.max_history)
+            if loaded is None and self.archive is not None and session_id in self.archive:
+                loaded = self.archive.load(session_id)
+                restored = loaded is not None
+            if loaded is not None:
+                messages, meta = loaded
+                if len(messages) > self.max_history:
+                    meta['message_offset'] = meta.get('message_offset', 0) + len(messages) - self.max_history
+                    messages = messages[-self.max_history:]
+                    trimmed = True
+        except Exception as e:
+            print(f"加载会话消息失败 {session_id}: {str(e)}")
+
+        with self._lock:
+            # 并发加载时以先放入内存的为准
+            if session_id not in self.sessions:
+                self._meta[session_id] = meta
+                self.sessions[session_id] = messages
+                if trimmed and self.search is not None:
+                    self._search_trims[session_id] = meta['message_offset']
+                if restored:
+                    # 归档的会话在下一次落盘时写回会话目录，写回后从归档中移除
+                    self._dirty.setdefault(session_id, None)
+                    metrics.inc("memory_restored_sessions_total")
+            return self.sessions.get(session_id, messages)
+
+    def _mark_dirty(self, session_id, message=None):
+        """标记会话待落盘，返回本次写入的序号；message为新增的消息，不提供时下次落盘整体重写"""
+        with self._lock:
+            self._write_seq += 1
+            self._meta.setdefault(session_id, {})['last_updated'] = time.time()
+            if message is None:
+                self._dirty[session_id] = None
+            elif session_id not in self._dirty:
+                self._dirty[session_id] = [message]
+            elif self._dirty[session_id] is not None:
+                self._dirty[session_id].append(message)
+            return self._write_seq
+
+    def wait_committed(self, seq, timeout=None):
+        """等待序号为seq的写入随所在批次提交，超时返回False"""
+        self._wakeup.set()
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_seq >= seq, timeout)
+
+    def flush(self):
+        """
+        把所有脏会话写入文件
+
+        写入失败时抛出异常: 这一批会话重新标记为待落盘(整体重写，部分写入过的会话不会重复追加)，
+        待索引的消息放回队列，提交序号不前进，等待提交的写入不会被误认为已持久化
+        """
+        with self._flush_lock:
+            with self._lock:
+                seq = self._write_seq
+                dirty, self._dirty = self._dirty, {}
+                pending, self._search_pending = self._search_pending, []
+                trims, self._search_trims = self._search_trims, {}
+                # 落盘不算访问，不刷新会话在缓存中的访问时间
+                batch = [
+                    (session_id, list(self.sessions.peek(session_id)), dict(self._meta.get(session_id, {})), appended)
+                    for session_id, appended in dirty.items() if session_id in self.sessions
+                ]
+            # 一个刷新周期的所有会话作为一批交给存储，统一fsync和提交
+            try:
+                self.store.save_many(batch)
+            except Exception:
+                with self._lock:
+                    for session_id, _, _, _ in batch:
+                        self._dirty[session_id] = None
+                    self._search_pending[:0] = pending
+                    for session_id, offset in trims.items():
+                        self._search_trims[session_id] = max(offset, self._search_trims.get(session_id, 0))
+                metrics.inc("memory_flush_failures_total")
+                raise
+            if self.archive is not None and len(self.archive):
+                # 已写回会话目录的归档会话
+                restored = [item[0] for item in batch if item[0] in self.archive]
+                if restored:
+                    self.archive.forget(restored)
+            if self.search is not None and (pending or trims):
+                try:
+                    self.search.index_many(pending)
+                    # 截断掉的消息已不在会话文件中，从索引中删除
+                    for session_id, offset in trims.items():
+                        self.search.trim_session(session_id, offset)
+                except Exception as e:
+                    logger.warning(f"更新会话检索索引失败: {e}")
+            with self._committed:
+                self._committed_seq = max(self._committed_seq, seq)
+                self._committed.notify_all()
+        if batch:
+            metrics.inc("memory_flushed_sessions_total", len(batch))
+
+    def _flush_loop(self):
+        while not self._closed:
+            if self._wakeup.wait(self.flush_interval) and not self._closed:
+                # 被等待提交的写入唤醒，稍等片刻合并同时到达的其他写入
+                time.sleep(MEMORY_GROUP_COMMIT_WINDOW)
+            self._wakeup.clear()
             try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.sessions[session_id] = data.get('messages', [])
+                self.flush()
+                # 淘汰空闲的会话，和写入在同一把锁下进行，避免淘汰刚被写入的会话
+                with self._lock:
+                    self.sessions.sweep()
             except Exception as e:
-                print(f"加载会话消息失败 {session_id}: {str(e)}")
-                if session_id not in self.sessions:
-                    self.sessions[session_id] = []
-        else:
-            # 如果文件不存在，创建空会话
-            self.sessions[session_id] = []
-
-    def _save_session_data(self, session_id):
-        """保存会话数据到文件"""
-        # 保存会话消息
-        if session_id in self.sessions:
-            session_file = self._get_file_path(self.sessions_dir, session_id)
-
-            # 判断文件是否已存在
-            file_exists = os.path.exists(session_file)
-
+                logger.warning(f"会话落盘失败: {e}")
+
+    def archive_idle_sessions(self, idle_days=None):
+        """把闲置超过idle_days天(默认MEMORY_ARCHIVE_DAYS)且不在内存中的会话移入归档，返回归档数量"""
+        if self.archive is None:
+            return 0
+        before = time.time() - (MEMORY_ARCHIVE_DAYS if idle_days is None else idle_days) * 86400
+        # 和落盘、删除互斥
+        with self._flush_lock:
+            candidates = self.store.idle_sessions(before)
+            with self._lock:
+                candidates = [s for s in candidates if s not in self.sessions and s not in self._dirty]
+            items = []
+            for session_id in candidates:
+                try:
+                    loaded = self.store.load(session_id)
+                except Exception as e:
+                    logger.warning(f"读取待归档会话失败 {session_id}: {e}")
+                    continue
+                if loaded is not None:
+                    items.append((session_id, loaded[0], loaded[1]))
+            archived = self.archive.archive(items)
+            for session_id in archived:
+                self.store.delete(session_id)
+        if archived:
+            logger.info(f"已归档 {len(archived)} 个闲置会话")
+        return len(archived)
+
+    def _archive_loop(self):
+        while not self._closed:
+            time.sleep(MEMORY_ARCHIVE_INTERVAL)
             try:
-                # 准备保存的数据
-                save_data = {
-                    'session_id': session_id,
-                    'messages': self.sessions[session_id],
-                    'last_updated': time.time()
-                }
-
-                # 如果文件不存在且消息列表不为空，添加title字段
-                if not file_exists and self.sessions[session_id]:
-                    # 获取用户的第一条消息
-                    for msg in self.sessions[session_id]:
-                        if msg.get('role') == 'user':
-                            # 取用户问题的前十个字符作为title
-                            title = msg.get('content', '')[:10]
-                            save_data['title'] = title
-                            break
-                # 如果文件已存在，读取原有的title保留
-                elif file_exists:
-                    try:
-                        with open(session_file, 'r', encoding='utf-8') as f:
-                            existing_data = json.load(f)
-                            if 'title' in existing_data:
-                                save_data['title'] = existing_data['title']
-                    except Exception as e:
-                        print(f"读取已有会话数据失败 {session_id}: {str(e)}")
-
-                # 保存数据到文件
-                with open(session_file, 'w', encoding='utf-8') as f:
-                    json.dump(save_data, f, ensure_ascii=False, indent=2)
-
+                self.archive_idle_sessions()
             except Exception as e:
-                print(f"保存会话消息失败 {session_id}: {str(e)}")
+                logger.warning(f"归档会话失败: {e}")
+
+    def _flush_before_read(self):
+        """读取文件前先落盘；失败时脏会话留给后台重试，读取照常进行"""
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"会话落盘失败: {e}")
 
+    def close(self):
+        """停止后台落盘并写完剩余的脏会话，可重复调用"""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
 
     def add_message(self, session_id: str, role: str, content: str) -> None:
         """添加消息到会话记忆"""
 
-        # 先加载最新会话数据
-        self._load_session_data(session_id)
-
-        if session_id not in self.sessions:
-            self.sessions[session_id] = []
-
-        # 添加消息到历史
-        self.sessions[session_id].append({
-            "role": role,
-            "content": content
-        })
-
-        # 保持历史长度在限制内
-        if len(self.sessions[session_id]) > self.max_history:
-            self.sessions[session_id] = self.sessions[session_id][-self.max_history:]
-
-        # 保存更新后的数据
-        self._save_session_data(session_id)
-
-    def get_messages(self, session_id: str) -> List[Dict[str, str]]:
-        """获取会话消息历史"""
-        # 先尝试从文件加载最新数据
-        self._load_session_data(session_id)
-
-        if session_id not in self.sessions:
-            return []
-
-        # 添加历史消息
-        messages = self.sessions[session_id].copy()
+        # 会话不在内存中时先从文件加载
+        messages = self._load_session_data(session_id)
+        indexed_content = content
+        if role == 'assistant':
+            # 大块结果先写入结果存储(不持有锁)，会话里只保存引用
+            content = self.blobs.externalize(content)
+
+        with self._lock:
+            if session_id not in self.sessions:
+                # 加载后到这里之间被淘汰(只可能是容量极小时)，放回缓存
+                self.sessions[session_id] = messages
+
+            # 添加消息到历史
+            message = {
+                "role": role,
+                "content": content
+            }
+            messages.append(message)
+
+            # 保持历史长度在限制内，message_offset记录截断掉的消息数
+            meta = self._meta.setdefault(session_id, {})
+            position = meta.get('message_offset', 0) + len(messages) - 1
+            if len(messages) > self.max_history:
+                meta['message_offset'] = meta.get('message_offset', 0) + len(messages) - self.max_history
+                del messages[:-self.max_history]
+                if self.search is not None:
+                    self._search_trims[session_id] = meta['message_offset']
+
+            # 取用户问题的前十个字符作为title，之后不再改变
+            if meta.get('title') is None and role == 'user':
+                meta['title'] = (content or '')[:10]
+                # title记录在文件头部，需要整体重写
+                seq = self._mark_dirty(session_id)
+            else:
+                seq = self._mark_dirty(session_id, message)
+            if self.search is not None and role in ('user', 'assistant'):
+                # 索引原始内容(外置前)，图表只索引类型和标题
+                self._search_pending.append((session_id, position, role, indexed_content, time.time()))
+
+        if MEMORY_SYNC_WRITES:
+            self.wait_committed(seq, timeout=max(self.flush_interval, 1.0) * 10)
+
+    def _message_tokens(self, message: Dict[str, str]) -> int:
+        """计算单条消息的token数，按内容哈希缓存"""
+        content = message.get("content") or ""
+        key = hashlib.md5(f"{message.get('role')}\x00{content}".encode('utf-8')).hexdigest()
+        tokens = self._token_cache.get(key)
+        if tokens is None:
+            if len(self._token_cache) > 20000:
+                self._token_cache.clear()
+            tokens = count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+            self._token_cache[key] = tokens
+        return tokens
+
+    def _apply_token_budget(self, messages: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+        """从最新消息向前选取，直到用完token预算；较早的助手图表结果只保留摘要"""
+        system_messages = [msg for msg in messages if msg["role"] == "system"]
+        history = [msg for msg in messages if msg["role"] != "system"]
+
+        budget = max_tokens - sum(self._message_tokens(msg) for msg in system_messages)
+
+        recent = history[-self.keep_recent:] if self.keep_recent else []
+        older = history[:len(history) - len(recent)]
+        budget -= sum(self._message_tokens(msg) for msg in recent)
+
+        selected = []
+        for msg in reversed(older):
+            if msg["role"] == "assistant" and msg.get("content") and CHART_PAYLOAD_PATTERN.search(msg["content"]):
+                msg = {**msg, "content": elide_chart_payload(msg["content"])}
+            tokens = self._message_tokens(msg)
+            if tokens > budget:
+                break
+            budget -= tokens
+            selected.append(msg)
+        selected.reverse()
+
+        window = selected + recent
+        # 窗口不以助手消息开头，避免模型看到没有提问的回答
+        while len(window) > len(recent) and window[0]["role"] != "user":
+            window.pop(0)
+
+        return system_messages + window
+
+    def get_messages(self, session_id: str, max_tokens: Optional[int] = None) -> List[Dict[str, str]]:
+        """获取会话消息历史
+
+        参数:
+        - session_id: 会话ID
+        - max_tokens: 可选的token预算，提供时按预算截取最近的历史(用于发送给模型)，不提供时返回完整历史
+        """
+        offset, messages = self.get_message_window(session_id)
 
         # 确保总消息数不超过最大历史限制
         if len(messages) > self.max_history:
+            # 重排后位置和message_offset对不上，不再折叠
+            offset = None
             # 保留系统消息和最近的消息
             system_messages = [msg for msg in messages if msg["role"] == "system"]
             recent_messages = messages[-self.max_history + len(system_messages):]
@@ -126,21 +402,46 @@ class ConversationMemory:
             # 重组消息，确保系统消息在前
             messages = system_messages + [msg for msg in recent_messages if msg["role"] != "system"]
 
+        messages = self._resolve_payloads(messages)
+
+        if max_tokens is not None:
+            if self.summarizer is not None:
+                messages = self.summarizer.fold(session_id, messages, offset)
+            messages = self._apply_token_budget(messages, max_tokens)
+
         return messages
 
+    def get_message_window(self, session_id: str) -> Tuple[int, List[Dict[str, str]]]:
+        """返回 (message_offset, 内存中消息的副本)，messages[i]是会话的第offset+i条消息(从0计)"""
+        # 会话不在内存中时从文件加载
+        messages = self._load_session_data(session_id)
+        with self._lock:
+            return self._meta.get(session_id, {}).get('message_offset', 0), list(messages)
+
+    def _resolve_payloads(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """把消息中的结果引用换回原始内容，返回副本，不修改内存中的会话"""
+        resolved = []
+        for msg in messages:
+            content = msg.get("content")
+            if content and msg["role"] == "assistant":
+                expanded = self.blobs.resolve(content)
+                if expanded != content:
+                    msg = {**msg, "content": expanded}
+            resolved.append(msg)
+        return resolved
+
     def clear_session(self, session_id: str) -> bool:
         """清除会话记忆"""
-        # 先加载最新会话数据，确保文件存在
         self._load_session_data(session_id)
 
-        # 清空内存中的数据
-        if session_id in self.sessions:
+        # 清空内存中的数据，空会话随下一次落盘写入文件
+        with self._lock:
             self.sessions[session_id] = []
-
-            # 保存空数据
-            self._save_session_data(session_id)
-            return True
-        return False
+            self._mark_dirty(session_id)
+        self._discard_search(session_id)
+        if self.summarizer is not None:
+            self.summarizer.discard(session_id)
+        return True
 
     def print_session_debug(self, session_id: str) -> None:
         """打印会话调试信息"""
@@ -152,45 +453,77 @@ class ConversationMemory:
 
     def delete_session(self, session_id: str) -> bool:
         """删除会话及其文件"""
-        # 删除文件
-        session_file = self._get_file_path(self.sessions_dir, session_id)
+        with self._flush_lock:
+            # 从内存中删除，尚未落盘的会话也算删除成功
+            with self._lock:
+                deleted = session_id in self._dirty and session_id in self.sessions
+                self.sessions.pop(session_id, None)
+                self._meta.pop(session_id, None)
+                self._dirty.pop(session_id, None)
 
-        deleted = False
-
-        if os.path.exists(session_file):
             try:
-                os.remove(session_file)
-                deleted = True
+                deleted = self.store.delete(session_id) or deleted
+                if self.archive is not None:
+                    deleted = bool(self.archive.forget([session_id])) or deleted
             except Exception as e:
-                print(f"删除文件失败 {session_file}: {str(e)}")
+                print(f"删除会话文件失败 {session_id}: {str(e)}")
+            self._discard_search(session_id)
 
-        # 从内存中删除
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        if self.summarizer is not None:
+            self.summarizer.discard(session_id)
 
         return deleted
 
-    def list_available_sessions(self) -> List[Dict[str, Any]]:
-        """列出所有可用的会话"""
-        sessions = []
+    def _discard_search(self, session_id):
+        """从检索索引中删除会话的消息，包括尚未写入索引的"""
+        if self.search is None:
+            return
+        with self._lock:
+            self._search_pending = [item for item in self._search_pending if item[0] != session_id]
+            self._search_trims.pop(session_id, None)
         try:
-            for file_name in os.listdir(self.sessions_dir):
-                if file_name.endswith('.json'):
-                    session_id = file_name[:-5].replace('_', ':')  # 还原会话ID
+            self.search.delete_session(session_id)
+        except Exception as e:
+            logger.warning(f"删除会话检索索引失败 {session_id}: {e}")
 
-                    # 获取最后修改时间
-                    file_path = os.path.join(self.sessions_dir, file_name)
-                    last_modified = os.path.getmtime(file_path)
+    def search_sessions(self, user_id: str, query: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """检索某个用户的会话消息，返回命中总数和当前页的结果(会话ID、片段、时间、相关度)"""
+        if self.search is None:
+            return {"total": 0, "results": []}
+        if self._search_pending:
+            # 刚发送的消息也能检索到
+            self._flush_before_read()
+        return self.search.search(user_id, query, page, page_size)
 
-                    # 添加到列表
-                    sessions.append({
-                        'session_id': session_id,
-                        'last_modified': last_modified
-                    })
+    def list_available_sessions(self) -> List[Dict[str, Any]]:
+        """列出所有可用的会话，每项包含session_id、title和last_modified，最新的在前"""
+        # 先把尚未落盘的会话写入文件
+        self._flush_before_read()
+        sessions = []
+        try:
+            sessions = self.store.list_sessions()
+            if self.archive is not None:
+                # 归档的会话只读内存中的索引；两边都有时以会话目录里的为准
+                hot = {info['session_id'] for info in sessions}
+                sessions.extend(info for info in self.archive.list_sessions() if info['session_id'] not in hot)
 
             # 按最后修改时间排序，最新的在前
             sessions.sort(key=lambda x: x['last_modified'], reverse=True)
         except Exception as e:
             print(f"列出会话失败: {str(e)}")
 
-        return sessions
\ No newline at end of file
+        return sessions
+
+    def list_user_sessions(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """列出某个用户的会话，最近更新的在前；只读取该用户的分片目录(或SQLite索引)和归档索引"""
+        self._flush_before_read()
+        sessions = self.store.list_user_sessions(user_id, limit)
+        if self.archive is not None:
+            prefix = f"{user_id}:"
+            hot = {info['session_id'] for info in sessions}
+            sessions.extend(
+                info for info in self.archive.list_sessions()
+                if info['session_id'].startswith(prefix) and info['session_id'] not in hot
+            )
+            sessions.sort(key=lambda x: x['last_modified'], reverse=True)
+        return sessions[:limit]
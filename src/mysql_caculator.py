@@ -8,6 +8,7 @@ from src.derived_variable_calculator import DerivedVariableCalculator  # 导入
 
 from utils import (
     connect_to_mysql,
+    get_mysql_pool,
     load_db_config,
     enrich_data_with_relations,
     group_and_aggregate,
@@ -17,6 +18,9 @@ from utils import (
 from utils import logger
 from src.chart_caculator import ChartCalculatorFactory
 from src.select_mysql import get_date_field, query_data_from_tables
+from src.progress import emit_progress
+from src.speculative_query import fetch_rows
+from src.arg_validator import ArgumentError, correct_mysql_arguments
 
 
 def mysql_caculator(
@@ -62,6 +66,22 @@ def mysql_caculator(
     - JSON格式的计算结果
     """
 
+    # 访问数据库前按表结构校验并纠正参数，无法纠正时直接返回错误
+    try:
+        corrected, _ = correct_mysql_arguments(dict(
+            x_field=x_field, y_field=y_field, x_table=x_table, y_table=y_table,
+            x_index_field=x_index_field, x_start_index=x_start_index, x_end_index=x_end_index,
+            y_index_field=y_index_field, y_start_index=y_start_index, y_end_index=y_end_index,
+            series_field=series_field,
+        ))
+    except ArgumentError as e:
+        logger.warning(f"参数校验失败: {e}")
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+    x_field, y_field, x_table, y_table = corrected["x_field"], corrected["y_field"], corrected["x_table"], corrected["y_table"]
+    x_index_field, x_start_index, x_end_index = corrected["x_index_field"], corrected["x_start_index"], corrected["x_end_index"]
+    y_index_field, y_start_index, y_end_index = corrected["y_index_field"], corrected["y_start_index"], corrected["y_end_index"]
+    series_field = corrected["series_field"]
+
     # 记录日志
     # 记录日志
     logger.info(
@@ -72,6 +92,8 @@ def mysql_caculator(
     if derived_expression:
         logger.info(f"使用衍生变量表达式: {derived_expression}")
 
+    pool = None
+    connection = None
     try:
         # 加载数据库配置
         db_info = load_db_config()
@@ -83,10 +105,10 @@ def mysql_caculator(
         else:
             mysql_info = db_info
 
-        # 连接到MySQL数据库
-        logger.info("尝试连接MySQL数据库...")
-        connection = connect_to_mysql(mysql_info)
-        logger.info(f"成功连接到MySQL数据库: {mysql_info.get('host')}:{mysql_info.get('port')}")
+        # 从连接池获取MySQL连接
+        pool = get_mysql_pool(mysql_info)
+        connection = pool.acquire()
+        logger.info(f"已获取MySQL连接: {mysql_info.get('host')}:{mysql_info.get('port')}")
 
         # 判断是否为需要多y系列的图表类型
         multi_series_chart_types = ["bar", "line", "scatter", "multi_series_bar", "multi_series_line"]
@@ -147,13 +169,14 @@ def mysql_caculator(
             all_data = []
             for i, y_field_item in enumerate(y_fields):
                 # 查询单个y系列的数据
-                series_data = query_data_from_tables(
+                series_data = fetch_rows(
                     connection,
                     x_table, y_tables[i],
                     x_field, y_field_item,
                     x_index_field, x_start_index, x_end_index,
                     y_index_fields[i], y_start_indices[i], y_end_indices[i]
                 )
+                emit_progress("rows_fetched", table=y_tables[i], field=y_field_item, rows=len(series_data))
 
                 # 为数据添加系列标识
                 for item in series_data:
@@ -334,13 +357,14 @@ def mysql_caculator(
             primary_y_end_index = y_end_index[0] if isinstance(y_end_index, list) and y_end_index else y_end_index
 
             # 查询数据
-            data = query_data_from_tables(
+            data = fetch_rows(
                 connection,
                 x_table, primary_y_table,
                 x_field, primary_y_field,
                 x_index_field, x_start_index, x_end_index,
                 primary_y_index_field, primary_y_start_index, primary_y_end_index
             )
+            emit_progress("rows_fetched", table=primary_y_table, field=primary_y_field, rows=len(data or []))
 
             derived_y_field = None
             if derived_expression and data:
@@ -381,9 +405,10 @@ def mysql_caculator(
                     data, x_field, primary_y_field, x_table, primary_y_table
                 )
 
-        # 关闭连接
-        connection.close()
-        logger.info("数据库连接已关闭")
+        # 归还连接
+        pool.release(connection)
+        connection = None
+        emit_progress("calculation_done", chart_type=chart_type)
 
         logger.info(f"查询结果: {calculation_result}")
 
@@ -432,6 +457,8 @@ def mysql_caculator(
 
         return f"[{chart_type}{json.dumps(result, ensure_ascii=False)}]"
     except Exception as e:
+        if connection is not None:
+            pool.release(connection)
         error_msg = f"查询计算出错: {str(e)}"
         logger.error(error_msg)
         import traceback
@@ -0,0 +1,73 @@
+"""
+分析过程的进度事件
+
+每个请求可以打开一个事件通道，工具层在关键步骤(参数解析完成、开始查询、取到N行数据、计算完成)发出结构化事件，
+流式接口把事件转发给客户端。没有打开通道时emit_progress什么也不做。
+
+通道通过contextvars传递，工具在并发线程中执行时由调用方复制上下文，事件仍然进入同一个通道。
+"""
+import contextvars
+import queue
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from utils import logger
+
+
+_current_channel = contextvars.ContextVar("progress_channel", default=None)
+
+
+class ProgressChannel:
+    """单个请求的事件队列"""
+
+    # 通道关闭时放入的结束标记
+    _CLOSED = object()
+
+    def __init__(self, maxsize: int = 1000):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.started_at = time.time()
+
+    def put(self, event: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # 客户端消费太慢时丢弃进度事件，不影响分析本身
+            logger.warning(f"进度事件队列已满，丢弃事件: {event.get('event')}")
+
+    def close(self) -> None:
+        self._queue.put(self._CLOSED)
+
+    def events(self, timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """依次取出事件直到通道关闭，timeout秒内没有事件时产出None(可用于发送心跳)"""
+        while True:
+            try:
+                event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if event is self._CLOSED:
+                return
+            yield event
+
+
+@contextmanager
+def progress_channel(channel: ProgressChannel):
+    """在with块内发出的进度事件都进入该通道"""
+    token = _current_channel.set(channel)
+    try:
+        yield channel
+    finally:
+        _current_channel.reset(token)
+
+
+def emit_progress(event: str, **data: Any) -> None:
+    """发出一个进度事件，当前请求没有打开通道时忽略"""
+    channel = _current_channel.get()
+    if channel is None:
+        return
+    channel.put({
+        "event": event,
+        "elapsed": round(time.time() - channel.started_at, 3),
+        **data,
+    })
@@ -0,0 +1,200 @@
+"""
+提示词与工具描述编译器
+
+从 data/prompts.json 的结构化源编译智能体提示词和工具描述:
+- 逐行去重(忽略空白差异)，反复强调的行只保留第一次出现
+- 段落按源文件顺序输出，编译结果逐字节稳定，便于服务端的前缀缓存命中
+- 按 budgets 里的token预算检查编译结果
+
+构建: python -m src.prompt_compiler
+会输出每个提示词的token报告，写入 data/prompts.compiled.json，超出预算时以非0状态退出。
+"""
+import functools
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils import logger, metrics, count_tokens
+
+
+def get_base_path():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+SOURCE_PATH = os.path.join(get_base_path(), 'data', 'prompts.json')
+COMPILED_PATH = os.path.join(get_base_path(), 'data', 'prompts.compiled.json')
+
+_compiled_cache = None
+_compiled_lock = threading.Lock()
+
+
+def load_prompt_source(path: Optional[str] = None) -> Dict[str, Any]:
+    """读取提示词结构化源文件"""
+    with open(path or SOURCE_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _source_hash(source: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(source, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compile_prompt(sections: List[Dict[str, Any]]) -> str:
+    """把段落列表编译成一段提示词，跨段落去除重复行"""
+    seen = set()
+    blocks = []
+    for section in sections:
+        lines = []
+        for line in section.get("lines", []):
+            key = " ".join(line.split())
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            lines.append(line.rstrip())
+        if lines:
+            blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def compile_all(source: Dict[str, Any]) -> Dict[str, Any]:
+    """编译所有智能体提示词和工具描述"""
+    return {
+        "source_hash": _source_hash(source),
+        "prompts": {
+            name: compile_prompt(agent.get("sections", []))
+            for name, agent in source.get("agents", {}).items()
+        },
+        "tools": {
+            name: " ".join(description.split())
+            for name, description in source.get("tools", {}).items()
+        },
+    }
+
+
+def build_report(source: Dict[str, Any], compiled: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """统计编译前后的token数并和预算比较"""
+    budgets = source.get("budgets", {})
+    report = []
+
+    for name, agent in source.get("agents", {}).items():
+        raw_text = "\n".join(line for section in agent.get("sections", []) for line in section.get("lines", []))
+        compiled_tokens = count_tokens(compiled["prompts"][name])
+        budget = budgets.get(name)
+        report.append({
+            "name": name,
+            "source_tokens": count_tokens(raw_text),
+            "compiled_tokens": compiled_tokens,
+            "budget": budget,
+            "ok": budget is None or compiled_tokens <= budget,
+        })
+
+    tool_tokens = sum(count_tokens(name) + count_tokens(desc) for name, desc in compiled["tools"].items())
+    budget = budgets.get("tools")
+    report.append({
+        "name": "tools",
+        "source_tokens": tool_tokens,
+        "compiled_tokens": tool_tokens,
+        "budget": budget,
+        "ok": budget is None or tool_tokens <= budget,
+    })
+    return report
+
+
+def get_compiled_prompts() -> Dict[str, Any]:
+    """获取编译结果：构建产物与源文件一致时直接使用，否则在内存中重新编译"""
+    global _compiled_cache
+    if _compiled_cache is not None:
+        return _compiled_cache
+
+    with _compiled_lock:
+        if _compiled_cache is not None:
+            return _compiled_cache
+
+        source = load_prompt_source()
+        compiled = None
+        if os.path.exists(COMPILED_PATH):
+            try:
+                with open(COMPILED_PATH, 'r', encoding='utf-8') as f:
+                    compiled = json.load(f)
+                if compiled.get("source_hash") != _source_hash(source):
+                    logger.info("提示词源文件已变更，重新编译")
+                    compiled = None
+            except Exception as e:
+                logger.warning(f"读取提示词编译结果失败: {str(e)}")
+                compiled = None
+
+        if compiled is None:
+            compiled = compile_all(source)
+
+        for row in build_report(source, compiled):
+            if not row["ok"]:
+                logger.warning(f"提示词 {row['name']} 超出token预算: {row['compiled_tokens']} > {row['budget']}")
+
+        _compiled_cache = compiled
+        return _compiled_cache
+
+
+def get_prompt(name: str) -> str:
+    """获取编译后的智能体提示词"""
+    return get_compiled_prompts()["prompts"][name]
+
+
+def compile_tool(func: Callable, name: Optional[str] = None) -> Callable:
+    """
+    用编译后的简短描述包装工具函数
+
+    Swarm根据函数名、docstring和签名生成function schema，每轮都会发送给模型。
+    包装后签名保持不变(inspect.signature会沿__wrapped__取到原函数)，docstring换成prompts.json里的短描述。
+    """
+    tool_name = name or func.__name__
+    description = get_compiled_prompts()["tools"].get(tool_name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    wrapper.__name__ = tool_name
+    if description is not None:
+        wrapper.__doc__ = description
+    return wrapper
+
+
+def report_prompt_cache(model: str, usage: Any) -> None:
+    """记录一次调用的提示缓存命中token数，兼容deepseek(prompt_cache_hit_tokens)和openai(prompt_tokens_details.cached_tokens)"""
+    if usage is None:
+        return
+
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit_tokens is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+    hit_tokens = hit_tokens or 0
+
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, model=model)
+    metrics.inc("llm_prompt_cache_hit_tokens_total", hit_tokens, model=model)
+    logger.info(f"提示缓存命中: 模型={model}, 命中 {hit_tokens}/{prompt_tokens} tokens")
+
+
+if __name__ == "__main__":
+    source = load_prompt_source()
+    compiled = compile_all(source)
+    report = build_report(source, compiled)
+
+    for row in report:
+        budget = row["budget"] if row["budget"] is not None else "-"
+        status = "OK" if row["ok"] else "OVER BUDGET"
+        print(f"{row['name']:<8} 源: {row['source_tokens']:>6} tokens  编译后: {row['compiled_tokens']:>6} tokens  预算: {budget:>6}  {status}")
+
+    with open(COMPILED_PATH, 'w', encoding='utf-8') as f:
+        json.dump(compiled, f, ensure_ascii=False, indent=2)
+    print(f"已写入 {COMPILED_PATH}")
+
+    if not all(row["ok"] for row in report):
+        sys.exit(1)
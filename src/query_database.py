@@ -6,7 +6,9 @@ import os
 import pymysql
 import re
 from typing import Dict, List, Any, Union, Optional
-from utils import logger, load_db_config
+from utils import logger, load_db_config, get_mysql_pool
+from src.progress import emit_progress
+from src.arg_validator import correct_sql
 
 
 class DatabaseExecutor:
@@ -50,27 +52,20 @@ class DatabaseExecutor:
 
     def connect(self) -> None:
         """
-        连接到MySQL数据库
+        从连接池获取MySQL连接
         """
-        key = "TokugawaMatsuri"
         try:
-            self.connection = pymysql.connect(
-                host=self.config.get('host', 'localhost'),
-                port=self.config.get('port', 3306),
-                user=self.config.get('username', 'root'),  # 使用username与配置文件保持一致
-                password = ''.join(chr(b ^ ord(key[i % len(key)])) for i, b in enumerate(bytes.fromhex(self.config.get('password', '')))),
-                database=self.config.get('database', ''),
-                charset=self.config.get('charset', 'utf8mb4')
-            )
+            self.connection = get_mysql_pool(self.config).acquire()
         except Exception as e:
             raise ConnectionError(f"连接数据库失败: {str(e)}")
 
     def close(self) -> None:
         """
-        关闭数据库连接
+        归还数据库连接
         """
-        if self.connection and self.connection.open:
-            self.connection.close()
+        if self.connection is not None:
+            get_mysql_pool(self.config).release(self.connection)
+            self.connection = None
 
     def _is_select_only(self, query: str) -> bool:
         """
@@ -164,11 +159,17 @@ def query_database(query: str, config_path: str = "config.json") -> str:
             "DROP", "TRUNCATE", "REPLACE", "MERGE", "EXEC", "EXECUTE"]):
         return {"error": "安全错误：查询包含禁止的操作,只允许SELECT查询"}
 
+    # 纠正表名，避免因为表名写错查询失败
+    query, _ = correct_sql(query)
+
     db = DatabaseExecutor()
 
-    logger.info(len(db.execute_query(query)))
     try:
-        results = f"{db.execute_query(query)}".replace('"', "").replace("'", "").replace("[","").replace("]","").replace("{","").replace("}","").replace(" ","")
+        emit_progress("query_started", database="mysql", query=query)
+        rows = db.execute_query(query)
+        emit_progress("rows_fetched", rows=len(rows))
+        logger.info(len(rows))
+        results = f"{rows}".replace('"', "").replace("'", "").replace("[","").replace("]","").replace("{","").replace("}","").replace(" ","")
         logger.info(f"查询结果: {results}")
         logger.info(f"查询结果长度: {len(results)}")
         if len(results) > 2000:
@@ -179,9 +180,7 @@ def query_database(query: str, config_path: str = "config.json") -> str:
 
         logger.info(f"查询结果: {results}")
 
-        re = f"{results}"
-
-        return db.execute_query(query)
+        return rows
     except ValueError as e:
         return {"error": str(e)}
     except Exception as e:
@@ -8,6 +8,12 @@ from typing import Dict, List, Any, Union, Optional
 from pymongo import MongoClient
 from bson import json_util, ObjectId
 from utils import logger, load_db_config
+from utils.data_helper import get_mongo_client
+from src.progress import emit_progress
+
+
+# 已经ping过的连接串
+_verified_uris = set()
 
 
 class MongoDBExecutor:
@@ -58,21 +64,22 @@ class MongoDBExecutor:
                 uri = f"mongodb://{username}:{password}@{host}:{port}/"
             else:
                 uri = f"mongodb://{host}:{port}/"
-            # 连接到MongoDB
-            self.client = MongoClient(uri)
+            # 复用共享的MongoClient，只在首次创建时测试连接
+            is_new = uri not in _verified_uris
+            self.client = get_mongo_client(uri)
             self.db = self.client[self.config.get('database', 'test')]
-            # 测试连接
-            self.client.admin.command('ping')
-            logger.info("MongoDB连接成功")
+            if is_new:
+                self.client.admin.command('ping')
+                _verified_uris.add(uri)
+                logger.info("MongoDB连接成功")
         except Exception as e:
             raise ConnectionError(f"连接数据库失败: {str(e)}")
     def close(self) -> None:
         """
-        关闭数据库连接
+        释放数据库连接，共享的MongoClient不关闭，连接留在其连接池中复用
         """
-        if self.client:
-            self.client.close()
-            logger.info("MongoDB连接已关闭")
+        self.client = None
+        self.db = None
     def _is_query_only(self, query_str: str) -> bool:
         """
         检查MongoDB查询字符串是否只包含查询操作,不包含增删改操作
@@ -437,7 +444,9 @@ def query_mongodb(query: str) -> List[Dict]:
     logger.info(f"接收到的查询: {query}")
     db = MongoDBExecutor()
     try:
+        emit_progress("query_started", database="mongodb", query=query)
         results = db.execute_query(query)
+        emit_progress("rows_fetched", rows=len(results))
         # 处理结果输出
         str_result = str(results)
         logger.info(f"查询结果长度: {len(str_result)}")
@@ -1,8 +1,59 @@
 import os
 import json
+import threading
+import time
 from datetime import datetime, date
 from typing import Dict, List, Any, Union, Optional, Tuple
 from utils import logger
+from src.progress import emit_progress
+
+
+# 表结构缓存，避免每次查询都执行DESCRIBE
+SCHEMA_CACHE_TTL = float(os.environ.get('SCHEMA_CACHE_TTL', '300'))
+_schema_cache: Dict[tuple, Tuple[float, list]] = {}
+_schema_lock = threading.Lock()
+
+
+def get_table_columns(connection, table_name):
+    """
+    获取表的字段信息(DESCRIBE的结果，每行为 (Field, Type, Null, Key, Default, Extra))，按连接的库缓存
+
+    参数:
+    - connection: 数据库连接
+    - table_name: 表名
+
+    返回:
+    - 字段信息列表
+    """
+    db = getattr(connection, 'db', None)
+    key = (getattr(connection, 'host', None), getattr(connection, 'port', None),
+           db.decode() if isinstance(db, bytes) else db, table_name)
+    now = time.time()
+    with _schema_lock:
+        cached = _schema_cache.get(key)
+        if cached and now - cached[0] < SCHEMA_CACHE_TTL:
+            return cached[1]
+
+    # 使用普通游标，DictCursor下DESCRIBE的行是字典，不能按下标取字段名
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"DESCRIBE `{table_name}`")
+        columns = [tuple(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+    with _schema_lock:
+        _schema_cache[key] = (now, columns)
+    return columns
+
+
+def warm_schema_cache(connection, table_names):
+    """预先加载表结构缓存"""
+    for table_name in table_names:
+        try:
+            get_table_columns(connection, table_name)
+        except Exception as e:
+            logger.warning(f"预加载表结构失败 {table_name}: {e}")
 
 
 def get_date_field(connection, table_name):
@@ -24,8 +75,7 @@ def get_date_field(connection, table_name):
         cursor = connection.cursor()
 
         # 1. 获取表字段信息
-        cursor.execute(f"DESCRIBE `{table_name}`")
-        columns = cursor.fetchall()
+        columns = get_table_columns(connection, table_name)
 
         # 存储候选字段and其优先级
         candidates = []
@@ -120,6 +170,7 @@ def query_data_from_tables(connection, x_table, y_table, x_field, y_field,
     返回:
     - 包含两个表中字段的数据列表
     """
+    emit_progress("query_started", database="mysql", tables=sorted({x_table, y_table}))
     cursor = None
     try:
         import pymysql
@@ -161,11 +212,8 @@ def query_data_from_tables(connection, x_table, y_table, x_field, y_field,
         else:
             # 如果在不同表,需要查找关联字段并执行联合查询
             # 首先检查两个表是否有共同的ID字段
-            cursor.execute(f"DESCRIBE `{x_table}`")
-            x_table_columns = [col[0] for col in cursor.fetchall()]
-
-            cursor.execute(f"DESCRIBE `{y_table}`")
-            y_table_columns = [col[0] for col in cursor.fetchall()]
+            x_table_columns = [col[0] for col in get_table_columns(connection, x_table)]
+            y_table_columns = [col[0] for col in get_table_columns(connection, y_table)]
 
             # 寻找可能的连接键
             common_columns = set(x_table_columns) & set(y_table_columns)
@@ -0,0 +1,148 @@
+"""
+闲置会话归档
+
+超过 MEMORY_ARCHIVE_DAYS 天没有更新的会话文件由后台线程移入 data/memory/archive 下的压缩段文件，
+会话目录只保留活跃的会话，列会话时不再需要逐个stat所有历史文件。
+- 段文件 segment-000001.gz 由多个gzip成员首尾相接组成(整个文件仍可以用zcat查看)，
+  每个成员是一个会话的完整JSON(session_id、title、last_updated、message_offset、messages)；段超过大小上限后新开一个段
+- index.json 记录 会话 -> (段、偏移、长度、title、last_updated)，启动时加载到内存，
+  读取归档会话只需要seek到偏移处解压一个成员
+
+写入顺序: 先追加并fsync段文件，再原子替换索引，最后删除会话目录里的文件；任何一步崩溃都不会丢失会话，
+最多留下段文件里无人引用的字节或两边各有一份(以会话目录里的为准)。
+访问归档的会话时透明恢复: 加载到内存并在下一次落盘时写回会话目录，写回后从索引中移除；
+一个段的会话全部移除后删除该段文件。只用于文件后端，SQLite后端不归档。
+
+通过环境变量配置:
+- MEMORY_ARCHIVE_DAYS: 会话闲置多少天后归档，为0时不归档(已归档的会话仍可访问)，默认30
+- MEMORY_ARCHIVE_INTERVAL: 检查闲置会话的间隔(秒)，默认3600
+- MEMORY_ARCHIVE_SEGMENT_MB: 单个段文件的大小上限(MB)，默认64
+"""
+import gzip
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.session_store import MEMORY_FSYNC, META_KEYS, WriteBatch, _fsync_path
+from utils import logger, metrics
+
+
+MEMORY_ARCHIVE_DAYS = float(os.environ.get('MEMORY_ARCHIVE_DAYS', '30'))
+MEMORY_ARCHIVE_INTERVAL = float(os.environ.get('MEMORY_ARCHIVE_INTERVAL', '3600'))
+MEMORY_ARCHIVE_SEGMENT_MB = float(os.environ.get('MEMORY_ARCHIVE_SEGMENT_MB', '64'))
+
+_SEGMENT_NAME = re.compile(r'^segment-(\d+)\.gz$')
+
+
+class SessionArchive:
+    """闲置会话的压缩段文件和索引"""
+
+    def __init__(self, archive_dir: str, segment_bytes: Optional[int] = None):
+        self.archive_dir = archive_dir
+        self.index_path = os.path.join(archive_dir, 'index.json')
+        self.segment_bytes = segment_bytes or int(MEMORY_ARCHIVE_SEGMENT_MB * 1024 * 1024)
+        os.makedirs(archive_dir, exist_ok=True)
+        # 段文件追加和索引重写互斥
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except Exception as e:
+                logger.warning(f"读取会话归档索引失败 {self.index_path}: {e}")
+        metrics.set_gauge("memory_archived_sessions", len(self._index))
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def list_sessions(self) -> List[Dict[str, Any]]:
+        """归档会话的session_id、title和最后修改时间，只读内存中的索引"""
+        return [
+            {'session_id': session_id, 'title': entry.get('title'), 'last_modified': entry.get('last_updated') or 0}
+            for session_id, entry in list(self._index.items())
+        ]
+
+    def load(self, session_id: str) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """读取归档的会话，返回 (消息, 元数据)，不在归档中时返回None"""
+        entry = self._index.get(session_id)
+        if entry is None:
+            return None
+        with open(os.path.join(self.archive_dir, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = json.loads(gzip.decompress(f.read(entry['length'])).decode('utf-8'))
+        meta = {key: data[key] for key in META_KEYS if data.get(key) is not None}
+        return data.get('messages', []), meta
+
+    def _current_segment(self) -> str:
+        numbers = [int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(self.archive_dir)) if match]
+        if numbers:
+            name = f"segment-{max(numbers):06d}.gz"
+            if os.path.getsize(os.path.join(self.archive_dir, name)) < self.segment_bytes:
+                return name
+        return f"segment-{max(numbers, default=0) + 1:06d}.gz"
+
+    def _write_index(self, index: Dict[str, Dict[str, Any]]) -> None:
+        writes = WriteBatch()
+        writes.replace(self.index_path, lambda f: json.dump(index, f, ensure_ascii=False))
+        writes.commit()
+        self._index = index
+        metrics.set_gauge("memory_archived_sessions", len(index))
+
+    def archive(self, items: List[Tuple[str, List[Dict[str, Any]], Dict[str, Any]]]) -> List[str]:
+        """把一批会话写入段文件和索引，返回已归档的会话ID；调用方在此之后再删除会话文件"""
+        if not items:
+            return []
+        with self._lock:
+            index = dict(self._index)
+            archived = []
+            segment = self._current_segment()
+            path = os.path.join(self.archive_dir, segment)
+            with open(path, 'ab') as f:
+                for session_id, messages, meta in items:
+                    if f.tell() >= self.segment_bytes:
+                        # 当前段写满，后面的会话留给下一轮归档写入新段
+                        break
+                    document = {
+                        'session_id': session_id,
+                        'title': meta.get('title'),
+                        'last_updated': meta.get('last_updated'),
+                        'message_offset': meta.get('message_offset', 0),
+                        'messages': messages,
+                    }
+                    data = gzip.compress(json.dumps(document, ensure_ascii=False).encode('utf-8'))
+                    offset = f.tell()
+                    f.write(data)
+                    index[session_id] = {
+                        'segment': segment, 'offset': offset, 'length': len(data),
+                        'title': meta.get('title'), 'last_updated': meta.get('last_updated'),
+                    }
+                    archived.append(session_id)
+            # 段文件持久化之后索引才引用它
+            if MEMORY_FSYNC:
+                _fsync_path(path)
+            self._write_index(index)
+        metrics.inc("memory_archived_sessions_total", len(archived))
+        return archived
+
+    def forget(self, session_ids: List[str]) -> List[str]:
+        """从索引中移除会话(已恢复到会话目录或被删除)，返回实际移除的会话ID；不再被引用的段文件一起删除"""
+        with self._lock:
+            removed = [session_id for session_id in session_ids if session_id in self._index]
+            if not removed:
+                return []
+            index = {key: entry for key, entry in self._index.items() if key not in removed}
+            segments = {self._index[session_id]['segment'] for session_id in removed}
+            self._write_index(index)
+            live = {entry['segment'] for entry in index.values()}
+            for segment in segments - live:
+                path = os.path.join(self.archive_dir, segment)
+                # 当前段可能还要继续追加，保留
+                if segment != self._current_segment() and os.path.exists(path):
+                    os.remove(path)
+        return removed
@@ -0,0 +1,398 @@
+"""
+会话历史全文检索
+
+所有会话消息的倒排索引放在一个SQLite FTS5库里(data/memory/search.db)，按用户隔离，按BM25排序分页返回。
+FTS5自带的unicode61分词把连续的汉字当成一个词，搜不到"电控组"里的"电控"，因此入库前先自行分词:
+- 连续的汉字切成重叠的二字组: "电控组成员" -> "电控 控组 组成 成员"，单独一个汉字保留单字
+- 字母数字按单词切分并转小写: "totaltime" -> "totaltime"
+查询用同样的方式分词，每个词组内的二字组按短语匹配，词组之间是AND；单个汉字的查询按前缀匹配。
+
+索引由 ConversationMemory.add_message 增量更新: 新消息先进入待索引队列，随每次落盘批量写入一个事务。
+图表/查询结果只索引图表类型和标题(如 "bar member.totaltime")，不索引数据本身。
+每条消息记录它在会话中的位置(从0计，同message_offset)，会话按max_history截断时，截断掉的消息随下一次落盘从索引中删除，
+检索不会返回已经打不开的消息。
+用户条件作为一个索引词(用户ID的哈希)写在owner列里，和关键词一起走倒排表，不需要扫描其他用户的消息。
+
+通过环境变量配置:
+- MEMORY_SEARCH_ENABLED: 为0时不建索引，默认1
+- MEMORY_SEARCH_PATH: 索引库的路径，默认 data/memory/search.db
+
+索引库第一次创建或格式版本升级时在后台用已有的会话建立索引，也可以手动重建:
+    python -m src.session_search --rebuild
+重建写入新表(messages_rebuild)，完成后在一个事务里替换旧表，期间检索和实时写入照常使用旧表；
+替换时把重建期间实时写入的消息并入新表，重建期间删除或截断的会话从新表中删除对应的消息。
+外置到结果存储的图表先解析成原始内容，和实时写入一样只索引图表类型和标题。
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.blob_store import CHART_PAYLOAD_PATTERN
+from src.session_store import MEMORY_FSYNC, session_user_id
+from utils import logger, metrics
+
+
+MEMORY_SEARCH_ENABLED = os.environ.get('MEMORY_SEARCH_ENABLED', '1') == '1'
+MEMORY_SEARCH_PATH = os.environ.get('MEMORY_SEARCH_PATH', '')
+
+# 汉字(含扩展A)、字母数字
+_TOKEN_PATTERN = re.compile(r'[㐀-䶿一-鿿]+|[A-Za-z0-9_]+')
+_CJK = re.compile(r'[㐀-䶿一-鿿]')
+_UNICODE_ESCAPE = re.compile(r'\\u([0-9a-fA-F]{4})')
+# 片段前后保留的字符数
+_SNIPPET_CONTEXT = 30
+
+# 索引格式版本(PRAGMA user_version)，低于此版本的索引在启动时后台重建
+# 1: 用户ID按会话ID的最后一个':'拆分(IPv6地址)
+# 2: 记录消息在会话中的位置，截断的消息从索引中删除
+SEARCH_INDEX_VERSION = 2
+
+_MESSAGES_TABLE = """CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    position INTEGER,
+    role TEXT,
+    text TEXT,
+    created_at REAL NOT NULL
+)"""
+_FTS_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(owner, tokens, tokenize='unicode61')"
+
+_SEARCH_SCHEMA = (
+    _MESSAGES_TABLE.format(table="messages"),
+    "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, position)",
+    _FTS_TABLE.format(table="messages_fts"),
+)
+
+_SQL_INSERT_MESSAGE = "INSERT INTO messages (session_id, position, role, text, created_at) VALUES (?, ?, ?, ?, ?)"
+_SQL_INSERT_TOKENS = "INSERT INTO messages_fts (rowid, owner, tokens) VALUES (?, ?, ?)"
+_SQL_INSERT_REBUILD_MESSAGE = (
+    "INSERT INTO messages_rebuild (session_id, position, role, text, created_at) VALUES (?, ?, ?, ?, ?)"
+)
+_SQL_INSERT_REBUILD_TOKENS = "INSERT INTO messages_fts_rebuild (rowid, owner, tokens) VALUES (?, ?, ?)"
+# 重建期间实时写入旧表、且新表里没有相同内容的消息
+_SQL_LIVE_SINCE = (
+    "SELECT m.session_id, m.position, m.role, m.text, m.created_at, f.owner, f.tokens"
+    " FROM messages m JOIN messages_fts f ON f.rowid = m.id WHERE m.id > ?"
+    " AND NOT EXISTS (SELECT 1 FROM messages_rebuild r"
+    " WHERE r.session_id = m.session_id AND r.role = m.role AND r.text = m.text)"
+)
+_SQL_DELETE_TOKENS = "DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE session_id = ?)"
+_SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE session_id = ?"
+_SQL_TRIM_TOKENS = "DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE session_id = ? AND position < ?)"
+_SQL_TRIM_MESSAGES = "DELETE FROM messages WHERE session_id = ? AND position < ?"
+_SQL_COUNT = "SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?"
+_SQL_SEARCH = (
+    "SELECT m.session_id, m.role, m.text, m.created_at, hits.score FROM ("
+    " SELECT rowid, bm25(messages_fts, 0.0, 1.0) AS score FROM messages_fts WHERE messages_fts MATCH ?"
+    " ORDER BY score LIMIT ? OFFSET ?"
+    ") AS hits JOIN messages m ON m.id = hits.rowid ORDER BY hits.score, m.created_at DESC"
+)
+
+
+def tokenize(text: str) -> List[List[str]]:
+    """分词，返回词组列表，每个词组是一段连续汉字的二字组或一个字母数字单词"""
+    groups = []
+    for run in _TOKEN_PATTERN.findall(text or ""):
+        if _CJK.match(run):
+            groups.append([run[i:i + 2] for i in range(len(run) - 1)] if len(run) > 1 else [run])
+        else:
+            groups.append([run.lower()])
+    return groups
+
+
+def searchable_text(content: str) -> str:
+    """消息中参与检索的文本，图表/查询结果只保留图表类型和标题"""
+
+    def _replace(match):
+        if match.group(1) == '&&&&':
+            return " "
+        payload = match.group(2)
+        chart_type = re.search(r"['\"]chart_type['\"]\s*:\s*['\"]([^'\"]+)", payload)
+        title = re.search(r"['\"]title['\"]\s*:\s*['\"]([^'\"]+)", payload)
+        text = " ".join(p.group(1) for p in (chart_type, title) if p)
+        # JSON格式的结果里汉字可能被转义成\uXXXX
+        return " " + _UNICODE_ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), text) + " "
+
+    return CHART_PAYLOAD_PATTERN.sub(_replace, content or "").strip()
+
+
+def owner_token(user_id: str) -> str:
+    """用户ID(可能是IP等含标点的字符串)换成单个索引词"""
+    return "u" + hashlib.md5(user_id.encode('utf-8')).hexdigest()[:16]
+
+
+def build_match(user_id: str, query: str) -> Optional[str]:
+    """构造FTS5的MATCH表达式，查询中没有可检索的词时返回None"""
+    terms = []
+    for group in tokenize(query):
+        if len(group) == 1 and len(group[0]) == 1 and _CJK.match(group[0]):
+            # 单个汉字匹配以它开头的二字组和单字
+            terms.append(f'"{group[0]}"*')
+        else:
+            terms.append('"' + " ".join(group) + '"')
+    if not terms:
+        return None
+    return f"owner:{owner_token(user_id)} AND tokens:({' AND '.join(terms)})"
+
+
+def make_snippet(text: str, query: str) -> str:
+    """截取原文中第一个命中的词附近的片段"""
+    lowered = text.lower()
+    positions = [lowered.find(word.lower()) for word in _TOKEN_PATTERN.findall(query)]
+    positions = [p for p in positions if p >= 0]
+    start = max(min(positions) - _SNIPPET_CONTEXT, 0) if positions else 0
+    end = start + _SNIPPET_CONTEXT * 3
+    return ("..." if start > 0 else "") + text[start:end] + ("..." if end < len(text) else "")
+
+
+class SessionSearchIndex:
+    """会话消息的全文索引，写入串行化，查询每个线程使用自己的连接"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # 正在重建时为重建期间删除的会话和截断到的位置，否则为None
+        self._rebuild_deleted = None
+        self._rebuild_trimmed = None
+        with self._write_lock:
+            connection = self._connection()
+            connection.execute(_SEARCH_SCHEMA[0])
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(messages)")}
+            if 'position' not in columns:
+                # 版本1的索引库没有位置，旧消息的位置为NULL，后台重建后补齐
+                connection.execute("ALTER TABLE messages ADD COLUMN position INTEGER")
+            for statement in _SEARCH_SCHEMA[1:]:
+                connection.execute(statement)
+            connection.commit()
+            self.needs_rebuild = connection.execute("PRAGMA user_version").fetchone()[0] < SEARCH_INDEX_VERSION
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, cached_statements=64)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # 索引可以从会话重建，不需要每次提交都fsync
+            connection.execute(f"PRAGMA synchronous={'NORMAL' if MEMORY_FSYNC else 'OFF'}")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _rows(items: Iterable[Tuple[str, int, str, str, float]]) -> List[Tuple[str, int, str, str, float, str, str]]:
+        """(会话ID, 位置, role, 内容, 时间) -> (会话ID, 位置, role, 检索文本, 时间, 用户索引词, 分词)，没有可检索词的跳过"""
+        rows = []
+        for session_id, position, role, content, created_at in items:
+            text = searchable_text(content)
+            tokens = " ".join(" ".join(group) for group in tokenize(text))
+            if tokens:
+                owner = owner_token(session_user_id(session_id))
+                rows.append((session_id, position, role, text, created_at, owner, tokens))
+        return rows
+
+    @staticmethod
+    def _insert(connection, rows, insert_message: str, insert_tokens: str) -> None:
+        for session_id, position, role, text, created_at, owner, tokens in rows:
+            row_id = connection.execute(insert_message, (session_id, position, role, text, created_at)).lastrowid
+            connection.execute(insert_tokens, (row_id, owner, tokens))
+
+    def index_many(self, items: List[Tuple[str, int, str, str, float]]) -> None:
+        """一个事务写入一批消息，每项为 (会话ID, 消息在会话中的位置, role, 内容, 时间)"""
+        rows = self._rows(items)
+        if not rows:
+            return
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                self._insert(connection, rows, _SQL_INSERT_MESSAGE, _SQL_INSERT_TOKENS)
+        metrics.inc("memory_search_indexed_total", len(rows))
+
+    def delete_session(self, session_id: str) -> None:
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.execute(_SQL_DELETE_TOKENS, (session_id,))
+                connection.execute(_SQL_DELETE_MESSAGES, (session_id,))
+            if self._rebuild_deleted is not None:
+                self._rebuild_deleted.add(session_id)
+
+    def trim_session(self, session_id: str, offset: int) -> None:
+        """删除会话中位置在offset之前(已被截断)的消息"""
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.execute(_SQL_TRIM_TOKENS, (session_id, offset))
+                connection.execute(_SQL_TRIM_MESSAGES, (session_id, offset))
+            if self._rebuild_trimmed is not None:
+                self._rebuild_trimmed[session_id] = max(offset, self._rebuild_trimmed.get(session_id, 0))
+
+    def search(self, user_id: str, query: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """
+        检索某个用户的会话消息，按相关度排序
+
+        返回 {"total": 命中总数, "results": [{session_id, role, snippet, created_at, score}]}，
+        session_id 不含用户前缀
+        """
+        started = time.time()
+        match = build_match(user_id, query)
+        if match is None:
+            return {"total": 0, "results": []}
+        page, page_size = max(int(page), 1), min(max(int(page_size), 1), 100)
+        connection = self._connection()
+        try:
+            total = connection.execute(_SQL_COUNT, (match,)).fetchone()[0]
+            rows = connection.execute(_SQL_SEARCH, (match, page_size, (page - 1) * page_size)).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"会话检索失败 {query!r}: {e}")
+            return {"total": 0, "results": []}
+        prefix = f"{user_id}:"
+        results = [
+            {
+                "session_id": session_id[len(prefix):] if session_id.startswith(prefix) else session_id,
+                "role": role,
+                "snippet": make_snippet(text, query),
+                "created_at": created_at,
+                # bm25越小越相关，取反后越大越相关
+                "score": round(-score, 4),
+            }
+            for session_id, role, text, created_at, score in rows
+        ]
+        metrics.inc("memory_search_queries_total")
+        metrics.inc("memory_search_seconds_total", time.time() - started)
+        return {"total": total, "results": results}
+
+    def rebuild(self, sessions: Iterable[List[Tuple[str, str, str, float]]]) -> int:
+        """
+        用sessions(每项是一个会话的消息，格式同index_many)在新表里重建索引，完成后替换旧表，返回写入的会话数
+
+        重建期间旧表照常检索和写入；替换时并入重建期间实时写入的消息，删除重建期间删除的会话和截断的消息
+        """
+        connection = self._connection()
+        with self._write_lock:
+            if self._rebuild_deleted is not None:
+                raise RuntimeError("检索索引正在重建")
+            self._rebuild_deleted = set()
+            self._rebuild_trimmed = {}
+            with connection:
+                connection.execute("DROP TABLE IF EXISTS messages_rebuild")
+                connection.execute("DROP TABLE IF EXISTS messages_fts_rebuild")
+                connection.execute(_MESSAGES_TABLE.format(table="messages_rebuild"))
+                connection.execute(_FTS_TABLE.format(table="messages_fts_rebuild"))
+            # 之后实时写入的消息在替换时并入新表
+            live_since = connection.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+        try:
+            count = 0
+            for items in sessions:
+                rows = self._rows(items)
+                # 新表只有重建线程写入，每个会话一个事务，不占用实时写入的锁
+                with connection:
+                    self._insert(connection, rows, _SQL_INSERT_REBUILD_MESSAGE, _SQL_INSERT_REBUILD_TOKENS)
+                count += 1
+
+            with self._write_lock:
+                live = connection.execute(_SQL_LIVE_SINCE, (live_since,)).fetchall()
+                deleted = self._rebuild_deleted
+                trimmed = self._rebuild_trimmed
+                with connection:
+                    # 替换旧表的几条DDL和合并在同一个事务里，检索不会看到缺表的中间状态
+                    connection.execute("BEGIN IMMEDIATE")
+                    self._insert(connection, [row for row in live if row[0] not in deleted],
+                                 _SQL_INSERT_REBUILD_MESSAGE, _SQL_INSERT_REBUILD_TOKENS)
+                    for session_id in deleted:
+                        connection.execute("DELETE FROM messages_fts_rebuild WHERE rowid IN"
+                                           " (SELECT id FROM messages_rebuild WHERE session_id = ?)", (session_id,))
+                        connection.execute("DELETE FROM messages_rebuild WHERE session_id = ?", (session_id,))
+                    for session_id, offset in trimmed.items():
+                        connection.execute("DELETE FROM messages_fts_rebuild WHERE rowid IN (SELECT id FROM"
+                                           " messages_rebuild WHERE session_id = ? AND position < ?)", (session_id, offset))
+                        connection.execute("DELETE FROM messages_rebuild WHERE session_id = ? AND position < ?",
+                                           (session_id, offset))
+                    connection.execute("DROP TABLE messages")
+                    connection.execute("DROP TABLE messages_fts")
+                    connection.execute("ALTER TABLE messages_rebuild RENAME TO messages")
+                    connection.execute("ALTER TABLE messages_fts_rebuild RENAME TO messages_fts")
+                    connection.execute(_SEARCH_SCHEMA[1])
+                    connection.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}")
+            self.needs_rebuild = False
+        finally:
+            with self._write_lock:
+                self._rebuild_deleted = None
+                self._rebuild_trimmed = None
+        return count
+
+
+def search_index_path(storage_dir: str) -> str:
+    return MEMORY_SEARCH_PATH or os.path.join(storage_dir, 'search.db')
+
+
+def backfill_search_index(index: SessionSearchIndex, store, archive=None, blobs=None,
+                          max_history: Optional[int] = None) -> int:
+    """
+    用已有的会话(含归档的会话)重建索引，blobs用于解析外置的图表结果，返回索引的会话数
+
+    max_history不为空时每个会话只索引最近max_history条，和加载到内存中的消息一致
+    """
+    sessions = store.list_sessions()
+    if archive is not None:
+        known = {info['session_id'] for info in sessions}
+        sessions.extend(info for info in archive.list_sessions() if info['session_id'] not in known)
+
+    def documents():
+        for info in sessions:
+            session_id = info['session_id']
+            try:
+                loaded = store.load(session_id)
+                if loaded is None and archive is not None:
+                    loaded = archive.load(session_id)
+            except Exception as e:
+                logger.warning(f"读取会话失败 {session_id}: {e}")
+                continue
+            if loaded is None:
+                continue
+            created_at = info.get('last_modified') or time.time()
+            messages, meta = loaded
+            offset = meta.get('message_offset', 0)
+            if max_history is not None and len(messages) > max_history:
+                offset += len(messages) - max_history
+                messages = messages[-max_history:]
+            items = []
+            for position, message in enumerate(messages, offset):
+                if message.get('role') not in ('user', 'assistant'):
+                    continue
+                content = message.get('content') or ''
+                if blobs is not None and message['role'] == 'assistant':
+                    content = blobs.resolve(content)
+                items.append((session_id, position, message['role'], content, created_at))
+            yield items
+
+    count = index.rebuild(documents())
+    logger.info(f"会话检索索引已重建: {count} 个会话")
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.blob_store import BlobStore
+    from src.session_archive import SessionArchive
+    from src.session_store import JsonSessionStore, create_session_store
+
+    parser = argparse.ArgumentParser(description="会话检索索引维护")
+    parser.add_argument("--rebuild", action="store_true", help="用已有的会话重建检索索引")
+    parser.add_argument("--storage-dir", default=os.path.join('.', 'data', 'memory'))
+    parser.add_argument("--max-history", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.rebuild:
+        store = create_session_store(os.path.join(args.storage_dir, 'sessions'), args.max_history)
+        archive = SessionArchive(os.path.join(args.storage_dir, 'archive')) if isinstance(store, JsonSessionStore) else None
+        blobs = BlobStore(os.path.join(args.storage_dir, 'blobs'))
+        count = backfill_search_index(SessionSearchIndex(search_index_path(args.storage_dir)), store, archive, blobs,
+                                      args.max_history)
+        print(f"已为 {count} 个会话建立检索索引")
+    else:
+        parser.print_help()
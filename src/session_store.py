@@ -0,0 +1,788 @@
+"""
+会话持久化格式
+
+ConversationMemory 只负责内存中的会话和落盘时机，文件读写交给这里的存储类:
+- JsonSessionStore: 每个会话一个JSON文件(旧格式)，每次保存都整体重写
+  文件按用户分片存放在 sessions/<md5(user_id)前两位>/<user_id>/ 下，按用户列会话只读该用户的目录；
+  分片之前放在 sessions/ 顶层的旧文件仍可读取，下次保存时移入分片目录
+- JsonlSessionStore: 每个会话一个追加写的JSONL日志，第一行是元数据(session_id、title等)，
+  之后每行一条消息；新消息只追加到文件末尾，读取时从文件尾部向前只读最近的N条。
+  每行带消息在会话中的序号seq(从1开始，和SQLite后端一致)，截断掉的消息数由读到的第一条的序号得出，不需要数行。
+  日志行数超过阈值时在后台落盘线程里压缩成最近的消息，先写临时文件再原子替换。
+- SqliteSessionStore: 所有会话存放在一个WAL模式的SQLite库里，按 (user_id, updated_at) 和
+  (session_id, seq) 建索引，按用户列会话、取最近N条消息都走索引；一次落盘的所有会话在一个事务里批量写入。
+
+文件后端按组提交: 一次落盘的所有会话先写入(整体重写的写到临时文件，JSONL追加写到日志末尾)，
+再统一fsync，最后原子替换并fsync一次目录，每个批次而不是每条消息承担一次fsync的开销。
+
+JSONL格式下仍能读取旧的JSON文件，会话第一次保存时转换成JSONL并删除旧文件。
+SQLite库第一次创建时自动导入已有的JSON/JSONL会话文件，也可以手动执行:
+    python -m src.session_store --migrate
+一次性把顶层的旧会话文件移动到分片目录(服务停止时执行):
+    python -m src.session_store --shard
+
+通过环境变量配置:
+- MEMORY_BACKEND: jsonl(默认)、json或sqlite，兼容旧的MEMORY_FORMAT
+- MEMORY_COMPACT_LINES: JSONL日志超过多少行时压缩，默认为max_history的2倍
+- MEMORY_SQLITE_PATH: SQLite库的路径，默认 data/memory/sessions.db
+- MEMORY_FSYNC: 为0时不fsync(只保证原子替换，掉电可能丢失最近一批写入)，默认1
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils import logger, metrics
+
+
+MEMORY_BACKEND = os.environ.get('MEMORY_BACKEND', os.environ.get('MEMORY_FORMAT', 'jsonl')).lower()
+MEMORY_COMPACT_LINES = int(os.environ.get('MEMORY_COMPACT_LINES', '0'))
+MEMORY_SQLITE_PATH = os.environ.get('MEMORY_SQLITE_PATH', '')
+MEMORY_FSYNC = os.environ.get('MEMORY_FSYNC', '1') == '1'
+
+# 从文件尾部向前读取的块大小
+_TAIL_BLOCK_SIZE = 8192
+
+
+def _fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(directory: str) -> None:
+    """fsync目录使重命名持久化，Windows不支持打开目录，跳过"""
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBatch:
+    """
+    一批文件写入，commit时统一fsync和原子替换
+
+    replace写到临时文件，commit时才替换目标文件，崩溃时目标文件要么是旧内容要么是新内容；
+    append直接追加，崩溃时最多在末尾留下写了一半的行(读取时跳过)；
+    追加前文件不以换行结尾时先补一个换行，新内容不会和写了一半的行拼在一起。
+    """
+
+    def __init__(self):
+        self._written: List[str] = []
+        self._renames: List[Tuple[str, str]] = []
+        self._after: List[Callable[[], None]] = []
+
+    def replace(self, path: str, write: Callable[[Any], None]) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            write(f)
+        self._written.append(tmp_path)
+        self._renames.append((tmp_path, path))
+
+    def append(self, path: str, text: str) -> None:
+        data = text.encode('utf-8')
+        with open(path, 'a+b') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+        self._written.append(path)
+
+    def after_commit(self, action: Callable[[], None]) -> None:
+        self._after.append(action)
+
+    def commit(self) -> None:
+        if MEMORY_FSYNC:
+            for path in dict.fromkeys(self._written):
+                _fsync_path(path)
+        for tmp_path, path in self._renames:
+            os.replace(tmp_path, path)
+        if MEMORY_FSYNC and self._renames:
+            for directory in {os.path.dirname(path) for _, path in self._renames}:
+                _fsync_dir(directory)
+        for action in self._after:
+            action()
+        if self._written:
+            metrics.inc("memory_group_commits_total")
+            metrics.inc("memory_group_commit_files_total", len(self._written))
+
+
+def read_tail_lines(path: str, max_lines: int) -> List[bytes]:
+    """从文件尾部向前读取最后max_lines行，不读取整个文件"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= max_lines:
+            size = min(_TAIL_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+    lines = data.split(b'\n')
+    if position > 0:
+        # 第一行可能只读到一半
+        lines = lines[1:]
+    return [line for line in lines if line.strip()][-max_lines:]
+
+
+# 会话文件里随消息保存的元数据
+META_KEYS = ('title', 'last_updated', 'message_offset')
+
+
+def _apply_limit(messages: List[Dict[str, Any]], meta: Dict[str, Any],
+                 limit: Optional[int]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """只保留最近limit条消息，被去掉的计入message_offset"""
+    if limit and len(messages) > limit:
+        meta['message_offset'] = meta.get('message_offset', 0) + len(messages) - limit
+        messages = messages[-limit:]
+    return messages, meta
+
+
+def _read_first_line(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.readline()
+
+
+def safe_session_name(session_id: str) -> str:
+    """将会话ID转换为安全的文件名(不含扩展名)"""
+    return session_id.replace('/', '_').replace(':', '_')
+
+
+def user_shard(user_id: str) -> str:
+    """用户所在的分片目录名，按用户ID的哈希分成256个"""
+    return hashlib.md5(user_id.encode('utf-8')).hexdigest()[:2]
+
+
+def user_dir(directory: str, user_id: str) -> str:
+    """某个用户的会话文件所在目录: <directory>/<分片>/<用户>"""
+    return os.path.join(directory, user_shard(user_id), safe_session_name(user_id))
+
+
+def session_path(directory: str, session_id: str, extension: str) -> str:
+    """
+    会话文件的路径，组合会话ID(user_id:session_id)按用户分片存放:
+        <directory>/<md5(user_id)前两位>/<user_id>/<session_id><extension>
+    用户ID可能含':'(IPv6地址)，按最后一个':'拆分，和session_user_id一致；没有用户部分的会话ID放在directory下
+    """
+    user_id, separator, name = session_id.rpartition(':')
+    if not separator:
+        return os.path.join(directory, safe_session_name(session_id) + extension)
+    return os.path.join(user_dir(directory, user_id), safe_session_name(name) + extension)
+
+
+def misplaced_session_path(directory: str, session_id: str, extension: str) -> Optional[str]:
+    """旧版本按第一个':'拆分用户ID时写入的路径(用户ID含':'时和session_path不同)，相同时返回None"""
+    user_id, _, name = session_id.partition(':')
+    if ':' not in name:
+        return None
+    return os.path.join(user_dir(directory, user_id), safe_session_name(name) + extension)
+
+
+def flat_session_path(directory: str, session_id: str, extension: str) -> str:
+    """分片之前的旧路径: <directory>/<user_id>_<session_id><extension>"""
+    return os.path.join(directory, safe_session_name(session_id) + extension)
+
+
+def _ensure_parent(path: str) -> None:
+    """创建文件所在的分片目录，新建的目录项随上级目录fsync"""
+    directory = os.path.dirname(path)
+    if os.path.isdir(directory):
+        return
+    os.makedirs(directory, exist_ok=True)
+    if MEMORY_FSYNC:
+        _fsync_dir(os.path.dirname(directory))
+        _fsync_dir(os.path.dirname(os.path.dirname(directory)))
+
+
+def _describe_file(path: str) -> Dict[str, Any]:
+    """读取会话文件的session_id和title；JSONL只读第一行的元数据"""
+    if path.endswith('.jsonl'):
+        header = _parse_line(_read_first_line(path))
+        if not header or header.get('type') != 'meta':
+            return {}
+        return {'session_id': header.get('session_id'), 'title': header.get('title')}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return {'session_id': data.get('session_id'), 'title': data.get('title')}
+
+
+def _is_session_file(name: str) -> bool:
+    return name.endswith(('.json', '.jsonl'))
+
+
+def _scan_files(directory: str):
+    if not os.path.isdir(directory):
+        return
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and _is_session_file(entry.name):
+                yield entry
+
+
+def iter_session_files(directory: str):
+    """遍历目录下所有会话文件(os.DirEntry)，包括分片目录里的和顶层尚未迁移的"""
+    yield from _scan_files(directory)
+    with os.scandir(directory) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as users:
+                for user in users:
+                    if user.is_dir():
+                        yield from _scan_files(user.path)
+
+
+class JsonSessionStore:
+    """每个会话一个JSON文件，保存时整体重写"""
+
+    extension = '.json'
+
+    def __init__(self, sessions_dir: str):
+        self.sessions_dir = sessions_dir
+        # 顶层是否还有分片之前的旧文件，没有时按用户列会话不需要扫描顶层
+        self._has_flat_files = any(True for _ in _scan_files(sessions_dir))
+
+    def path(self, session_id: str, extension: Optional[str] = None) -> str:
+        return session_path(self.sessions_dir, session_id, extension or self.extension)
+
+    def _read_paths(self, session_id: str) -> List[str]:
+        """读取时依次查找的路径，第一个是保存时写入的路径"""
+        paths = [self.path(session_id)]
+        misplaced = misplaced_session_path(self.sessions_dir, session_id, self.extension)
+        if misplaced is not None:
+            paths.append(misplaced)
+        if self._has_flat_files:
+            paths.append(flat_session_path(self.sessions_dir, session_id, self.extension))
+        return paths
+
+    def _existing_path(self, session_id: str) -> Optional[str]:
+        return next((path for path in self._read_paths(session_id) if os.path.exists(path)), None)
+
+    def _remove_stale(self, session_id: str, writes: "WriteBatch") -> None:
+        """新文件替换到位后再删除旧路径、旧格式的文件"""
+        for stale_path in self._read_paths(session_id)[1:]:
+            if os.path.exists(stale_path):
+                writes.after_commit(lambda path=stale_path: os.path.exists(path) and os.remove(path))
+
+    def _load_json(self, path: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        meta = {key: data[key] for key in META_KEYS if key in data}
+        return data.get('messages', []), meta
+
+    def load(self, session_id: str, limit: Optional[int] = None) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        返回 (消息, 元数据)，会话不存在时返回None；limit限制只返回最近的消息
+        元数据的message_offset是返回的第一条消息之前被截断的消息数(messages[i]是会话的第offset+i条)
+        """
+        path = self._existing_path(session_id)
+        if path is None:
+            return None
+        messages, meta = self._load_json(path)
+        return _apply_limit(messages, meta, limit)
+
+    def save(self, session_id: str, messages: List[Dict[str, Any]], meta: Dict[str, Any],
+             appended: Optional[List[Dict[str, Any]]] = None, writes: Optional[WriteBatch] = None) -> None:
+        """保存会话；appended是上次保存后新增的消息，为None时表示需要整体重写；writes为所属的写入批次"""
+        save_data = {
+            'session_id': session_id,
+            'messages': messages,
+            'last_updated': meta.get('last_updated'),
+            'message_offset': meta.get('message_offset', 0),
+        }
+        if meta.get('title') is not None:
+            save_data['title'] = meta['title']
+        own = writes is None
+        writes = writes or WriteBatch()
+        path = self.path(session_id)
+        _ensure_parent(path)
+        writes.replace(path, lambda f: json.dump(save_data, f, ensure_ascii=False))
+        self._remove_stale(session_id, writes)
+        if own:
+            writes.commit()
+
+    def save_many(self, batch: List[Tuple[str, List[Dict[str, Any]], Dict[str, Any], Optional[List[Dict[str, Any]]]]]) -> None:
+        """
+        保存一批会话，每项为 (会话ID, 消息, 元数据, 新增消息)，所有文件一起提交
+
+        有会话保存失败时其余会话照常提交，最后抛出第一个错误，由调用方重试
+        """
+        writes = WriteBatch()
+        errors = []
+        for session_id, messages, meta, appended in batch:
+            try:
+                self.save(session_id, messages, meta, appended, writes)
+            except Exception as e:
+                logger.warning(f"保存会话消息失败 {session_id}: {str(e)}")
+                errors.append(e)
+        try:
+            writes.commit()
+        except Exception as e:
+            logger.warning(f"提交会话写入失败({len(batch)}个会话): {str(e)}")
+            raise
+        if errors:
+            raise errors[0]
+
+    def delete(self, session_id: str) -> bool:
+        deleted = False
+        for path in self._read_paths(session_id):
+            if os.path.exists(path):
+                os.remove(path)
+                deleted = True
+        directory = os.path.dirname(self.path(session_id))
+        if deleted and directory != self.sessions_dir:
+            try:
+                # 用户的最后一个会话被删除(或归档)后删除空目录
+                os.rmdir(directory)
+            except OSError:
+                pass
+        return deleted
+
+    def _describe(self, entry) -> Optional[Dict[str, Any]]:
+        try:
+            info = _describe_file(entry.path)
+        except Exception as e:
+            logger.warning(f"读取会话文件失败 {entry.path}: {str(e)}")
+            return None
+        if not info.get('session_id'):
+            # 旧文件没有记录session_id时按文件名还原
+            info['session_id'] = os.path.splitext(entry.name)[0].replace('_', ':')
+        info['last_modified'] = entry.stat().st_mtime
+        return info
+
+    def list_sessions(self) -> List[Dict[str, Any]]:
+        """列出所有会话的session_id、title和最后修改时间"""
+        return [info for info in map(self._describe, iter_session_files(self.sessions_dir)) if info]
+
+    def list_user_sessions(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """某个用户的会话，最近更新的在前；只读取该用户的目录"""
+        entries = list(_scan_files(user_dir(self.sessions_dir, user_id)))
+        if self._has_flat_files:
+            flat_prefix = safe_session_name(user_id) + '_'
+            entries.extend(entry for entry in _scan_files(self.sessions_dir) if entry.name.startswith(flat_prefix))
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        prefix = f"{user_id}:"
+        sessions, seen = [], set()
+        for entry in entries:
+            info = self._describe(entry)
+            # 旧文件名前缀相同的可能是别的用户(用户ID本身含下划线)，以文件里记录的session_id为准
+            if not info or not info['session_id'].startswith(prefix) or info['session_id'] in seen:
+                continue
+            seen.add(info['session_id'])
+            sessions.append(info)
+            if len(sessions) >= limit:
+                break
+        return sessions
+
+    def idle_sessions(self, before: float) -> List[str]:
+        """最后修改时间早于before的会话ID"""
+        idle = []
+        for entry in iter_session_files(self.sessions_dir):
+            if entry.stat().st_mtime >= before:
+                continue
+            info = self._describe(entry)
+            if info:
+                idle.append(info['session_id'])
+        return idle
+
+
+class JsonlSessionStore(JsonSessionStore):
+    """每个会话一个追加写的JSONL日志"""
+
+    extension = '.jsonl'
+
+    def __init__(self, sessions_dir: str, compact_lines: int = 100):
+        super().__init__(sessions_dir)
+        self.compact_lines = compact_lines
+        # 会话 -> 日志当前的行数(含元数据行)，进程内第一次追加时统计
+        self._line_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _read_paths(self, session_id: str) -> List[str]:
+        # JSONL优先，其次是旧的JSON格式
+        paths = super()._read_paths(session_id) + [self.path(session_id, JsonSessionStore.extension)]
+        if self._has_flat_files:
+            paths.append(flat_session_path(self.sessions_dir, session_id, JsonSessionStore.extension))
+        return paths
+
+    def load(self, session_id: str, limit: Optional[int] = None) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        path = self._existing_path(session_id)
+        if path is None:
+            return None
+        if path.endswith(JsonSessionStore.extension):
+            messages, meta = self._load_json(path)
+            return _apply_limit(messages, meta, limit)
+
+        meta = {}
+        header = _parse_line(_read_first_line(path))
+        has_header = bool(header and header.get('type') == 'meta')
+        if has_header:
+            meta = {key: header[key] for key in META_KEYS if key in header}
+
+        if limit:
+            lines = read_tail_lines(path, limit + 1)
+        else:
+            with open(path, 'rb') as f:
+                lines = f.read().split(b'\n')
+        messages, first_seq = [], None
+        for line in lines:
+            record = _parse_line(line)
+            # 元数据行和崩溃时写了一半的行跳过
+            if record is None or record.get('type') == 'meta':
+                continue
+            messages.append(record)
+        if limit:
+            messages = messages[-limit:]
+        if messages:
+            first_seq = messages[0].get('seq')
+        # 序号只在文件里用于定位，返回的消息不带
+        messages = [{key: value for key, value in message.items() if key != 'seq'} for message in messages]
+        if first_seq is not None:
+            meta['message_offset'] = first_seq - 1
+        elif messages:
+            # 旧版本写入的行没有序号，数出文件里的消息数换算，下次重写后不再需要
+            with open(path, 'rb') as f:
+                total = sum(1 for line in f if line.strip()) - has_header
+            meta['message_offset'] = meta.get('message_offset', 0) + max(total - len(messages), 0)
+        meta['last_updated'] = os.path.getmtime(path)
+        return messages, meta
+
+    def _rewrite(self, session_id: str, messages: List[Dict[str, Any]], meta: Dict[str, Any], writes: WriteBatch) -> None:
+        header = {'type': 'meta', 'session_id': session_id, 'title': meta.get('title'),
+                  'last_updated': meta.get('last_updated'), 'message_offset': meta.get('message_offset', 0)}
+
+        def write(f):
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            f.write(_message_lines(messages, meta.get('message_offset', 0) + 1))
+
+        path = self.path(session_id)
+        _ensure_parent(path)
+        writes.replace(path, write)
+        with self._lock:
+            self._line_counts[session_id] = len(messages) + 1
+        self._remove_stale(session_id, writes)
+
+    def _line_count(self, session_id: str) -> int:
+        with self._lock:
+            count = self._line_counts.get(session_id)
+        if count is None:
+            with open(self.path(session_id), 'rb') as f:
+                count = sum(1 for _ in f)
+        return count
+
+    def save(self, session_id: str, messages: List[Dict[str, Any]], meta: Dict[str, Any],
+             appended: Optional[List[Dict[str, Any]]] = None, writes: Optional[WriteBatch] = None) -> None:
+        own = writes is None
+        writes = writes or WriteBatch()
+        path = self.path(session_id)
+        if appended is None or not os.path.exists(path):
+            # 新会话、旧路径或旧格式的会话整体写到分片目录
+            self._rewrite(session_id, messages, meta, writes)
+        elif appended:
+            count = self._line_count(session_id) + len(appended)
+            if count > self.compact_lines:
+                # 日志太长时压缩成内存中的最近消息(已按max_history截断)
+                self._rewrite(session_id, messages, meta, writes)
+                metrics.inc("memory_compactions_total")
+            else:
+                # 新增的消息在messages末尾(可能已被截断掉一部分)，最后一条的序号是offset+len(messages)
+                last_seq = meta.get('message_offset', 0) + len(messages)
+                writes.append(path, _message_lines(appended, last_seq - len(appended) + 1))
+                with self._lock:
+                    self._line_counts[session_id] = count
+        if own:
+            writes.commit()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            self._line_counts.pop(session_id, None)
+        return super().delete(session_id)
+
+
+def _message_lines(messages: List[Dict[str, Any]], first_seq: int) -> str:
+    """JSONL的消息行，每行带消息在会话中的序号"""
+    return ''.join(
+        json.dumps({**message, 'seq': seq}, ensure_ascii=False) + '\n'
+        for seq, message in enumerate(messages, first_seq)
+    )
+
+
+def _parse_line(line: bytes) -> Optional[Dict[str, Any]]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+_SQLITE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        title TEXT,
+        updated_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_user_updated ON sessions (user_id, updated_at)",
+)
+
+# 语句保持不变，由sqlite3的语句缓存复用编译结果
+_SQL_LAST_MESSAGES = (
+    "SELECT seq, role, content FROM ("
+    " SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?"
+    ") ORDER BY seq"
+)
+_SQL_ALL_MESSAGES = "SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq"
+_SQL_SESSION = "SELECT title, updated_at FROM sessions WHERE session_id = ?"
+_SQL_MAX_SEQ = "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?"
+_SQL_UPSERT_SESSION = (
+    "INSERT INTO sessions (session_id, user_id, title, updated_at) VALUES (?, ?, ?, ?)"
+    " ON CONFLICT(session_id) DO UPDATE SET user_id = excluded.user_id, title = excluded.title,"
+    " updated_at = excluded.updated_at"
+)
+_SQL_INSERT_MESSAGE = "INSERT INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)"
+_SQL_TRIM_MESSAGES = "DELETE FROM messages WHERE session_id = ? AND seq <= ?"
+_SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE session_id = ?"
+_SQL_DELETE_SESSION = "DELETE FROM sessions WHERE session_id = ?"
+_SQL_LIST_SESSIONS = "SELECT session_id, title, updated_at FROM sessions ORDER BY updated_at DESC"
+_SQL_MULTI_COLON_SESSIONS = "SELECT session_id, user_id FROM sessions WHERE session_id LIKE '%:%:%'"
+_SQL_UPDATE_USER = "UPDATE sessions SET user_id = ? WHERE session_id = ?"
+_SQL_LIST_USER_SESSIONS = (
+    "SELECT session_id, title, updated_at FROM sessions WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?"
+)
+
+
+def session_user_id(session_id: str) -> str:
+    """组合会话ID(user_id:session_id)中的用户部分，用户ID可能含':'(IPv6地址)，按最后一个':'拆分"""
+    user_id, separator, _ = session_id.rpartition(':')
+    return user_id if separator else session_id
+
+
+class SqliteSessionStore:
+    """所有会话存放在一个SQLite库里，每个线程使用自己的连接"""
+
+    def __init__(self, db_path: str, max_history: int = 50):
+        self.db_path = db_path
+        self.max_history = max_history
+        self._local = threading.local()
+        # 写入串行化，SQLite同一时刻只允许一个写事务
+        self._write_lock = threading.Lock()
+        with self._write_lock:
+            connection = self._connection()
+            for statement in _SQLITE_SCHEMA:
+                connection.execute(statement)
+            # 旧版本对含':'的用户ID(IPv6地址)按第一个':'拆分，记录的user_id不完整
+            for session_id, user_id in connection.execute(_SQL_MULTI_COLON_SESSIONS).fetchall():
+                if session_user_id(session_id) != user_id:
+                    connection.execute(_SQL_UPDATE_USER, (session_user_id(session_id), session_id))
+            connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, cached_statements=64)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # WAL模式下FULL在每次提交(即每个落盘批次)时fsync一次，NORMAL只在检查点时fsync
+            connection.execute(f"PRAGMA synchronous={'FULL' if MEMORY_FSYNC else 'NORMAL'}")
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id: str, limit: Optional[int] = None) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        connection = self._connection()
+        row = connection.execute(_SQL_SESSION, (session_id,)).fetchone()
+        if row is None:
+            return None
+        if limit:
+            rows = connection.execute(_SQL_LAST_MESSAGES, (session_id, limit)).fetchall()
+        else:
+            rows = connection.execute(_SQL_ALL_MESSAGES, (session_id,)).fetchall()
+        messages = [{"role": role, "content": content} for _, role, content in rows]
+        # seq从会话的第一条消息起连续编号，截断时只删除最早的行
+        meta = {'title': row[0], 'last_updated': row[1], 'message_offset': rows[0][0] - 1 if rows else 0}
+        return messages, meta
+
+    def _save(self, connection: sqlite3.Connection, session_id: str, messages: List[Dict[str, Any]],
+              meta: Dict[str, Any], appended: Optional[List[Dict[str, Any]]]) -> int:
+        connection.execute(_SQL_UPSERT_SESSION, (
+            session_id, session_user_id(session_id), meta.get('title'), meta.get('last_updated') or time.time(),
+        ))
+        if appended is None:
+            connection.execute(_SQL_DELETE_MESSAGES, (session_id,))
+            rows, start = messages, meta.get('message_offset', 0) + 1
+        else:
+            rows, start = appended, connection.execute(_SQL_MAX_SEQ, (session_id,)).fetchone()[0] + 1
+        connection.executemany(_SQL_INSERT_MESSAGE, [
+            (session_id, start + i, message.get('role'), message.get('content'))
+            for i, message in enumerate(rows)
+        ])
+        last_seq = start + len(rows) - 1
+        if appended is not None and last_seq > self.max_history:
+            # 和内存中一样只保留最近max_history条
+            connection.execute(_SQL_TRIM_MESSAGES, (session_id, last_seq - self.max_history))
+        return len(rows)
+
+    def save(self, session_id: str, messages: List[Dict[str, Any]], meta: Dict[str, Any],
+             appended: Optional[List[Dict[str, Any]]] = None) -> None:
+        self.save_many([(session_id, messages, meta, appended)])
+
+    def save_many(self, batch: List[Tuple[str, List[Dict[str, Any]], Dict[str, Any], Optional[List[Dict[str, Any]]]]]) -> None:
+        """一个事务写入一批会话，失败时整批回滚并抛出异常"""
+        if not batch:
+            return
+        with self._write_lock:
+            connection = self._connection()
+            try:
+                with connection:
+                    inserted = sum(self._save(connection, *item) for item in batch)
+            except Exception as e:
+                logger.warning(f"保存会话消息失败({len(batch)}个会话): {str(e)}")
+                raise
+        metrics.inc("memory_sqlite_rows_written_total", inserted)
+
+    def delete(self, session_id: str) -> bool:
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.execute(_SQL_DELETE_MESSAGES, (session_id,))
+                deleted = connection.execute(_SQL_DELETE_SESSION, (session_id,)).rowcount
+        return deleted > 0
+
+    def list_sessions(self) -> List[Dict[str, Any]]:
+        return [
+            {'session_id': session_id, 'title': title, 'last_modified': updated_at}
+            for session_id, title, updated_at in self._connection().execute(_SQL_LIST_SESSIONS)
+        ]
+
+    def list_user_sessions(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """某个用户的会话，最近更新的在前"""
+        return [
+            {'session_id': session_id, 'title': title, 'last_modified': updated_at}
+            for session_id, title, updated_at in self._connection().execute(_SQL_LIST_USER_SESSIONS, (user_id, limit))
+        ]
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def migrate_file_sessions(sessions_dir: str, store: SqliteSessionStore) -> int:
+    """把目录下的JSON/JSONL会话文件导入SQLite库，已存在的会话不覆盖；文件保留不删除"""
+    file_store = JsonlSessionStore(sessions_dir)
+    batch = []
+    for info in file_store.list_sessions():
+        session_id = info['session_id']
+        if store.load(session_id, limit=1) is not None:
+            continue
+        try:
+            loaded = file_store.load(session_id, limit=store.max_history)
+        except Exception as e:
+            logger.warning(f"读取会话文件失败 {session_id}: {str(e)}")
+            continue
+        if loaded is None:
+            continue
+        messages, meta = loaded
+        meta['title'] = meta.get('title') or info.get('title')
+        meta['last_updated'] = meta.get('last_updated') or info['last_modified']
+        batch.append((session_id, messages, meta, None))
+    store.save_many(batch)
+    logger.info(f"已导入 {len(batch)} 个会话到 {store.db_path}")
+    return len(batch)
+
+
+def shard_file_sessions(sessions_dir: str) -> int:
+    """
+    把顶层(分片之前)的会话文件和旧版本放错目录的会话文件(用户ID含':'时按第一个':'拆分)
+    移动到按用户分片的目录，返回移动的文件数
+    分片目录里已有同一会话的更新文件时直接删除旧文件；迁移期间不要同时运行服务
+    """
+    moved, directories, emptied = 0, set(), set()
+    for entry in list(iter_session_files(sessions_dir)):
+        top_level = os.path.dirname(entry.path) == sessions_dir
+        try:
+            session_id = _describe_file(entry.path).get('session_id')
+        except Exception as e:
+            logger.warning(f"读取会话文件失败 {entry.path}: {str(e)}")
+            continue
+        if not session_id:
+            if not top_level:
+                continue
+            session_id = os.path.splitext(entry.name)[0].replace('_', ':', 1)
+        target = session_path(sessions_dir, session_id, os.path.splitext(entry.name)[1])
+        if target == entry.path:
+            continue
+        if not top_level:
+            emptied.add(os.path.dirname(entry.path))
+        if os.path.exists(target) and os.path.getmtime(target) >= entry.stat().st_mtime:
+            os.remove(entry.path)
+            continue
+        _ensure_parent(target)
+        os.replace(entry.path, target)
+        directories.add(os.path.dirname(target))
+        moved += 1
+    for directory in emptied:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+    if MEMORY_FSYNC:
+        for directory in directories | {sessions_dir}:
+            _fsync_dir(directory)
+    logger.info(f"已把 {moved} 个会话文件移动到分片目录 {sessions_dir}")
+    return moved
+
+
+def sqlite_path(sessions_dir: str) -> str:
+    return MEMORY_SQLITE_PATH or os.path.join(os.path.dirname(sessions_dir), 'sessions.db')
+
+
+def create_session_store(sessions_dir: str, max_history: int):
+    """按MEMORY_BACKEND创建会话存储"""
+    if MEMORY_BACKEND == 'json':
+        return JsonSessionStore(sessions_dir)
+    if MEMORY_BACKEND == 'sqlite':
+        db_path = sqlite_path(sessions_dir)
+        created = not os.path.exists(db_path)
+        store = SqliteSessionStore(db_path, max_history)
+        if created:
+            # 第一次切换到SQLite时导入已有的会话文件
+            migrate_file_sessions(sessions_dir, store)
+        return store
+    return JsonlSessionStore(sessions_dir, compact_lines=MEMORY_COMPACT_LINES or max_history * 2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="会话存储维护")
+    parser.add_argument("--migrate", action="store_true", help="把JSON/JSONL会话文件导入SQLite库")
+    parser.add_argument("--shard", action="store_true", help="把顶层的会话文件移动到按用户分片的目录")
+    parser.add_argument("--sessions-dir", default=os.path.join('.', 'data', 'memory', 'sessions'))
+    parser.add_argument("--max-history", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.migrate:
+        target = SqliteSessionStore(sqlite_path(args.sessions_dir), args.max_history)
+        count = migrate_file_sessions(args.sessions_dir, target)
+        print(f"已导入 {count} 个会话，库中共 {target.count()} 个会话: {target.db_path}")
+    elif args.shard:
+        count = shard_file_sessions(args.sessions_dir)
+        print(f"已移动 {count} 个会话文件到分片目录: {args.sessions_dir}")
+    else:
+        parser.print_help()
@@ -0,0 +1,328 @@
+"""
+工具参数流式生成期间的投机查询
+
+内层智能体以流式方式生成mysql_caculator的参数JSON，边接收边解析已经确定的字段:
+- 表名确定后，从连接池取连接并预加载表结构缓存
+- 表、字段和过滤条件都确定后(后面的参数开始生成或JSON结束)，提前在后台执行数据查询
+模型生成完毕后用最终参数核对，不一致时取消投机查询；一致时mysql_caculator直接取用查询结果，
+数据库耗时和模型生成重叠。
+投机查询按请求隔离(request_prefetches)，一个请求只会取用或取消自己发起的查询，请求结束时清理没有用上的查询。
+
+通过环境变量配置:
+- LLM_SPECULATIVE_QUERY: 为0时关闭，默认1
+- SPECULATIVE_QUERY_TTL: 投机查询结果的有效期(秒)，默认30
+"""
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from src.arg_validator import ArgumentError, correct_mysql_arguments
+from src.select_mysql import query_data_from_tables, warm_schema_cache
+from utils import get_mysql_pool, logger, metrics
+
+
+SPECULATIVE_ENABLED = os.environ.get('LLM_SPECULATIVE_QUERY', '1') == '1'
+SPECULATIVE_TTL = float(os.environ.get('SPECULATIVE_QUERY_TTL', '30'))
+
+# 参与投机查询的工具及决定查询内容的参数，顺序和query_data_from_tables的参数一致
+SPECULATIVE_TOOL = "mysql_caculator"
+QUERY_KEYS = (
+    "x_table", "y_table", "x_field", "y_field",
+    "x_index_field", "x_start_index", "x_end_index",
+    "y_index_field", "y_start_index", "y_end_index",
+)
+_REQUIRED_KEYS = ("x_table", "y_table", "x_field", "y_field")
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+# (请求编号, 查询键) -> 投机查询
+_prefetches: Dict[tuple, "Prefetch"] = {}
+_prefetches_lock = threading.Lock()
+
+# 当前请求的编号，工具线程通过复制的上下文继承；不在request_prefetches内时为None(所有这样的调用共用)
+_current_scope = contextvars.ContextVar("speculative_scope", default=None)
+_scope_ids = itertools.count(1)
+
+
+@contextmanager
+def request_prefetches():
+    """在with块内发起的投机查询只归本次请求所有，退出时取消没有被取用的查询"""
+    scope = next(_scope_ids)
+    token = _current_scope.set(scope)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+        with _prefetches_lock:
+            leftovers = [_prefetches.pop(key) for key in [k for k in _prefetches if k[0] == scope]]
+        for prefetch in leftovers:
+            _kill(prefetch)
+
+
+def parse_partial_arguments(text: str) -> Tuple[Dict[str, Any], bool]:
+    """
+    解析尚未生成完的参数JSON
+
+    返回 (已确定的参数, JSON是否已结束)。最后一个参数的值可能还没生成完，不算已确定。
+    """
+    text = (text or "").strip()
+    if not text:
+        return {}, False
+    try:
+        value = json.loads(text)
+        return (value, True) if isinstance(value, dict) else ({}, True)
+    except ValueError:
+        pass
+
+    text = text.rstrip(",")
+    for suffix in ('}', '"}', ']}', '"]}', 'null}', ':null}', '":null}'):
+        try:
+            value = json.loads(text + suffix)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            keys = list(value)
+            if keys:
+                value.pop(keys[-1])
+            return value, False
+    return {}, False
+
+
+def query_key(arguments: Dict[str, Any]) -> Optional[tuple]:
+    """投机查询的键(参数先经过表结构纠正，和mysql_caculator实际查询时一致)，只处理单表单字段的简单查询"""
+    if any(not isinstance(arguments.get(key), str) or not arguments.get(key) for key in _REQUIRED_KEYS):
+        return None
+    try:
+        arguments, _ = correct_mysql_arguments(arguments, record=False)
+    except ArgumentError:
+        return None
+    if any(not isinstance(arguments.get(key), str) or not arguments.get(key) for key in _REQUIRED_KEYS):
+        return None
+    values = []
+    for key in QUERY_KEYS:
+        value = arguments.get(key)
+        if value is not None and not isinstance(value, (str, int, float)):
+            return None
+        values.append(value)
+    return tuple(values)
+
+
+class Prefetch:
+    """一次投机查询"""
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.created_at = time.time()
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.thread_id = None
+        self.future = None
+
+
+def _run_prefetch(prefetch: Prefetch) -> Optional[List[Dict[str, Any]]]:
+    pool = get_mysql_pool()
+    connection = pool.acquire()
+    try:
+        with prefetch.lock:
+            if prefetch.cancelled:
+                return None
+            prefetch.thread_id = connection.thread_id()
+        started = time.time()
+        rows = query_data_from_tables(connection, *prefetch.key)
+        logger.info(f"投机查询完成: {prefetch.key[:4]}，{len(rows)} 行，耗时 {time.time() - started:.2f}秒")
+        return rows
+    finally:
+        with prefetch.lock:
+            prefetch.thread_id = None
+            killed = prefetch.cancelled
+        if killed:
+            # 取消时可能已经(或即将)对这个连接发出KILL QUERY，关闭而不是归还，避免误杀复用它的查询
+            try:
+                connection.close()
+            except Exception:
+                pass
+        pool.release(connection)
+
+
+def start_prefetch(key: tuple) -> None:
+    """在后台执行投机查询，本请求中相同的查询已在进行时不重复执行"""
+    scoped_key = (_current_scope.get(), key)
+    with _prefetches_lock:
+        _expire_locked()
+        if scoped_key in _prefetches:
+            return
+        prefetch = Prefetch(key)
+        _prefetches[scoped_key] = prefetch
+    prefetch.future = _executor.submit(_run_prefetch, prefetch)
+    metrics.inc("speculative_queries_started_total")
+
+
+def cancel_prefetch(key: tuple) -> None:
+    """取消本请求的投机查询"""
+    with _prefetches_lock:
+        prefetch = _prefetches.pop((_current_scope.get(), key), None)
+    if prefetch is None:
+        return
+    _kill(prefetch)
+    logger.info(f"最终参数与投机查询不一致，已取消: {key[:4]}")
+
+
+def _kill(prefetch: Prefetch) -> None:
+    """标记取消，查询正在执行时终止数据库端的语句"""
+    metrics.inc("speculative_queries_cancelled_total")
+    with prefetch.lock:
+        prefetch.cancelled = True
+        thread_id = prefetch.thread_id
+    if thread_id is None:
+        return
+    # 不持有prefetch.lock等待连接: 连接池满时，执行查询的线程要拿到这把锁才能归还自己的连接
+    try:
+        with get_mysql_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("KILL QUERY %s", (thread_id,))
+    except Exception as e:
+        logger.warning(f"终止投机查询失败: {e}")
+
+
+def _expire_locked() -> None:
+    now = time.time()
+    for key in [k for k, p in _prefetches.items() if now - p.created_at > SPECULATIVE_TTL]:
+        _prefetches.pop(key)
+
+
+def take_prefetched(key: tuple, timeout: float = 60.0) -> Optional[List[Dict[str, Any]]]:
+    """取出本请求的投机查询结果(还在执行时等待)，没有可用结果时返回None"""
+    with _prefetches_lock:
+        _expire_locked()
+        prefetch = _prefetches.pop((_current_scope.get(), key), None)
+    if prefetch is None or prefetch.cancelled or prefetch.future is None:
+        return None
+    try:
+        rows = prefetch.future.result(timeout=timeout)
+    except Exception as e:
+        logger.warning(f"投机查询失败，重新查询: {e}")
+        return None
+    if rows is None:
+        return None
+    metrics.inc("speculative_queries_used_total")
+    return rows
+
+
+def fetch_rows(connection, *args) -> List[Dict[str, Any]]:
+    """优先使用投机查询的结果，否则正常查询；参数与query_data_from_tables相同"""
+    if SPECULATIVE_ENABLED:
+        rows = take_prefetched(tuple(args))
+        if rows is not None:
+            return rows
+    return query_data_from_tables(connection, *args)
+
+
+def _warm_schema(tables: Iterable[str]) -> None:
+    try:
+        with get_mysql_pool().connection() as connection:
+            warm_schema_cache(connection, tables)
+    except Exception as e:
+        logger.warning(f"预加载表结构失败: {e}")
+
+
+class ArgumentWatcher:
+    """跟踪一个工具调用的参数流，在参数确定时触发预热和投机查询"""
+
+    def __init__(self):
+        self.text = ""
+        self.warmed = False
+        self.started_key = None
+
+    def feed(self, delta: str) -> None:
+        self.text += delta
+        arguments, closed = parse_partial_arguments(self.text)
+
+        if not self.warmed and isinstance(arguments.get("x_table"), str) and isinstance(arguments.get("y_table"), str):
+            self.warmed = True
+            _executor.submit(_warm_schema, sorted({arguments["x_table"], arguments["y_table"]}))
+
+        # 过滤条件是可选参数，要等到后面的参数(chart_type等)开始生成才能确定没有更多过滤条件
+        if self.started_key is None and (closed or "chart_type" in arguments):
+            key = query_key(arguments)
+            if key is not None:
+                self.started_key = key
+                start_prefetch(key)
+
+    def finish(self) -> None:
+        """参数生成完毕，最终参数和投机查询不一致时取消"""
+        if self.started_key is None:
+            return
+        arguments, _ = parse_partial_arguments(self.text)
+        if query_key(arguments) != self.started_key:
+            cancel_prefetch(self.started_key)
+
+
+def should_speculate(agent) -> bool:
+    return SPECULATIVE_ENABLED and any(
+        getattr(func, "__name__", None) == SPECULATIVE_TOOL for func in agent.functions
+    )
+
+
+def collect_stream(chunks: Iterable[Any], model: str) -> ChatCompletion:
+    """
+    消费流式响应并组装成和非流式请求相同的ChatCompletion，
+    过程中对mysql_caculator的参数做投机查询
+    """
+    content = ""
+    finish_reason = None
+    completion_id = None
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    watchers: Dict[int, ArgumentWatcher] = {}
+
+    for chunk in chunks:
+        completion_id = completion_id or chunk.id
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        delta = choice.delta
+        if delta.content:
+            content += delta.content
+        for tool_delta in delta.tool_calls or []:
+            entry = tool_calls.setdefault(tool_delta.index, {"id": None, "name": "", "arguments": ""})
+            if tool_delta.id:
+                entry["id"] = tool_delta.id
+            function = tool_delta.function
+            if function is None:
+                continue
+            if function.name:
+                entry["name"] += function.name
+            if function.arguments:
+                entry["arguments"] += function.arguments
+                if entry["name"] == SPECULATIVE_TOOL:
+                    watchers.setdefault(tool_delta.index, ArgumentWatcher()).feed(function.arguments)
+
+    for watcher in watchers.values():
+        watcher.finish()
+
+    message = ChatCompletionMessage(
+        role="assistant",
+        content=content or None,
+        tool_calls=[
+            ChatCompletionMessageToolCall(
+                id=entry["id"],
+                type="function",
+                function=Function(name=entry["name"], arguments=entry["arguments"]),
+            )
+            for _, entry in sorted(tool_calls.items())
+        ] or None,
+    )
+    return ChatCompletion(
+        id=completion_id or "speculative",
+        object="chat.completion",
+        created=int(time.time()),
+        model=model,
+        choices=[Choice(index=0, finish_reason=finish_reason or "stop", message=message)],
+    )
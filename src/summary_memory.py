@@ -0,0 +1,245 @@
+"""
+长会话滚动摘要
+
+把超过阈值的较早轮次折叠进每个会话的滚动摘要，并记录已经生成过的图表(表、字段、图表类型)。
+摘要在后台线程里增量刷新，不占用请求路径；结果保存在 data/memory/summaries 下，与会话文件同名。
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from src.llm_client import create_completion
+from src.memory import CHART_PAYLOAD_PATTERN, elide_chart_payload
+from src.session_store import flat_session_path
+from src.usage import usage_tracker
+from utils import LRUCache, logger
+
+
+SUMMARY_PROMPT = (
+    "你负责压缩数据分析助手的对话历史。根据已有摘要和新增的对话，输出一段更新后的中文摘要，"
+    "保留用户关注的数据表、字段、筛选条件、时间范围、已得到的结论和未解决的问题，不要编造数据，不超过300字。"
+)
+
+# 图表标题中的 表名.字段名
+_TABLE_FIELD_PATTERN = re.compile(r'([A-Za-z_][\w]*)\.([A-Za-z_][\w]*)')
+
+
+def extract_charts(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """从助手消息的图表结果中提取表、字段和图表类型"""
+    charts = []
+    for msg in messages:
+        if msg.get("role") != "assistant" or not msg.get("content"):
+            continue
+        for match in CHART_PAYLOAD_PATTERN.finditer(msg["content"]):
+            if match.group(1) != '$$$$':
+                continue
+            payload = match.group(2)
+            chart_type = re.search(r"['\"]chart_type['\"]\s*:\s*['\"]([^'\"]+)", payload)
+            title = re.search(r"['\"]title['\"]\s*:\s*['\"]([^'\"]+)", payload)
+            pairs = _TABLE_FIELD_PATTERN.findall(title.group(1)) if title else []
+            charts.append({
+                "chart_type": chart_type.group(1) if chart_type else None,
+                "tables": sorted({table for table, _ in pairs}),
+                "fields": [field for _, field in pairs],
+            })
+    return charts
+
+
+class SessionSummarizer:
+    """
+    会话滚动摘要管理器
+
+    参数:
+    - memory: ConversationMemory实例
+    - fold_threshold: 会话消息数超过该值才开始折叠
+    - keep_recent: 最近的多少条消息保持原文，不折叠
+    - summarize_fn: 生成摘要的函数 (previous_summary, new_messages) -> str，失败时退回抽取式摘要
+    """
+
+    def __init__(self, memory, fold_threshold=20, keep_recent=10, summarize_fn=None, max_workers=2):
+        self.memory = memory
+        self.fold_threshold = fold_threshold
+        self.keep_recent = keep_recent
+        self.summarize_fn = summarize_fn
+
+        self.summaries_dir = os.path.join(memory.storage_dir, 'summaries')
+        os.makedirs(self.summaries_dir, exist_ok=True)
+
+        # 摘要已经保存在文件里，内存中只缓存最近用到的会话
+        self._states = LRUCache(
+            "session_summaries",
+            max_entries=int(os.environ.get('SUMMARY_CACHE_MAX_SESSIONS', '1000')),
+            ttl=float(os.environ.get('SUMMARY_CACHE_IDLE_TTL', '1800')),
+        )
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+
+    def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话摘要，内存中没有时从文件加载"""
+        with self._lock:
+            if session_id in self._states:
+                return self._states[session_id]
+
+        state = None
+        summary_file = self.memory._get_file_path(self.summaries_dir, session_id)
+        if not os.path.exists(summary_file):
+            # 分片之前的摘要文件
+            summary_file = flat_session_path(self.summaries_dir, session_id, ".json")
+        if os.path.exists(summary_file):
+            try:
+                with open(summary_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+            except Exception as e:
+                logger.warning(f"加载会话摘要失败 {session_id}: {str(e)}")
+
+        with self._lock:
+            self._states[session_id] = state
+        return state
+
+    def _save_summary(self, session_id: str, state: Dict[str, Any]) -> None:
+        summary_file = self.memory._get_file_path(self.summaries_dir, session_id)
+        tmp_file = summary_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_file, summary_file)
+        except Exception as e:
+            logger.warning(f"保存会话摘要失败 {session_id}: {str(e)}")
+
+    def discard(self, session_id: str) -> None:
+        """删除或清空会话时一并删除摘要"""
+        with self._lock:
+            self._states.pop(session_id, None)
+        for summary_file in (self.memory._get_file_path(self.summaries_dir, session_id),
+                             flat_session_path(self.summaries_dir, session_id, ".json")):
+            if os.path.exists(summary_file):
+                try:
+                    os.remove(summary_file)
+                except Exception as e:
+                    logger.warning(f"删除会话摘要失败 {session_id}: {str(e)}")
+
+    def schedule_refresh(self, session_id: str, message_count: Optional[int] = None) -> None:
+        """请求结束后调用，会话足够长时在后台刷新摘要；后台线程沿用调用方的上下文(用量归属的用户和会话)"""
+        if message_count is not None and message_count <= self.fold_threshold:
+            return
+
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+
+        self._executor.submit(contextvars.copy_context().run, self._refresh, session_id)
+
+    def _refresh(self, session_id: str) -> None:
+        try:
+            offset, window = self.memory.get_message_window(session_id)
+            # (消息在会话中的位置, 消息)，位置从0计，不随截断变化
+            messages = [(offset + i, msg) for i, msg in enumerate(window) if msg["role"] != "system"]
+            if len(messages) <= self.fold_threshold:
+                return
+
+            to_fold = messages[:-self.keep_recent] if self.keep_recent else messages
+            state = self.get_summary(session_id)
+            if not state or "folded_until" not in state:
+                # 旧版按内容哈希记录的摘要无法定位折叠边界，重新生成
+                state = {"summary": "", "charts": [], "folded_until": 0, "folded_count": 0}
+
+            # 只折叠上次之后新增的消息；上次的边界已被截断时，剩下的都是新消息
+            new_messages = self.memory._resolve_payloads(
+                [msg for position, msg in to_fold if position >= state["folded_until"]])
+            if not new_messages:
+                return
+
+            started = time.time()
+            summary = self._summarize(state.get("summary", ""), new_messages)
+            state = {
+                "summary": summary,
+                "charts": state.get("charts", []) + extract_charts(new_messages),
+                "folded_until": to_fold[-1][0] + 1,
+                "folded_count": state.get("folded_count", 0) + len(new_messages),
+                "updated_at": time.time(),
+            }
+
+            with self._lock:
+                self._states[session_id] = state
+            self._save_summary(session_id, state)
+            logger.info(f"会话摘要已更新 {session_id}: 折叠 {len(new_messages)} 条消息，耗时 {time.time() - started:.2f}秒")
+        except Exception as e:
+            logger.warning(f"刷新会话摘要失败 {session_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+    def _summarize(self, previous: str, new_messages: List[Dict[str, Any]]) -> str:
+        if self.summarize_fn is not None:
+            try:
+                return self.summarize_fn(previous, new_messages)
+            except Exception as e:
+                logger.warning(f"模型生成摘要失败，使用抽取式摘要: {str(e)}")
+
+        lines = [previous] if previous else []
+        for msg in new_messages:
+            content = elide_chart_payload(msg.get("content") or "").replace("\n", " ")
+            lines.append(f"{'用户' if msg['role'] == 'user' else '助手'}: {content[:80]}")
+        # 抽取式摘要只保留最近的部分，避免无限增长
+        return "\n".join(lines)[-1500:]
+
+    def fold(self, session_id: str, messages: List[Dict[str, Any]],
+             offset: Optional[int] = 0) -> List[Dict[str, Any]]:
+        """
+        用摘要替换已折叠的消息，返回 [摘要系统消息] + 未折叠的消息
+
+        offset是messages[0]在会话中的位置(ConversationMemory.get_message_window)，为None时位置未知，不使用摘要
+        """
+        state = self.get_summary(session_id)
+        if not state or not state.get("folded_until") or offset is None:
+            return messages
+
+        cut = state["folded_until"] - offset
+        if cut > len(messages):
+            # 折叠边界超出现有消息(如会话被清空)时不使用摘要
+            return messages
+        # 边界之前的消息已被截断时，现有消息都在摘要之后
+        cut = max(cut, 0)
+
+        charts = "; ".join(
+            f"{chart['chart_type']}({', '.join(chart['tables'])}: {', '.join(chart['fields'])})"
+            for chart in state.get("charts", [])[-10:]
+        )
+        content = f"此前对话摘要:\n{state['summary']}"
+        if charts:
+            content += f"\n已生成的图表: {charts}"
+
+        system_messages = [msg for msg in messages if msg["role"] == "system"]
+        remaining = [msg for msg in messages[cut:] if msg["role"] != "system"]
+        return system_messages + [{"role": "system", "content": content}] + remaining
+
+
+def llm_summarize_fn(openai_client, model_name: str, max_tokens: int = 400):
+    """构造调用模型生成摘要的函数"""
+
+    def summarize(previous: str, new_messages: List[Dict[str, Any]]) -> str:
+        dialogue = "\n".join(
+            f"{'用户' if msg['role'] == 'user' else '助手'}: {elide_chart_payload(msg.get('content') or '')}"
+            for msg in new_messages
+        )
+        # 和对话请求一样经过端点熔断器，熔断时直接退回抽取式摘要
+        completion = create_completion(openai_client, {
+            "model": model_name,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"已有摘要:\n{previous or '无'}\n\n新增对话:\n{dialogue}"},
+            ],
+            "max_tokens": max_tokens,
+        })
+        usage_tracker.record(model_name, "summary", completion.usage)
+        return completion.choices[0].message.content.strip()
+
+    return summarize
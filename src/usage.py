@@ -0,0 +1,185 @@
+"""
+LLM token用量统计与每日配额
+
+每次chat completion(主智能体和内层智能体)的prompt/completion token数都会记录下来，
+按用户、会话、阶段和模型汇总在内存中，并通过 /api/metrics 导出。
+
+通过环境变量配置:
+- USER_DAILY_TOKEN_QUOTA: 每个用户每天可用的token数，0表示不限制，默认0
+- LLM_PRICES: 模型单价JSON，{"模型": {"input": 未命中缓存输入, "cached": 命中缓存输入, "output": 输出}}，单位美元/百万token
+- LLM_STREAM_USAGE: 为1时流式请求也要求服务端返回用量(stream_options.include_usage)，默认1
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from utils import logger, metrics
+
+
+USER_DAILY_TOKEN_QUOTA = int(os.environ.get('USER_DAILY_TOKEN_QUOTA', '0'))
+STREAM_USAGE = os.environ.get('LLM_STREAM_USAGE', '1') == '1'
+
+# 默认单价，美元/百万token
+DEFAULT_PRICES = {
+    "deepseek-chat": {"input": 0.27, "cached": 0.07, "output": 1.10},
+    "deepseek-reasoner": {"input": 0.55, "cached": 0.14, "output": 2.19},
+}
+try:
+    PRICES = {**DEFAULT_PRICES, **json.loads(os.environ.get('LLM_PRICES', '{}'))}
+except ValueError:
+    logger.warning("LLM_PRICES 格式错误，使用默认单价")
+    PRICES = dict(DEFAULT_PRICES)
+
+# 最多保留多少个会话的用量
+MAX_TRACKED_SESSIONS = 1000
+
+_request_context = contextvars.ContextVar("llm_request_context", default=None)
+
+
+class QuotaExceededError(Exception):
+    """用户当日token用量超过配额"""
+
+
+@contextmanager
+def request_context(user_id: str, session_id: str):
+    """在with块内发出的LLM请求都记到该用户和会话名下"""
+    token = _request_context.set({"user_id": user_id, "session_id": session_id})
+    try:
+        yield
+    finally:
+        _request_context.reset(token)
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d")
+
+
+def _cached_tokens(usage: Any) -> int:
+    """兼容deepseek(prompt_cache_hit_tokens)和openai(prompt_tokens_details.cached_tokens)"""
+    cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+    return cached or 0
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """按单价估算一次调用的费用(美元)，未知模型返回0"""
+    price = PRICES.get(model)
+    if not price:
+        return 0.0
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (
+        uncached * price.get("input", 0)
+        + cached_tokens * price.get("cached", price.get("input", 0))
+        + completion_tokens * price.get("output", 0)
+    ) / 1_000_000
+
+
+class UsageTracker:
+    """进程内的token用量汇总"""
+
+    def __init__(self, daily_quota: int = USER_DAILY_TOKEN_QUOTA):
+        self.daily_quota = daily_quota
+        self._lock = threading.Lock()
+        self._day = _today()
+        self._user_daily = defaultdict(int)
+        self._sessions = OrderedDict()
+
+    def _roll_day(self) -> None:
+        today = _today()
+        if today != self._day:
+            self._day = today
+            self._user_daily.clear()
+
+    def record(self, model: str, stage: Optional[str], usage: Any) -> None:
+        """记录一次调用的用量，归属到当前请求的用户和会话"""
+        if usage is None:
+            return
+
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        cached_tokens = _cached_tokens(usage)
+        cost = estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+
+        context = _request_context.get() or {}
+        user_id = context.get("user_id", "system")
+        session_id = context.get("session_id")
+        stage = stage or "unknown"
+
+        metrics.inc("llm_tokens_total", prompt_tokens, model=model, stage=stage, kind="prompt")
+        metrics.inc("llm_tokens_total", completion_tokens, model=model, stage=stage, kind="completion")
+        metrics.inc("llm_calls_total", 1, model=model, stage=stage)
+        if cost:
+            metrics.inc("llm_cost_usd_total", cost, model=model, stage=stage)
+
+        with self._lock:
+            self._roll_day()
+            self._user_daily[user_id] += prompt_tokens + completion_tokens
+            if session_id:
+                key = f"{user_id}:{session_id}"
+                totals = self._sessions.pop(key, None) or {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+                totals["prompt_tokens"] += prompt_tokens
+                totals["completion_tokens"] += completion_tokens
+                totals["cost_usd"] += cost
+                self._sessions[key] = totals
+                while len(self._sessions) > MAX_TRACKED_SESSIONS:
+                    self._sessions.popitem(last=False)
+
+        logger.info(
+            f"LLM用量: 用户={user_id}, 会话={session_id}, 阶段={stage}, 模型={model}, "
+            f"prompt={prompt_tokens}(缓存{cached_tokens}), completion={completion_tokens}, 费用=${cost:.6f}"
+        )
+
+    def user_tokens_today(self, user_id: str) -> int:
+        with self._lock:
+            self._roll_day()
+            return self._user_daily.get(user_id, 0)
+
+    def check_quota(self, user_id: str) -> None:
+        """用户当日用量已达到配额时抛出QuotaExceededError"""
+        if self.daily_quota <= 0:
+            return
+        used = self.user_tokens_today(user_id)
+        if used >= self.daily_quota:
+            metrics.inc("llm_quota_rejections_total")
+            raise QuotaExceededError(f"用户 {user_id} 今日token用量 {used} 已达到配额 {self.daily_quota}")
+
+    def session_usage(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            totals = self._sessions.get(f"{user_id}:{session_id}")
+            return dict(totals) if totals else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出当日各用户的用量"""
+        with self._lock:
+            self._roll_day()
+            result = {
+                f'llm_user_tokens_today{{user="{user_id}"}}': tokens
+                for user_id, tokens in self._user_daily.items()
+            }
+            result["llm_tracked_sessions"] = len(self._sessions)
+        return result
+
+
+usage_tracker = UsageTracker()
+metrics.register_collector(usage_tracker.snapshot)
+
+
+def track_stream(stream, on_usage: Callable[[Any], None]) -> Iterator[Any]:
+    """
+    透传流式响应，把用量chunk交给on_usage
+
+    开启include_usage后服务端在最后发送一个choices为空、只带usage的chunk，Swarm不能处理这种chunk，这里把它拦下来。
+    """
+    for chunk in stream:
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            on_usage(usage)
+        if getattr(chunk, "choices", None):
+            yield chunk
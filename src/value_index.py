@@ -0,0 +1,283 @@
+"""
+分类字段取值索引
+
+后台从MySQL加载低基数文本字段(如 jlugroup、school、identity、classification)的全部取值，
+在内存中建立倒排索引，把用户的说法映射成库里实际存储的值:
+    "电控组" -> "电控组"(精确)
+    "电控" / "电控的" -> "电控组"(包含关系)
+    "dkz" / "diankongzu" -> "电控组"(拼音首字母/全拼，需要安装pypinyin)
+查询只访问内存，不访问数据库也不需要模型推理；索引注册为参数校验的取值解析器(见 src.arg_validator)。
+
+索引定期增量刷新: 有自增ID的表只加载新增行的取值，每隔若干轮做一次全量重建以去掉已删除的取值。
+
+通过环境变量配置:
+- VALUE_INDEX_ENABLED: 为0时关闭，默认1
+- VALUE_INDEX_MAX_DISTINCT: 取值个数超过该值的字段不建索引，默认200
+- VALUE_INDEX_REFRESH: 增量刷新间隔(秒)，默认600
+- VALUE_INDEX_FULL_EVERY: 每隔多少次刷新做一次全量重建，默认12
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from src.arg_validator import register_value_resolver, schema_catalog
+from utils import get_mysql_pool, logger, metrics
+
+try:
+    from pypinyin import Style, lazy_pinyin
+    PINYIN_AVAILABLE = True
+except ImportError:
+    PINYIN_AVAILABLE = False
+
+
+VALUE_INDEX_ENABLED = os.environ.get('VALUE_INDEX_ENABLED', '1') == '1'
+VALUE_INDEX_MAX_DISTINCT = int(os.environ.get('VALUE_INDEX_MAX_DISTINCT', '200'))
+VALUE_INDEX_REFRESH = float(os.environ.get('VALUE_INDEX_REFRESH', '600'))
+VALUE_INDEX_FULL_EVERY = int(os.environ.get('VALUE_INDEX_FULL_EVERY', '12'))
+
+# 不建索引的字段(个人信息、长文本、日期等)
+_EXCLUDED_FIELDS = {
+    "id", "uid", "webid", "idcard", "qq", "name", "nickname", "username", "password",
+    "phone", "email", "wechat", "we_chat",
+}
+_EXCLUDED_FIELD_HINTS = (
+    "image", "photo", "link", "content", "title", "address", "description", "remark",
+    "date", "time", "sign", "_at", "text_",
+)
+
+# 用户说法里常见的、不属于取值本身的后缀
+_PHRASE_SUFFIXES = re.compile(r'(的人|的成员|的数据|的|们)$')
+
+
+def normalize(text: str) -> str:
+    """全角转半角、去空白、转小写"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text)).lower()
+
+
+def pinyin_keys(text: str) -> Tuple[str, ...]:
+    """全拼和首字母，未安装pypinyin或不含汉字时为空"""
+    if not PINYIN_AVAILABLE or not re.search(r'[一-鿿]', text):
+        return ()
+    syllables = lazy_pinyin(text, errors='ignore')
+    initials = lazy_pinyin(text, style=Style.FIRST_LETTER, errors='ignore')
+    return "".join(syllables).lower(), "".join(initials).lower()
+
+
+def is_indexable(field: str, column_type: Optional[str]) -> bool:
+    column_type = (column_type or "").lower()
+    if "char" not in column_type and "text" not in column_type:
+        return False
+    lowered = field.lower()
+    return lowered not in _EXCLUDED_FIELDS and not any(hint in lowered for hint in _EXCLUDED_FIELD_HINTS)
+
+
+class FieldValues:
+    """单个字段的取值及其倒排索引"""
+
+    def __init__(self):
+        self.values: Set[str] = set()
+        self._keys: Dict[str, Set[str]] = {}
+        self._chars: Dict[str, Set[str]] = {}
+
+    def add(self, value: str) -> None:
+        if not value or value in self.values:
+            return
+        self.values.add(value)
+        for key in (normalize(value),) + pinyin_keys(value):
+            self._keys.setdefault(key, set()).add(value)
+        for char in set(normalize(value)):
+            self._chars.setdefault(char, set()).add(value)
+
+    def lookup(self, phrase: str) -> Optional[str]:
+        """返回唯一匹配的取值，没有匹配或有歧义时返回None"""
+        if phrase in self.values:
+            return phrase
+        key = normalize(phrase)
+        for candidate in (key, _PHRASE_SUFFIXES.sub('', key)):
+            matched = self._keys.get(candidate)
+            if matched and len(matched) == 1:
+                return next(iter(matched))
+        key = _PHRASE_SUFFIXES.sub('', key) or key
+
+        # 取值包含用户的说法("电控" -> "电控组")，用字符倒排表求交集缩小候选
+        candidates = None
+        for char in set(key):
+            values = self._chars.get(char)
+            if not values:
+                candidates = set()
+                break
+            candidates = set(values) if candidates is None else candidates & values
+        if candidates:
+            contained = [value for value in candidates if key in normalize(value)]
+            if len(contained) == 1:
+                return contained[0]
+            if not contained:
+                # 缩写: 说法里的字按顺序出现在取值里("电组" -> "电控组")
+                abbreviated = [value for value in candidates if _is_subsequence(key, normalize(value))]
+                if len(abbreviated) == 1:
+                    return abbreviated[0]
+
+        # 用户的说法包含取值("电控组成员" -> "电控组")，取最长的
+        contained_in = [value for value in self.values if len(normalize(value)) > 1 and normalize(value) in key]
+        if contained_in:
+            longest = max(len(normalize(value)) for value in contained_in)
+            best = [value for value in contained_in if len(normalize(value)) == longest]
+            if len(best) == 1:
+                return best[0]
+        return None
+
+
+def _is_subsequence(short: str, long: str) -> bool:
+    remaining = iter(long)
+    return all(char in remaining for char in short)
+
+
+class ValueIndex:
+    """所有分类字段的取值索引，后台线程构建和刷新"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fields: Dict[Tuple[str, str], FieldValues] = {}
+        # 表 -> 已加载的最大自增ID，用于增量刷新
+        self._max_ids: Dict[str, int] = {}
+        # 取值太多而被排除的字段，增量刷新只看到新增的行，不能据此重新加入，等下一次全量刷新再判断
+        self._excluded: Set[Tuple[str, str]] = set()
+        self._thread = None
+        self._refreshes = 0
+        self.built_at = None
+
+    def lookup(self, table: str, field: str, phrase: str) -> Optional[str]:
+        values = self._fields.get((table, field))
+        if values is None:
+            return None
+        return values.lookup(phrase)
+
+    def candidates(self, table: str, field: str) -> List[str]:
+        values = self._fields.get((table, field))
+        return sorted(values.values) if values else []
+
+    def _columns(self) -> Dict[str, List[str]]:
+        columns = {}
+        for table, fields in schema_catalog.tables.items():
+            indexable = [field for field, column_type in fields.items() if is_indexable(field, column_type)]
+            if indexable:
+                columns[table] = indexable
+        return columns
+
+    @staticmethod
+    def _id_column(table: str) -> Optional[str]:
+        fields = schema_catalog.tables.get(table, {})
+        return next((name for name in ("ID", "id") if name in fields), None)
+
+    def _load_table(self, cursor, table: str, fields: Iterable[str], full: bool) -> Dict[str, Optional[Set[str]]]:
+        id_column = self._id_column(table)
+        since = None if full or id_column is None else self._max_ids.get(table)
+        # 先记录最大ID，查询期间新增的行留给下一次刷新(重复加载无影响)
+        max_id = None
+        if id_column is not None:
+            cursor.execute(f"SELECT MAX(`{id_column}`) FROM `{table}`")
+            row = cursor.fetchone()
+            max_id = row[0] if row else None
+        loaded = {}
+        for field in fields:
+            sql = f"SELECT DISTINCT `{field}` FROM `{table}`"
+            params = ()
+            if since is not None:
+                sql += f" WHERE `{id_column}` > %s"
+                params = (since,)
+            cursor.execute(sql + f" LIMIT {VALUE_INDEX_MAX_DISTINCT + 1}", params)
+            values = {str(row[0]).strip() for row in cursor.fetchall() if row[0] not in (None, "")}
+            # 取值太多的不是分类字段
+            loaded[field] = None if len(values) > VALUE_INDEX_MAX_DISTINCT else values
+        if max_id is not None:
+            self._max_ids[table] = int(max_id)
+        return loaded
+
+    def refresh(self, full: bool = False) -> None:
+        """加载取值；full为False时只加载新增行的取值"""
+        started = time.time()
+        full = full or self.built_at is None
+        columns = self._columns()
+        fields = dict(self._fields) if not full else {}
+        excluded = set(self._excluded) if not full else set()
+        with get_mysql_pool().connection() as connection:
+            cursor = connection.cursor()
+            try:
+                for table, table_fields in columns.items():
+                    table_fields = [field for field in table_fields if (table, field) not in excluded]
+                    if not table_fields:
+                        continue
+                    try:
+                        loaded = self._load_table(cursor, table, table_fields, full)
+                    except Exception as e:
+                        logger.warning(f"加载取值索引失败 {table}: {e}")
+                        continue
+                    for field, values in loaded.items():
+                        key = (table, field)
+                        if values is None:
+                            fields.pop(key, None)
+                            excluded.add(key)
+                            continue
+                        existing = fields.get(key)
+                        if existing is not None and values <= existing.values:
+                            continue
+                        # 在副本上追加新取值，查询线程始终看到完整的索引
+                        current = FieldValues()
+                        for value in (existing.values if existing is not None else set()) | values:
+                            current.add(value)
+                        if len(current.values) > VALUE_INDEX_MAX_DISTINCT:
+                            fields.pop(key, None)
+                            excluded.add(key)
+                        else:
+                            fields[key] = current
+            finally:
+                cursor.close()
+
+        with self._lock:
+            self._fields = fields
+            self._excluded = excluded
+        self.built_at = time.time()
+        metrics.set_gauge("value_index_fields", len(fields))
+        metrics.set_gauge("value_index_values", sum(len(values.values) for values in fields.values()))
+        logger.info(f"取值索引{'全量' if full else '增量'}刷新完成: {len(fields)} 个字段，耗时 {time.time() - started:.2f}秒")
+
+    def _run(self) -> None:
+        while True:
+            full = self._refreshes % max(VALUE_INDEX_FULL_EVERY, 1) == 0
+            try:
+                self.refresh(full=full)
+            except Exception as e:
+                logger.warning(f"刷新取值索引失败: {e}")
+            self._refreshes += 1
+            time.sleep(VALUE_INDEX_REFRESH)
+
+    def start(self) -> None:
+        """启动后台构建和定期刷新，重复调用无效"""
+        if not VALUE_INDEX_ENABLED:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="value-index", daemon=True)
+            self._thread.start()
+
+
+value_index = ValueIndex()
+
+
+def resolve_categorical_value(table: str, field: str, value: str) -> Optional[str]:
+    """参数校验的取值解析器: 把用户的说法换成库里实际的取值"""
+    resolved = value_index.lookup(table, field, value)
+    if resolved is not None and resolved != value:
+        metrics.inc("value_index_hits_total")
+    return resolved
+
+
+register_value_resolver(resolve_categorical_value)
+
+
+def start_value_index() -> None:
+    value_index.start()
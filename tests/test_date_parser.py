@@ -0,0 +1,81 @@
+from datetime import date
+
+import pytest
+
+from utils.date_parser import DateRange, format_range, parse_date_range
+
+
+TODAY = date(2025, 5, 20)
+
+
+@pytest.mark.parametrize("text, start, end", [
+    ("2025年4月", date(2025, 4, 1), date(2025, 4, 30)),
+    ("3月1日到3月22日", date(2025, 3, 1), date(2025, 3, 22)),
+    ("3月1日到22日", date(2025, 3, 1), date(2025, 3, 22)),
+    ("从3月1日至3月22日的数据", date(2025, 3, 1), date(2025, 3, 22)),
+    ("2024-03-05", date(2024, 3, 5), date(2024, 3, 5)),
+    ("20240305", date(2024, 3, 5), date(2024, 3, 5)),
+    ("2023/9 - 2024/1", date(2023, 9, 1), date(2024, 1, 31)),
+    ("二〇二四年十二月", date(2024, 12, 1), date(2024, 12, 31)),
+    ("2024年", date(2024, 1, 1), date(2024, 12, 31)),
+    ("今天", TODAY, TODAY),
+    ("昨天", date(2025, 5, 19), date(2025, 5, 19)),
+    ("去年", date(2024, 1, 1), date(2024, 12, 31)),
+    ("去年同期", date(2024, 1, 1), date(2024, 5, 20)),
+    ("今年以来", date(2025, 1, 1), date(2025, 12, 31)),
+    ("最近7天", date(2025, 5, 14), TODAY),
+    ("近2周", date(2025, 5, 7), TODAY),
+    ("最近1个月", date(2025, 4, 21), TODAY),
+    ("上个月", date(2025, 4, 1), date(2025, 4, 30)),
+    ("本月", date(2025, 5, 1), date(2025, 5, 31)),
+    ("本周", date(2025, 5, 19), date(2025, 5, 25)),
+    ("上周", date(2025, 5, 12), date(2025, 5, 18)),
+    ("第二季度", date(2025, 4, 1), date(2025, 6, 30)),
+    ("2024年Q4", date(2024, 10, 1), date(2024, 12, 31)),
+    ("上季度", date(2025, 1, 1), date(2025, 3, 31)),
+    ("2024年下半年", date(2024, 7, 1), date(2024, 12, 31)),
+])
+def test_documented_expressions(text, start, end):
+    assert parse_date_range(text, today=TODAY) == DateRange(start, end)
+
+
+@pytest.mark.parametrize("text, start, end", [
+    # 结束部分没写年份且早于开始时跨年
+    ("12月到2月", date(2024, 12, 1), date(2025, 2, 28)),
+    ("2024年12月到2月", date(2024, 12, 1), date(2025, 2, 28)),
+    ("2023年11月到2月", date(2023, 11, 1), date(2024, 2, 29)),
+    ("12月到2025年2月", date(2024, 12, 1), date(2025, 2, 28)),
+])
+def test_year_wrap(text, start, end):
+    assert parse_date_range(text, today=TODAY) == DateRange(start, end)
+
+
+@pytest.mark.parametrize("text, start, end", [
+    ("2025-03-01 - 2025-03-22", date(2025, 3, 1), date(2025, 3, 22)),
+    ("2025-03 - 2025-04", date(2025, 3, 1), date(2025, 4, 30)),
+    ("2025年4月1日-4月30日", date(2025, 4, 1), date(2025, 4, 30)),
+    ("2025.3.1-2025.3.22", date(2025, 3, 1), date(2025, 3, 22)),
+    ("2025-03-01~2025-03-22", date(2025, 3, 1), date(2025, 3, 22)),
+])
+def test_dash_ranges(text, start, end):
+    assert parse_date_range(text, today=TODAY) == DateRange(start, end)
+
+
+@pytest.mark.parametrize("text", [
+    None, "", "None", "null", "全部", "不限",
+    # 不存在的日期
+    "2月30日", "2025-13-01", "2025年2月29日",
+    # 无法解析
+    "很久以前", "最近0天",
+    # 两端都写了年份的倒序范围
+    "2025年5月到2024年3月",
+])
+def test_unbounded_or_invalid(text):
+    assert parse_date_range(text, today=TODAY) is None
+
+
+def test_format_range_by_column_type():
+    date_range = DateRange(date(2025, 4, 1), date(2025, 4, 30))
+    assert format_range(date_range, "datetime(3)") == ("2025-04-01 00:00:00", "2025-04-30 23:59:59")
+    assert format_range(date_range, "date") == ("2025-04-01", "2025-04-30")
+    assert format_range(date_range, "varchar(255)") == ("2025-04-01", "2025-04-30 23:59:59")
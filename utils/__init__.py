@@ -1,10 +1,15 @@
 from .logger import logger
 from .condense import condense_msg
+from .date_parser import DateRange, parse_date_range, format_range
 from .mysql_data_helper import (
     connect_to_mysql,
+    get_mysql_pool,
     load_db_config,
     enrich_data_with_relations,
     group_and_aggregate,
     calculate_derived_metrics,
     query_data
-)
\ No newline at end of file
+)
+from .tokens import count_tokens
+from .metrics import metrics
+from .cache import LRUCache, approx_size
@@ -0,0 +1,136 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional
+
+from .logger import logger
+from .metrics import _metric_key, metrics
+
+
+def approx_size(value: Any) -> int:
+    """粗略估算对象占用的字节数，递归统计字典、列表和字符串"""
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(MutableMapping):
+    """
+    带容量上限和空闲过期的LRU字典
+
+    - max_entries: 条目数上限，超出时淘汰最久未访问的条目
+    - ttl: 空闲超过ttl秒的条目在下次写入或sweep()时淘汰
+    - can_evict: (key, value) -> bool，返回False的条目不淘汰(如尚未落盘的会话)
+    - on_evict: (key, value) 条目被淘汰后调用，del/pop 不会触发
+    - sizeof: 估算单个条目大小，用于导出内存占用指标
+
+    读取(cache[key]、get)会刷新访问时间，`in` 判断不会。
+    指标: cache_entries、cache_bytes、cache_evictions_total，均带 cache=name 标签。
+    """
+
+    def __init__(self, name: str, max_entries: Optional[int] = None, ttl: Optional[float] = None,
+                 can_evict: Optional[Callable[[Hashable, Any], bool]] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 sizeof: Callable[[Any], int] = approx_size):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._can_evict = can_evict
+        self._on_evict = on_evict
+        self._sizeof = sizeof
+        self._data: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.RLock()
+        metrics.register_collector(self._collect)
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._data[key]
+            entry[1] = time.time()
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = [value, time.time()]
+            self._data.move_to_end(key)
+            # 刚写入的条目不淘汰
+            evicted = self._evict_locked(keep=key)
+        self._notify(evicted)
+
+    def peek(self, key, default=None):
+        """读取但不刷新访问时间"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[0] if entry is not None else default
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __iter__(self) -> Iterator:
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _evictable(self, key, value) -> bool:
+        return self._can_evict is None or self._can_evict(key, value)
+
+    def _evict_locked(self, keep=None):
+        evicted = []
+        if self.ttl is not None:
+            deadline = time.time() - self.ttl
+            # 按访问时间从旧到新，遇到未过期的即可停止
+            for key, (value, accessed) in list(self._data.items()):
+                if accessed > deadline:
+                    break
+                if key != keep and self._evictable(key, value):
+                    del self._data[key]
+                    evicted.append((key, value, "idle"))
+        if self.max_entries is not None and len(self._data) > self.max_entries:
+            for key, (value, _) in list(self._data.items()):
+                if len(self._data) <= self.max_entries:
+                    break
+                if key != keep and self._evictable(key, value):
+                    del self._data[key]
+                    evicted.append((key, value, "capacity"))
+        return evicted
+
+    def _notify(self, evicted) -> None:
+        for key, value, reason in evicted:
+            metrics.inc("cache_evictions_total", cache=self.name, reason=reason)
+            if self._on_evict is not None:
+                try:
+                    self._on_evict(key, value)
+                except Exception as e:
+                    logger.warning(f"缓存 {self.name} 淘汰回调失败 {key}: {e}")
+
+    def sweep(self) -> int:
+        """淘汰空闲过期和超出容量的条目，返回淘汰数量"""
+        with self._lock:
+            evicted = self._evict_locked()
+        self._notify(evicted)
+        return len(evicted)
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            values = [entry[0] for entry in self._data.values()]
+        return sum(self._sizeof(value) for value in values)
+
+    def _collect(self) -> Dict[str, Any]:
+        return {
+            _metric_key("cache_entries", {"cache": self.name}): len(self),
+            _metric_key("cache_bytes", {"cache": self.name}): self.size_bytes(),
+        }
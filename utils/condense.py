@@ -1,8 +1,12 @@
-def condense_msg(time_info: str, chart_info: str, db_info: str):
+def condense_msg(time_info: str, chart_info: str, db_info: str, time_range=None):
+    # 数据库信息对所有请求都相同且最长，放在最前面，让不同请求的消息前缀一致，提高服务端前缀缓存命中
     instruction_info = {
+        "数据库信息": db_info,
         "索引信息": time_info,
-        "图表类型": chart_info,
-        "数据库信息": db_info
+        "图表类型": chart_info
     }
+    if time_range is not None:
+        # 本地解析出的确定日期范围(闭区间)，模型直接使用，不必自行换算
+        instruction_info["时间范围"] = {"开始": time_range.start.isoformat(), "结束": time_range.end.isoformat()}
 
     return f"{instruction_info}"
@@ -1,10 +1,28 @@
 # 新建文件: utils/data_helper.py
 
 import json
+import threading
 import pymongo
 from typing import List, Dict, Any, Optional
 
 
+# MongoClient自带连接池且线程安全，按连接串共享，不要在用完后close
+_mongo_clients: Dict[str, pymongo.MongoClient] = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(uri: str) -> pymongo.MongoClient:
+    """按连接串获取共享的MongoClient"""
+    client = _mongo_clients.get(uri)
+    if client is None:
+        with _mongo_clients_lock:
+            client = _mongo_clients.get(uri)
+            if client is None:
+                client = pymongo.MongoClient(uri)
+                _mongo_clients[uri] = client
+    return client
+
+
 def connect_to_database(db_info: Dict[str, Any]) -> pymongo.MongoClient:
     """连接到MongoDB数据库"""
     key = "TokugawaMatsuri"
@@ -19,7 +37,7 @@ def connect_to_database(db_info: Dict[str, Any]) -> pymongo.MongoClient:
         connection_string += f"{username}:{password}@"
     connection_string += f"{host}:{port}/{database_name}"
 
-    client = pymongo.MongoClient(connection_string)
+    client = get_mongo_client(connection_string)
     return client[database_name]
 
 
@@ -0,0 +1,292 @@
+"""
+中文/ISO日期与日期范围解析
+
+把 time_info 这类表达式解析成确定的闭区间 [start, end]，再按字段的存储类型格式化成查询边界，
+不再依赖模型按提示词示例转换。
+
+支持的表达式(today=2025-05-20时):
+    "2025年4月"           -> 2025-04-01 ~ 2025-04-30
+    "3月1日到3月22日"     -> 2025-03-01 ~ 2025-03-22
+    "3月1日到22日"        -> 2025-03-01 ~ 2025-03-22
+    "12月到2月"           -> 2024-12-01 ~ 2025-02-28(结束早于开始且没有写年份时跨年)
+    "2024-03-05"          -> 2024-03-05 ~ 2024-03-05
+    "2023/9 - 2024/1"     -> 2023-09-01 ~ 2024-01-31
+    "2025-03-01 - 2025-03-22" / "2025年4月1日-4月30日"
+    "二〇二四年十二月"    -> 2024-12-01 ~ 2024-12-31
+    "去年"                -> 2024-01-01 ~ 2024-12-31
+    "去年同期"            -> 2024-01-01 ~ 2024-05-20
+    "最近7天"             -> 2025-05-14 ~ 2025-05-20
+    "上个月" / "本周" / "第二季度" / "2024年下半年" 等
+    "None" / "全部" / ""  -> None(不限时间)
+"""
+import calendar
+import re
+from datetime import date, datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
+
+
+class DateRange(NamedTuple):
+    """闭区间日期范围"""
+    start: date
+    end: date
+
+    @property
+    def key(self) -> str:
+        """规范化的键，相同范围的不同写法得到相同的键，可用于缓存"""
+        return f"{self.start.isoformat()}..{self.end.isoformat()}"
+
+    def shift_years(self, years: int) -> "DateRange":
+        return DateRange(_shift_year(self.start, years), _shift_year(self.end, years))
+
+
+_EMPTY = {"", "none", "null", "无", "全部", "所有", "不限", "全局", "总体", "整体", "全部数据"}
+
+_CN_DIGITS = {"〇": 0, "零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5,
+              "六": 6, "七": 7, "八": 8, "九": 9}
+
+# 范围分隔符；"-"和ISO日期里的"-"冲突，只在以下情况算分隔符，单独处理:
+# 两侧有空格("2025-03-01 - 2025-03-22")、左侧以年/月/日结尾("4月1日-4月30日")、两侧是/或.分隔的日期
+_RANGE_SEPARATORS = re.compile(r'\s*(?:到|至|~|～|—|－－|--)\s*')
+_DASH_RANGE = re.compile(
+    r'^(.+?)\s+-\s+(\S.*)$'
+    r'|^(.+?[年月日号])-(\S.*)$'
+    r'|^(\d{4}[/.]\d{1,2}(?:[/.]\d{1,2})?)\s*-\s*(\d{4}[/.]\d{1,2}(?:[/.]\d{1,2})?)$'
+)
+_HAS_YEAR = re.compile(r'\d{4}')
+
+_ISO = re.compile(r'^(\d{4})[-/.](\d{1,2})(?:[-/.](\d{1,2}))?(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?$')
+_COMPACT = re.compile(r'^(\d{4})(\d{2})(\d{2})$')
+_CN_DATE = re.compile(r'^(?:(\d{4})年)?(?:(\d{1,2})月)?(?:(\d{1,2})[日号])?$')
+_YEAR_ONLY = re.compile(r'^(\d{4})年?$')
+_QUARTER = re.compile(r'^(?:(\d{4})年)?(?:第([1-4])季度|[Qq]([1-4]))$')
+_HALF = re.compile(r'^(?:(\d{4})年)?(上|下)半年$')
+_RECENT = re.compile(r'^(?:最近|近|过去|前)(\d+)(天|日|周|个?星期|个?月|年)$')
+
+
+def _cn_number(text: str) -> str:
+    """把中文数字换成阿拉伯数字: 二〇二五年 -> 2025年, 十二月 -> 12月, 二十二日 -> 22日"""
+    def convert(match):
+        token = match.group(0)
+        if "十" not in token:
+            return "".join(str(_CN_DIGITS[c]) for c in token)
+        tens, _, ones = token.partition("十")
+        return str((_CN_DIGITS.get(tens, 1) if tens else 1) * 10 + (_CN_DIGITS.get(ones, 0) if ones else 0))
+    return re.sub(r'[〇零一二两三四五六七八九十]+', convert, text)
+
+
+def _month_end(year: int, month: int) -> date:
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+
+def _shift_year(d: date, years: int) -> date:
+    try:
+        return d.replace(year=d.year + years)
+    except ValueError:
+        # 2月29日
+        return d.replace(year=d.year + years, day=28)
+
+
+def _shift_month(year: int, month: int, months: int) -> Tuple[int, int]:
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def _relative(text: str, today: date) -> Optional[DateRange]:
+    if text in ("今天", "今日"):
+        return DateRange(today, today)
+    if text in ("昨天", "昨日"):
+        day = today - timedelta(days=1)
+        return DateRange(day, day)
+    if text == "前天":
+        day = today - timedelta(days=2)
+        return DateRange(day, day)
+    if text in ("本周", "这周", "这个星期", "本星期"):
+        start = today - timedelta(days=today.weekday())
+        return DateRange(start, start + timedelta(days=6))
+    if text in ("上周", "上个星期", "上星期"):
+        start = today - timedelta(days=today.weekday() + 7)
+        return DateRange(start, start + timedelta(days=6))
+    if text in ("本月", "这个月", "当月"):
+        return DateRange(today.replace(day=1), _month_end(today.year, today.month))
+    if text in ("上月", "上个月"):
+        year, month = _shift_month(today.year, today.month, -1)
+        return DateRange(date(year, month, 1), _month_end(year, month))
+    if text in ("今年", "本年", "当年", "今年以来"):
+        return DateRange(date(today.year, 1, 1), date(today.year, 12, 31))
+    if text == "去年":
+        return DateRange(date(today.year - 1, 1, 1), date(today.year - 1, 12, 31))
+    if text == "前年":
+        return DateRange(date(today.year - 2, 1, 1), date(today.year - 2, 12, 31))
+    if text in ("本季度", "这个季度"):
+        quarter = (today.month - 1) // 3
+        return DateRange(date(today.year, quarter * 3 + 1, 1), _month_end(today.year, quarter * 3 + 3))
+    if text in ("上季度", "上个季度"):
+        year, month = _shift_month(today.year, ((today.month - 1) // 3) * 3 + 1, -3)
+        return DateRange(date(year, month, 1), _month_end(year, month + 2))
+    if text in ("去年同期", "同期"):
+        # 去年年初到去年的今天，和今年以来的数据对比
+        return DateRange(date(today.year - 1, 1, 1), _shift_year(today, -1))
+
+    match = _RECENT.match(text)
+    if match:
+        count, unit = int(match.group(1)), match.group(2)
+        if count == 0:
+            return None
+        if unit in ("天", "日"):
+            return DateRange(today - timedelta(days=count - 1), today)
+        if unit.endswith(("周", "星期")):
+            return DateRange(today - timedelta(days=count * 7 - 1), today)
+        if unit.endswith("月"):
+            year, month = _shift_month(today.year, today.month, -count)
+            start = date(year, month, min(today.day, calendar.monthrange(year, month)[1])) + timedelta(days=1)
+            return DateRange(start, today)
+        return DateRange(_shift_year(today, -count) + timedelta(days=1), today)
+    return None
+
+
+def _single(text: str, today: date, default_year: Optional[int] = None,
+            default_month: Optional[int] = None) -> Optional[DateRange]:
+    """解析单个日期表达式，年份或月份缺省时使用default_year/default_month(范围的结束部分)或今年"""
+    text = text.strip()
+    if not text:
+        return None
+
+    relative = _relative(text, today)
+    if relative:
+        return relative
+
+    match = _ISO.match(text)
+    if match:
+        year, month, day = int(match.group(1)), int(match.group(2)), match.group(3)
+        if day:
+            d = date(year, month, int(day))
+            return DateRange(d, d)
+        return DateRange(date(year, month, 1), _month_end(year, month))
+
+    match = _COMPACT.match(text)
+    if match:
+        d = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        return DateRange(d, d)
+
+    match = _YEAR_ONLY.match(text)
+    if match:
+        year = int(match.group(1))
+        return DateRange(date(year, 1, 1), date(year, 12, 31))
+
+    match = _QUARTER.match(text)
+    if match:
+        year = int(match.group(1)) if match.group(1) else today.year
+        quarter = int(match.group(2) or match.group(3))
+        return DateRange(date(year, quarter * 3 - 2, 1), _month_end(year, quarter * 3))
+
+    match = _HALF.match(text)
+    if match:
+        year = int(match.group(1)) if match.group(1) else today.year
+        if match.group(2) == "上":
+            return DateRange(date(year, 1, 1), date(year, 6, 30))
+        return DateRange(date(year, 7, 1), date(year, 12, 31))
+
+    match = _CN_DATE.match(text)
+    if match and any(match.groups()):
+        year = int(match.group(1)) if match.group(1) else (default_year or today.year)
+        month = int(match.group(2)) if match.group(2) else None
+        day = int(match.group(3)) if match.group(3) else None
+        if month is None and day is not None:
+            month = default_month or today.month
+        if month is None:
+            return DateRange(date(year, 1, 1), date(year, 12, 31))
+        if day is None:
+            return DateRange(date(year, month, 1), _month_end(year, month))
+        d = date(year, month, day)
+        return DateRange(d, d)
+    return None
+
+
+def _split_range(text: str) -> Optional[Tuple[str, str]]:
+    parts = _RANGE_SEPARATORS.split(text, maxsplit=1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    match = _DASH_RANGE.match(text)
+    if match:
+        groups = match.groups()
+        for i in range(0, len(groups), 2):
+            if groups[i] is not None:
+                return groups[i], groups[i + 1]
+    return None
+
+
+def _has_year(text: str, today: date) -> bool:
+    """表达式是否确定了年份(写了年份或是相对日期)"""
+    return bool(_HAS_YEAR.search(text)) or _relative(text.strip(), today) is not None
+
+
+def parse_date_range(text: Optional[str], today: Optional[date] = None) -> Optional[DateRange]:
+    """
+    把日期表达式解析成闭区间，不限时间或无法解析时返回None
+
+    参数:
+    - text: 日期表达式，如 "2025年4月"、"3月1日到3月22日"、"去年同期"
+    - today: 相对日期的基准，默认今天
+    """
+    if text is None:
+        return None
+    today = today or date.today()
+    text = _cn_number(str(text).strip())
+    text = re.sub(r'^(从|自)', '', text)
+    text = re.sub(r'(以来|为止|期间|的数据|数据)$', '', text).strip()
+    if text.lower() in _EMPTY:
+        return None
+
+    try:
+        parts = _split_range(text)
+        if parts:
+            start = _single(parts[0], today)
+            if start is None:
+                return None
+            # "3月1日到22日": 结束部分缺省的年/月沿用开始部分
+            end = _single(parts[1], today, default_year=start.start.year, default_month=start.start.month)
+            if end is None:
+                return None
+            if end.end < start.start:
+                # 结束早于开始: 没写年份的一端跨年("12月到2月")，两端都写了年份的是无效范围
+                if not _has_year(parts[0], today):
+                    start = start.shift_years(-1)
+                elif not _has_year(parts[1], today):
+                    # 重新按下一年解析，跨到闰年的2月也取到29日
+                    end = _single(parts[1], today, default_year=start.start.year + 1, default_month=start.start.month)
+                if end.end < start.start:
+                    return None
+            return DateRange(start.start, end.end)
+        return _single(text, today)
+    except ValueError:
+        # 不存在的日期，如2月30日
+        return None
+
+
+def is_datetime_column(column_type: Optional[str]) -> bool:
+    column_type = (column_type or "").lower()
+    return "datetime" in column_type or "timestamp" in column_type
+
+
+def format_bound(value: date, column_type: Optional[str], end: bool = False) -> str:
+    """
+    按字段类型格式化范围的一端
+
+    - datetime/timestamp: 开始取 00:00:00，结束取 23:59:59
+    - date: YYYY-MM-DD
+    - 文本: 开始 YYYY-MM-DD；结束带 23:59:59，文本里带时间的值也能被包含在内
+    """
+    column_type = (column_type or "").lower()
+    if is_datetime_column(column_type):
+        moment = datetime.combine(value, datetime.max.time() if end else datetime.min.time())
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+    if column_type.startswith("date"):
+        return value.isoformat()
+    if end:
+        return f"{value.isoformat()} 23:59:59"
+    return value.isoformat()
+
+
+def format_range(date_range: DateRange, column_type: Optional[str]) -> Tuple[str, str]:
+    """按字段类型格式化整个范围，返回 (开始, 结束)"""
+    return format_bound(date_range.start, column_type), format_bound(date_range.end, column_type, end=True)
@@ -0,0 +1,57 @@
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> str:
+    """把指标名和标签拼成 name{k="v",...} 形式的键"""
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+class MetricsRegistry:
+    """进程内的简单指标注册表，供 /api/metrics 导出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._collectors: List[Callable[[], Dict[str, Any]]] = []
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """累加计数器"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """设置瞬时值"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def register_collector(self, collector: Callable[[], Dict[str, Any]]) -> None:
+        """注册在导出时才计算的指标，collector返回 {指标键: 值}"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出当前所有指标"""
+        with self._lock:
+            result = dict(self._counters)
+            result.update(self._gauges)
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            try:
+                result.update(collector())
+            except Exception as e:
+                result[f"collector_error{{name=\"{getattr(collector, '__name__', 'unknown')}\"}}"] = str(e)
+
+        return dict(sorted(result.items()))
+
+
+# 全局指标实例
+metrics = MetricsRegistry()
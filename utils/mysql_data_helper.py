@@ -1,6 +1,9 @@
 import json
 import os
+import queue
+import threading
 import pymysql
+from contextlib import contextmanager
 from datetime import datetime, date
 from typing import List, Dict, Any, Optional
 from utils import logger
@@ -39,6 +42,92 @@ def connect_to_mysql(db_info: Dict[str, Any]) -> pymysql.connections.Connection:
         raise
 
 
+class MySQLConnectionPool:
+    """线程安全的MySQL连接池，连接用完归还复用，避免每次查询都重新建连"""
+
+    def __init__(self, db_info: Dict[str, Any], max_size: int = 8):
+        self._db_info = db_info
+        self._max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = 30.0) -> pymysql.connections.Connection:
+        """取出一个可用连接，池中没有空闲连接且未达上限时新建"""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self._max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return connect_to_mysql(self._db_info)
+                except BaseException:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            connection = self._idle.get(timeout=timeout)
+
+        try:
+            connection.ping(reconnect=True)
+        except Exception:
+            self._discard(connection)
+            return self.acquire(timeout)
+        return connection
+
+    def release(self, connection: pymysql.connections.Connection) -> None:
+        """归还连接，结束未提交的事务，避免复用时读到旧快照"""
+        try:
+            if connection.open:
+                connection.rollback()
+                self._idle.put(connection)
+                return
+        except Exception:
+            pass
+        self._discard(connection)
+
+    def _discard(self, connection: pymysql.connections.Connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: 用法，退出时自动归还"""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+
+_pools: Dict[tuple, MySQLConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_mysql_pool(db_info: Optional[Dict[str, Any]] = None) -> MySQLConnectionPool:
+    """按连接配置获取共享连接池"""
+    if db_info is None:
+        db_info = load_db_config()
+    if "mysql" in db_info:
+        db_info = db_info["mysql"]
+
+    key = (db_info.get("host"), db_info.get("port"), db_info.get("username"), db_info.get("database"))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = MySQLConnectionPool(db_info, max_size=int(os.environ.get('MYSQL_POOL_SIZE', '8')))
+                _pools[key] = pool
+    return pool
+
+
 def get_base_path():
     if getattr(sys, 'frozen', False):
         return os.path.dirname(sys.executable)
@@ -0,0 +1,34 @@
+import re
+
+try:
+    import tiktoken
+    # cl100k_base 与 deepseek/openai 的分词差距不大，足够用于预算估算
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # 未安装tiktoken或无法加载词表(如离线环境)时使用启发式估算
+    _encoding = None
+
+# 中日韩文字和全角标点，每个字大约一个token
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def count_tokens(text) -> int:
+    """估算文本的token数量
+
+    参数:
+    - text: 待统计的文本，非字符串会先转为字符串
+
+    返回:
+    - token数量
+    """
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4